@@ -0,0 +1,68 @@
+import argparse
+import gzip
+import os
+import tempfile
+import time
+import gaia_filter
+import synthetic_gaia
+
+#
+# Compares the original per-line filter with the vectorized chunk parser on a
+# synthetic GaiaSource shard and checks that both produce the same output
+#
+
+def run(parser, file_path):
+    start = time.perf_counter()
+    blocks = []
+    accepted = 0
+    total = 0
+    with gzip.open(file_path, mode='rb') as file:
+        for block, block_accepted, block_total in gaia_filter.PARSERS[parser](file):
+            blocks.append(block)
+            accepted += block_accepted
+            total += block_total
+    elapsed = time.perf_counter() - start
+    return b''.join(blocks), accepted, total, elapsed
+
+def decompress_only(file_path):
+    # Time spent in gunzip alone, common to both parsers
+    start = time.perf_counter()
+    with gzip.open(file_path, mode='rb') as file:
+        while file.read(16 * 1024 * 1024):
+            pass
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the GAIA source row filters on a synthetic shard.")
+    parser.add_argument("--rows", type=int, default=500_000, help="Number of rows in the synthetic shard")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs per parser, the best is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = os.path.join(tmp, 'GaiaSource_synthetic.csv.gz')
+        print(f"Generating synthetic shard with {args.rows} rows")
+        synthetic_gaia.make_shard(file_path, args.rows)
+
+        gunzip = min(decompress_only(file_path) for i in range(args.repeat))
+        print(f"gunzip: {gunzip:.2f}s")
+
+        results = {}
+        timings = {}
+        for name in gaia_filter.PARSERS:
+            best = None
+            for i in range(args.repeat):
+                output, accepted, total, elapsed = run(name, file_path)
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = output
+            timings[name] = best
+            print(f"{name:>6}: {total / best:12,.0f} rows/sec ({best:.2f}s, accepted {accepted} from {total})")
+
+        print(f"Speedup: {timings['line'] / timings['chunk']:.2f}x overall, "
+              f"{(timings['line'] - gunzip) / (timings['chunk'] - gunzip):.2f}x excluding gunzip")
+        if len(set(results.values())) != 1:
+            print("WARNING: parsers produced different output")
+        else:
+            print("Outputs identical")
+
+if __name__ == "__main__":
+    main()
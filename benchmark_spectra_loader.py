@@ -0,0 +1,104 @@
+import argparse
+import gzip
+import io
+import os
+import tempfile
+import time
+import xp_spectra
+import synthetic_gaia
+
+#
+# Compares three ways of converting a synthetic XP sampled spectrum shard for COPY:
+# the original rewrite of every whole line to a csv with {} arrays, the text format
+# fetch_spectra.py uses by default, which cuts each line down to source_id and flux,
+# and the binary format, which parses the flux into float32 and encodes it as COPY
+# binary. With --dsn every stream is also COPYed into a temporary table, where the
+# difference in Postgres' own parsing shows up, and the end to end rates are compared
+#
+
+def convert_csv(file_path):
+    # What fetch_spectra.py used to do, writing to memory rather than disk
+    output = io.StringIO()
+    start = time.perf_counter()
+    with gzip.open(file_path, mode='rt', encoding='utf-8') as file:
+        rows = 0
+        for line in file:
+            if line.startswith('#'):
+                continue
+            line = line.replace('[', '{').replace(']', '}')
+            output.write(line.strip() + '\n')
+            rows += 1
+    return output.getvalue().encode('utf-8'), rows - 1, time.perf_counter() - start
+
+def convert_text(file_path):
+    counts = {}
+    start = time.perf_counter()
+    with gzip.open(file_path, mode='rb') as file:
+        stream = b''.join(xp_spectra.text_blocks(file, counts=counts))
+    return stream, counts['read'], time.perf_counter() - start
+
+def convert_binary(file_path):
+    counts = {}
+    start = time.perf_counter()
+    with gzip.open(file_path, mode='rb') as file:
+        stream = b''.join(xp_spectra.copy_blocks(file, counts=counts))
+    return stream, counts['read'], time.perf_counter() - start
+
+def copy_into(conn, data, name):
+    # Time COPY of one converted stream into a temporary table
+    with conn.cursor() as cursor:
+        if name == 'binary':
+            cursor.execute("CREATE TEMPORARY TABLE benchmark_spectra (source_id BIGINT, flux REAL[])")
+            sql = "COPY benchmark_spectra (source_id, flux) FROM STDIN WITH (FORMAT binary)"
+        elif name == 'text':
+            cursor.execute("CREATE TEMPORARY TABLE benchmark_spectra (source_id BIGINT, flux REAL[])")
+            sql = "COPY benchmark_spectra (source_id, flux) FROM STDIN WITH CSV"
+        else:
+            cursor.execute("CREATE TEMPORARY TABLE benchmark_spectra (source_id BIGINT, solution_id BIGINT, ra REAL, dec REAL, flux REAL[], flux_error REAL[])")
+            sql = "COPY benchmark_spectra (source_id, solution_id, ra, dec, flux, flux_error) FROM STDIN WITH CSV HEADER"
+        start = time.perf_counter()
+        cursor.copy_expert(sql, io.BytesIO(data), size=1024 * 1024)
+        elapsed = time.perf_counter() - start
+    conn.rollback()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the XP spectra conversion on a synthetic shard.")
+    parser.add_argument("--rows", type=int, default=20_000, help="Number of spectra in the synthetic shard")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs per method, the best is reported")
+    parser.add_argument("--dsn", default=None, help="Also time COPY of both outputs into this database")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = os.path.join(tmp, 'XpSampledMeanSpectrum_synthetic.csv.gz')
+        print(f"Generating synthetic shard with {args.rows} spectra")
+        synthetic_gaia.make_spectra_shard(file_path, args.rows)
+
+        timings = {}
+        outputs = {}
+        for name, convert in [('csv', convert_csv), ('text', convert_text), ('binary', convert_binary)]:
+            best = None
+            for i in range(args.repeat):
+                output, rows, elapsed = convert(file_path)
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+            outputs[name] = output
+            print(f"{name:>6}: {rows / best:10,.0f} rows/sec ({best:.2f}s), {len(output) / 1024**2:.1f} MB for Postgres to read")
+        for name in ['text', 'binary']:
+            print(f"Conversion speedup of {name} over csv: {timings['csv'] / timings[name]:.2f}x")
+
+        if args.dsn is not None:
+            import psycopg2
+            conn = psycopg2.connect(args.dsn)
+            try:
+                copies = {name: min(copy_into(conn, outputs[name], name) for i in range(args.repeat)) for name in outputs}
+            finally:
+                conn.close()
+            for name, elapsed in copies.items():
+                total = timings[name] + elapsed
+                print(f"{name:>6}: COPY {elapsed:.2f}s, {args.rows / total:10,.0f} rows/sec end to end")
+            for name in ['text', 'binary']:
+                print(f"End to end speedup of {name} over csv: {(timings['csv'] + copies['csv']) / (timings[name] + copies[name]):.2f}x")
+
+if __name__ == "__main__":
+    main()
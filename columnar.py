@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import numpy as np
+
+#
+# Columnar staging format for the filtered GAIA source rows, an alternative to the
+# data{N}.csv files. Each shard becomes a directory holding one .npy file per column
+# and a small descriptor.json, e.g.
+#
+#   columns/GaiaSource_000000-003111/ra.npy
+#   columns/GaiaSource_000000-003111/descriptor.json
+#
+# Columns are float64 ra/dec, float32 pmra/pmdec/phot_g_mean_mag/teff, int64 source_id,
+# bool has_xp_sampled and int32 healpix{level}. Every column is fixed width so it can be opened with np.load(mmap_mode='r') and
+# scanned without parsing any text. The descriptor also carries the shard's zone map
+# (see zonemap.py) when it is known
+#
+
+def shard_directory(directory, shard):
+    return os.path.join(directory, shard.split('.')[0])
+
+def save_shard(directory, shard, columns, total=None, zone=None):
+    # Write into a temporary directory and rename it into place, so a shard
+    # directory either holds a complete shard or doesn't exist
+    target = shard_directory(directory, shard)
+    staging = target + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    rows = len(next(iter(columns.values()))) if columns else 0
+    descriptor = {'shard': shard, 'rows': rows, 'total': total, 'columns': {}}
+    if zone is not None:
+        descriptor['zone'] = zone
+    for name, values in columns.items():
+        file_name = f'{name}.npy'
+        np.save(os.path.join(staging, file_name), values)
+        descriptor['columns'][name] = {'file': file_name, 'dtype': values.dtype.str}
+    with open(os.path.join(staging, 'descriptor.json'), 'w') as f:
+        json.dump(descriptor, f, indent=1)
+
+    for name in os.listdir(staging):
+        with open(os.path.join(staging, name), 'rb') as f:
+            os.fsync(f.fileno())
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(staging, target)
+    return target, descriptor
+
+def clean(directory):
+    # Remove shards that were part way through being written
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith('.tmp'):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+def load_shard(path, names=None, mmap_mode='r'):
+    # Returns (descriptor, columns) with every column memory mapped
+    with open(os.path.join(path, 'descriptor.json'), 'r') as f:
+        descriptor = json.load(f)
+    columns = {}
+    for name, column in descriptor['columns'].items():
+        if names is None or name in names:
+            columns[name] = np.load(os.path.join(path, column['file']), mmap_mode=mmap_mode)
+    return descriptor, columns
+
+def list_shards(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if os.path.exists(os.path.join(directory, name, 'descriptor.json')))
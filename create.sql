@@ -11,8 +11,20 @@ CREATE TABLE stars (
     flux REAL[]
 );
 
+-- Alternatively keep the spectra in the form the photometric catalogue stores them, a one byte exponent and 343
+-- float16 values, 687 bytes in all. That is small enough to stay in the row rather than being TOASTed, and
+-- generate-photometry.py --flux-column flux16 copies it straight out. Load it with fetch_spectra.py --flux-format float16
+-- ALTER TABLE stars ADD COLUMN flux16 BYTEA;
+
 -- Run this to import data from the GAIA extract
-COPY stars (ra, dec, pmra, pmdec, phot_g_mean_mag, source_id, has_xp_sampled, teff) FROM '/path/to/your/file.csv' DELIMITER ',' CSV HEADER NULL "null";
+COPY stars (ra, dec, pmra, pmdec, phot_g_mean_mag, source_id, has_xp_sampled, teff, healpix8) FROM '/path/to/your/file.csv' DELIMITER ',' CSV HEADER NULL "null";
+
+-- Files written with --compress gzip load the same way through zcat (zstd -dc or lz4 -dc for .zst and .lz4),
+-- or use load_staging.py
+-- COPY stars (ra, dec, pmra, pmdec, phot_g_mean_mag, source_id, has_xp_sampled, teff, healpix8) FROM PROGRAM 'zcat /path/to/your/file.csv.gz' DELIMITER ',' CSV HEADER NULL "null";
+
+-- If the csv files were made with --healpix-levels (no levels) they have no healpix8 column, load them with
+-- the column list above minus healpix8 and run update-healpix8.pl afterwards
 
 -- Create these after you populate data into stars
 CREATE INDEX idx_healpix8_phot_g ON stars (healpix8, phot_g_mean_mag);
@@ -37,4 +49,8 @@ CREATE TABLE public.photometry (
 CREATE INDEX idx_photometry_healpix2_healpix8
 ON public.photometry (healpix2, healpix8);
 
+-- Instead of running the find-127 scripts, fill both tables from the output of find_brightest.py
+-- COPY astrometry (source_id, healpix8) FROM '/path/to/selections/astrometry.csv' DELIMITER ',' CSV HEADER;
+-- COPY photometry (source_id, healpix8, healpix2) FROM '/path/to/selections/photometry.csv' DELIMITER ',' CSV HEADER;
+
 
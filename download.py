@@ -0,0 +1,151 @@
+import contextlib
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+#
+# Download engine shared by the fetch scripts. Connections come from one pooled
+# requests.Session, every request has a connect and read timeout so a stalled
+# connection fails instead of blocking a worker forever, and large files are split
+# into byte ranges fetched side by side. The size of every download is checked
+#
+
+PARTS = 4
+PART_SIZE = 32 * 1024 * 1024
+TIMEOUT = (10, 60)  # connect, read
+POOL_MAXSIZE = 64
+READ_SIZE = 1024 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+class DownloadError(Exception):
+    pass
+
+def configure(parts=None, part_size=None, timeout=None, workers=None):
+    # Change the defaults used by every download in this process. workers is the most
+    # files that can download at once, each over up to PARTS connections, and sizes
+    # the connection pool so none of them has to be thrown away after use
+    global PARTS, PART_SIZE, TIMEOUT, POOL_MAXSIZE, _session
+    if parts is not None:
+        PARTS = parts
+    if part_size is not None:
+        PART_SIZE = part_size
+    if timeout is not None:
+        TIMEOUT = timeout
+    if workers is not None:
+        with _session_lock:
+            POOL_MAXSIZE = max(1, workers * PARTS)
+            _session = None
+
+def session(pool_maxsize=None):
+    # One Session for the whole process so connections are kept alive and reused
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize or POOL_MAXSIZE)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def get(url, timeout=None, **kwargs):
+    r = session().get(url, timeout=timeout or TIMEOUT, **kwargs)
+    r.raise_for_status()
+    return r
+
+def probe(url, timeout):
+    # Returns (size, supports_ranges), size is None when the server doesn't say
+    r = session().head(url, timeout=timeout, allow_redirects=True)
+    r.raise_for_status()
+    size = r.headers.get('Content-Length')
+    return (int(size) if size is not None else None), r.headers.get('Accept-Ranges') == 'bytes'
+
+def fetch_range(url, start, end, write, timeout):
+    # Fetch bytes start..end inclusive, handing each piece to write(offset, data)
+    headers = {'Range': f'bytes={start}-{end}'}
+    with session().get(url, headers=headers, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise DownloadError(f"{url} ignored range {start}-{end}")
+        offset = start
+        while offset <= end:
+            data = r.raw.read(min(READ_SIZE, end + 1 - offset))
+            if not data:
+                break
+            write(offset, data)
+            offset += len(data)
+    if offset != end + 1:
+        raise DownloadError(f"{url} range {start}-{end} ended early at {offset}")
+
+def fetch_whole(url, write, size, timeout):
+    # Single streaming GET, checked against Content-Length when there is one
+    with session().get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        if size is None and r.headers.get('Content-Length') is not None:
+            size = int(r.headers['Content-Length'])
+        offset = 0
+        while True:
+            data = r.raw.read(READ_SIZE)
+            if not data:
+                break
+            write(offset, data)
+            offset += len(data)
+    if size is not None and offset != size:
+        raise DownloadError(f"{url} was {offset} bytes, expected {size}")
+    return offset
+
+@contextlib.contextmanager
+def open_stream(url, timeout=None):
+    # Single streaming GET whose body is read as it arrives, for decoding a file on
+    # the fly rather than holding all of it. The read timeout applies to every read
+    with session().get(url, stream=True, timeout=timeout or TIMEOUT) as r:
+        r.raise_for_status()
+        yield r.raw
+
+def ranges(size, parts, part_size):
+    # Split size bytes into at most parts inclusive ranges of at least part_size
+    count = max(1, min(parts, math.ceil(size / part_size)))
+    step = math.ceil(size / count)
+    return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+def fetch(url, write, parts=None, part_size=None, timeout=None):
+    # Download url through write(offset, data), in parallel ranges when the file is
+    # big enough and the server allows it. Returns the size
+    parts = parts or PARTS
+    part_size = part_size or PART_SIZE
+    timeout = timeout or TIMEOUT
+    size, supports_ranges = probe(url, timeout)
+    if size is None or not supports_ranges or parts < 2 or size < 2 * part_size:
+        return fetch_whole(url, write, size, timeout)
+
+    with ThreadPoolExecutor(max_workers=parts) as executor:
+        futures = [executor.submit(fetch_range, url, start, end, write, timeout) for start, end in ranges(size, parts, part_size)]
+        for future in futures:
+            future.result()
+    return size
+
+def fetch_bytes(url, **kwargs):
+    buffer = bytearray()
+    lock = threading.Lock()
+
+    def write(offset, data):
+        with lock:
+            if len(buffer) < offset + len(data):
+                buffer.extend(bytes(offset + len(data) - len(buffer)))
+            buffer[offset:offset + len(data)] = data
+
+    size = fetch(url, write, **kwargs)
+    return bytes(buffer[:size])
+
+def fetch_file(url, path, **kwargs):
+    # Ranges are written straight to their place in the file
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        size = fetch(url, lambda offset, data: os.pwrite(fd, data, offset), **kwargs)
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+    return path
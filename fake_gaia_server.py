@@ -0,0 +1,128 @@
+import argparse
+import gzip
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import synthetic_gaia
+
+#
+# A local stand-in for the GAIA CDN for offline testing. It serves an html directory
+# listing of .csv.gz shards like https://cdn.gea.esac.esa.int/Gaia/gdr3/gaia_source/
+# and the shards themselves, with HEAD and Range support. An optional per-connection
+# rate limit makes it possible to see what parallel ranged downloads buy
+#
+# e.g. python fake_gaia_server.py --shards 8 --rows 100000 --port 8000
+#      python fetch_gaia_source.py --url http://localhost:8000/gaia_source/
+#
+
+CHUNK = 64 * 1024
+
+class ShardHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_listing(self, directory, head):
+        names = sorted(path[len(directory):] for path in self.server.files if path.startswith(directory))
+        body = ''.join(f'<a href="{name}">{name}</a>\n' for name in names)
+        body = f'<html><body><pre>\n{body}</pre></body></html>\n'.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_file(self, data, head):
+        start, end = 0, len(data) - 1
+        status = 200
+        requested = self.headers.get('Range')
+        if requested is not None and requested.startswith('bytes='):
+            first, last = requested[len('bytes='):].split('-')
+            start = int(first)
+            end = min(int(last), len(data) - 1) if last else len(data) - 1
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/gzip')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end + 1 - start))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.end_headers()
+        if head:
+            return
+
+        view = memoryview(data)[start:end + 1]
+        for offset in range(0, len(view), CHUNK):
+            if self.server.stall:
+                time.sleep(self.server.stall)
+                return
+            piece = view[offset:offset + CHUNK]
+            self.wfile.write(piece)
+            if self.server.rate:
+                time.sleep(len(piece) / self.server.rate)
+
+    def handle_request(self, head):
+        path = self.path.split('?')[0]
+        if path.endswith('/'):
+            return self.send_listing(path, head)
+        data = self.server.files.get(path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_file(data, head)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+def start_server(files, port=0, rate=None, stall=None):
+    # files maps url paths such as '/gaia_source/GaiaSource_000000-003111.csv.gz' to
+    # their bytes. rate is bytes/sec per connection, stall makes every transfer hang
+    # for that many seconds after the headers. Returns (server, base url)
+    server = ThreadingHTTPServer(('127.0.0.1', port), ShardHandler)
+    server.daemon_threads = True
+    server.files = files
+    server.rate = rate
+    server.stall = stall
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+def gaia_source_files(num_shards, num_rows, directory='/gaia_source/'):
+    # Synthetic GaiaSource shards named by the level 8 pixel range they cover, each
+    # shard's stars lie in the first pixel of its range
+    files = {}
+    pixels = 786432 // num_shards
+    for i in range(num_shards):
+        first = i * pixels
+        name = f'GaiaSource_{first:06d}-{first + pixels - 1:06d}.csv.gz'
+        text = '# %ECSV 1.0\n' + ','.join(synthetic_gaia.header_columns()) + '\n' + ''.join(synthetic_gaia.make_rows(num_rows, seed=i, healpix8=first))
+        files[directory + name] = gzip.compress(text.encode('utf-8'), compresslevel=1)
+    return files
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic GAIA shards over HTTP for offline testing.")
+    parser.add_argument("--shards", type=int, default=8, help="Number of GaiaSource shards")
+    parser.add_argument("--rows", type=int, default=100_000, help="Rows per shard")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rate-limit", type=float, default=None, help="Per-connection limit in MB/sec")
+    args = parser.parse_args()
+
+    print(f"Generating {args.shards} shards of {args.rows} rows")
+    files = gaia_source_files(args.shards, args.rows)
+    rate = args.rate_limit * 1024**2 if args.rate_limit else None
+    server, url = start_server(files, args.port, rate)
+    print(f"Serving {url}/gaia_source/")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,148 +1,310 @@
-import requests
 import threading
+import argparse
+import contextlib
 from bs4 import BeautifulSoup
 import os
-import shutil
-import csv
-import gzip
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import queue
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import time
+import psycopg2
+import gaia_filter
+import pipeline
+import manifest
+import download
+import metrics
+import governor
+import sinks
+import staging
 
 #
 # This script fetches GAIA source csv files, filters them and outputs a csv suitable for
 # importing into the local database using a COPY command
 #
-# e.g. COPY stars (ra, dec, pmra, pmdec, phot_g_mean_mag, source_id, has_xp_sampled, teff) FROM '/path/to/your/file.csv' DELIMITER ',' CSV HEADER NULL "null";
+# e.g. COPY stars (ra, dec, pmra, pmdec, phot_g_mean_mag, source_id, has_xp_sampled, teff, healpix8) FROM '/path/to/your/file.csv' DELIMITER ',' CSV HEADER NULL "null";
+#
+# Alternatively use --sink copy to stream the rows straight into the stars table
 #
 
-POOL_SIZE = 16
-lock = threading.Lock()
-data_queue = queue.Queue()
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_QUEUE_BLOCKS = 32
+DOWNLOAD_QUEUE_MEMORY = 1024 * 1024 * 1024
 
 def fetch_urls(url):
     print(f"Fetching list of urls from {url}")
-    response = requests.get(url)
+    response = download.get(url)
     soup = BeautifulSoup(response.content, 'html.parser')
     return [url + link.get('href') for link in soup.find_all('a') if link.get('href').endswith('.csv.gz')]
 
-def download_and_process_file(file_url):
+def download_shard(file_url, keep_raw=False):
+    # Download stage: fetch the complete compressed shard into memory, in parallel
+    # byte ranges. Optionally keep a copy on disk as well
+    print(f"Downloading {file_url}")
+    with metrics.stage('download'):
+        data = download.fetch_bytes(file_url)
+    metrics.count('bytes_downloaded', len(data))
+    if keep_raw:
+        with open(os.path.join('.', file_url.split('/')[-1]), 'wb') as f:
+            f.write(data)
+    return data
+
+class ShardReader:
+    # Wraps a response body so every compressed byte handed to the gzip decoder is
+    # counted as downloaded, and also written to a local copy of the shard if one
+    # is being kept
+    def __init__(self, source, sink=None):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if data:
+            metrics.count('bytes_downloaded', len(data))
+            if self.sink is not None:
+                self.sink.write(data)
+        return data
+
+def stream_shard(file_url, parser='chunk', healpix_levels=(), columns=False, keep_raw=False):
+    # Download and filter stages in one for the thread backend: the response body is
+    # decompressed and filtered as it arrives, so only a chunk of the compressed
+    # shard is ever held rather than all of it. Costs the parallel byte ranges
     print(f"Downloading {file_url}")
     file_name = file_url.split('/')[-1]
-    file_path = os.path.join('.', file_name)
-    
-    with requests.get(file_url, stream=True) as r:
-        with open(file_path, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
-    
-    print(f"Processing {file_path}")
-    with gzip.open(file_path, mode='rt', encoding='utf-8') as file:
+    with contextlib.ExitStack() as stack:
+        body = stack.enter_context(download.open_stream(file_url))
+        sink = stack.enter_context(open(os.path.join('.', file_name), 'wb')) if keep_raw else None
+        with metrics.stage('download_filter'):
+            if columns:
+                block, accepted, total = gaia_filter.filter_gz_column_stream(ShardReader(body, sink), healpix_levels)
+            else:
+                block, accepted, total = gaia_filter.filter_gz_stream(ShardReader(body, sink), parser, healpix_levels)
+    return sinks.shard_item(file_name, block, accepted, total, columns)
 
-        total = 0
-        accepted = 0
+def filter_shard(file_url, data, process_pool=None, parser='chunk', healpix_levels=(), columns=False):
+    # Filter stage: decompress and filter one downloaded shard, on this thread or in
+    # a worker process. zlib and most of the numpy parsing release the GIL, so the
+    # thread backend still gets some parallelism. Returns the queue item for the
+    # writer and its size
+    file_name = file_url.split('/')[-1]
+    shard_filter = gaia_filter.filter_gz_columns if columns else gaia_filter.filter_gz_bytes
+    shard_args = (data, healpix_levels) if columns else (data, parser, healpix_levels)
+    with metrics.stage('filter'):
+        if process_pool is None:
+            block, accepted, total = shard_filter(*shard_args)
+        else:
+            block, accepted, total = process_pool.submit(shard_filter, *shard_args).result()
+    return sinks.shard_item(file_name, block, accepted, total, columns)
 
-        header_indices = {}
+def main():
+    parser = argparse.ArgumentParser(description="Fetch and filter GAIA source csv files into csv files ready for COPY.")
+    parser.add_argument("--keep-raw", action="store_true", help="Keep a local copy of each raw .csv.gz shard as it is downloaded")
+    parser.add_argument("--backend", choices=["thread", "process"], default="thread", help="Filter shards on the filter threads or in a pool of worker processes")
+    parser.add_argument("--download-workers", type=int, default=DOWNLOAD_WORKERS, help="Number of shards downloading at once to start with")
+    parser.add_argument("--min-download-workers", type=int, default=governor.MIN_WORKERS, help="Fewest shards the governor lets download at once")
+    parser.add_argument("--max-download-workers", type=int, default=governor.MAX_WORKERS, help="Most shards the governor lets download at once, the same as --download-workers for a fixed count")
+    parser.add_argument("--min-free-disk", type=int, default=governor.MIN_FREE_DISK // 1024**3, help="GB of free space to keep on the output disk, downloads are cut back below it")
+    parser.add_argument("--max-rss", type=int, default=None, help="MB of memory to stay under, downloads are cut back above it. Defaults to 3/4 of RAM")
+    parser.add_argument("--governor-interval", type=int, default=governor.INTERVAL, help="Seconds between download concurrency adjustments")
+    parser.add_argument("--buffer-shards", action="store_true", help="With the thread backend, download each shard whole into memory, in parallel byte ranges, before filtering it instead of filtering the response as it arrives")
+    parser.add_argument("--filter-workers", "--workers", dest="filter_workers", type=int, default=None, help="Number of shards being decompressed and filtered at once with --backend process or --buffer-shards, defaults to the number of cores")
+    parser.add_argument("--download-queue-blocks", type=int, default=DOWNLOAD_QUEUE_BLOCKS, help="Maximum number of downloaded shards waiting to be filtered")
+    parser.add_argument("--download-queue-memory", type=int, default=DOWNLOAD_QUEUE_MEMORY // 1024**2, help="Maximum MB of downloaded shards waiting to be filtered before downloads block")
+    parser.add_argument("--parser", choices=list(gaia_filter.PARSERS), default="chunk", help="Vectorized chunk parser or the original per-line loop")
+    parser.add_argument("--queue-blocks", type=int, default=pipeline.QUEUE_BLOCKS, help="Maximum number of blocks waiting for the writer")
+    parser.add_argument("--queue-memory", type=int, default=pipeline.QUEUE_MEMORY // 1024**2, help="Maximum MB of rows waiting for the writer before parsers block")
+    parser.add_argument("--healpix-levels", type=int, nargs='*', default=gaia_filter.HEALPIX_LEVELS, help="Append a healpix{level} column for each level, pass no levels for the plain 8 column output")
+    parser.add_argument("--sink", choices=["csv", "copy", "buckets", "columns"], default="csv", help="Write data{N}.csv files, COPY straight into the stars table, write one csv per HEALPix bucket or write columnar numpy shards")
+    parser.add_argument("--compress", choices=staging.CODECS, default="none", help="Compress the csv sink output, each shard becomes one gzip member or zstd/lz4 frame")
+    parser.add_argument("--compress-level", type=int, default=None, help="Compression level, defaults to a fast one")
+    parser.add_argument("--compress-workers", type=int, default=2, help="Threads compressing shards ahead of the csv writer")
+    parser.add_argument("--bucket-level", type=int, default=sinks.BUCKET_LEVEL, help="HEALPix level of the buckets written by the buckets sink, 2 gives 192 files and 4 gives 3072")
+    parser.add_argument("--bucket-dir", default="buckets", help="Directory for the buckets sink")
+    parser.add_argument("--columns-dir", default="columns", help="Directory for the columns sink")
+    parser.add_argument("--dsn", default=sinks.DSN, help="Postgres connection string for the copy sink")
+    parser.add_argument("--copy-connections", type=int, default=sinks.COPY_CONNECTIONS, help="Number of parallel COPY connections for the copy sink")
+    parser.add_argument("--url", default="https://cdn.gea.esac.esa.int/Gaia/gdr3/gaia_source/", help="Directory listing to fetch the shards from")
+    parser.add_argument("--download-parts", type=int, default=download.PARTS, help="Parallel byte ranges per large file")
+    parser.add_argument("--timeout", type=int, default=download.TIMEOUT[1], help="Seconds without data before a download is abandoned and retried")
+    parser.add_argument("--manifest", default="gaia_source_manifest.jsonl", help="File recording the progress of every shard")
+    parser.add_argument("--resume", action="store_true", help="Skip shards the manifest says are done and retry the rest")
+    parser.add_argument("--retries", type=int, default=manifest.RETRIES, help="Attempts per shard before giving up on it")
+    metrics.add_arguments(parser, "gaia_source_metrics.jsonl")
+    args = parser.parse_args()
+    if args.sink == "columns" and args.parser != "chunk":
+        parser.error("the columns sink needs the chunk parser")
+    if args.compress != "none" and args.sink != "csv":
+        parser.error("--compress only applies to the csv sink")
+    if not staging.available(args.compress):
+        parser.error(f"--compress {args.compress} needs the {'zstandard' if args.compress == 'zstd' else 'lz4'} package")
+    if args.filter_workers is not None and args.backend == "thread" and not args.buffer_shards:
+        parser.error("--filter-workers needs --backend process or --buffer-shards, streamed shards are filtered on the download threads")
+    if args.filter_workers is None:
+        args.filter_workers = os.cpu_count()
 
-        for line in file:
-            if line.startswith('#'):
-                continue
+    # Parsers block once the writer falls this far behind
+    data_queue = pipeline.BlockQueue(args.queue_blocks, args.queue_memory * 1024**2)
 
-            row = line.strip().split(',')
+    # The governor can run up to max_download_workers downloads, each over
+    # --download-parts connections
+    max_download_workers = max(args.download_workers, args.max_download_workers)
+    download.configure(parts=args.download_parts, timeout=(10, args.timeout), workers=max_download_workers)
 
-            if header_indices == {}:
-                header_indices = {name: idx for idx, name in enumerate(row)}
-                continue
+    progress = manifest.Manifest(args.manifest, resume=args.resume)
+    changed = progress.check_settings(sink=args.sink, compress=args.compress)
+    if changed is not None:
+        parser.error(f"can't resume, {changed}. Resume with the same --sink and --compress or start afresh without --resume")
 
-            total += 1
+    links = fetch_urls(args.url)
+    if args.resume:
+        pending = progress.pending(links)
+        print(f"Resuming, {len(links) - len(pending)} of {len(links)} shards already done")
+        links = pending
 
-            has_xp_sampled = 1 if row[header_indices['has_xp_sampled']] == '"True"' else 0
+    columns = gaia_filter.output_columns(args.healpix_levels)
 
-            try:
-                phot_g_mean_mag = float(row[header_indices['phot_g_mean_mag']])
-            except ValueError:
-#                print(f"phot_g_mean_mag error {row[header_indices['phot_g_mean_mag']]}")
-                continue
+    run_metrics = metrics.from_args(args, 'fetch_gaia_source', 'shards', len(links))
+    run_metrics.gauge('writer_queue_blocks', data_queue.qsize)
+    run_metrics.gauge('writer_queue_bytes', lambda: data_queue.stats()['bytes'])
+    run_metrics.start()
 
-            if phot_g_mean_mag > 20:
-                continue
+    # Compressed output goes through compression threads on the way to the writer,
+    # which then reads from its own queue
+    write_queue = data_queue
+    compress_stage = None
+    if args.compress != "none":
+        write_queue = pipeline.BlockQueue(args.queue_blocks, args.queue_memory * 1024**2)
+        compress_stage = pipeline.Stage("compress", lambda item: sinks.compress_shard(item, args.compress, args.compress_level),
+                                        data_queue, write_queue, args.compress_workers)
 
-            pmra = 0
-            if row[header_indices['pmra']] != 'null':
-                pmra = row[header_indices['pmra']]
+    print("Starting queue reader")
+    if args.sink == "copy":
+        # Connect up front so a bad connection string fails before any downloading starts
+        connections = [psycopg2.connect(args.dsn) for i in range(args.copy_connections)]
+        write_threads = [threading.Thread(target=sinks.copy_to_database, args=(data_queue, progress, conn, columns)) for conn in connections]
+    elif args.sink == "columns":
+        write_threads = [threading.Thread(target=sinks.write_columns, args=(data_queue, progress, args.columns_dir))]
+    elif args.sink == "buckets":
+        write_threads = [threading.Thread(target=sinks.write_buckets, args=(data_queue, progress, args.bucket_level, columns, args.bucket_dir))]
+    else:
+        write_threads = [threading.Thread(target=sinks.write_csv, args=(write_queue, progress, columns, args.compress, args.compress_level))]
+    write_started = time.perf_counter()
+    for write_thread in write_threads:
+        write_thread.start()
+    if compress_stage is not None:
+        compress_stage.start()
+    print("Started queue reader")
+    
+    total = len(links)
+    finished = 0
+    finished_lock = threading.Lock()
 
-            pmdec = 0
-            if row[header_indices['pmdec']] != 'null':
-                pmdec = row[header_indices['pmdec']]
+    # Three stages with a bounded queue between each: download threads put whole
+    # compressed shards on download_queue, filter threads decompress and filter them
+    # (in worker processes with the process backend) onto data_queue, and the sink
+    # threads write them out. Download and filter concurrency are set separately so
+    # both the link and the cores can be kept busy. With the thread backend the
+    # download threads filter each response as it arrives and feed data_queue
+    # themselves, unless --buffer-shards asks for the three stages
+    stream = args.backend == "thread" and not args.buffer_shards
+    process_pool = None
+    if args.backend == "process":
+        process_pool = ProcessPoolExecutor(max_workers=args.filter_workers, mp_context=multiprocessing.get_context('spawn'))
 
+    url_queue = pipeline.BlockQueue(max_blocks=len(links) + max_download_workers)
+    download_queue = pipeline.BlockQueue(args.download_queue_blocks, args.download_queue_memory * 1024**2)
+    run_metrics.gauge('download_queue_blocks', download_queue.qsize)
 
-            teff = 0
-            if row[header_indices['teff_gspphot']] != 'null':
-                teff = row[header_indices['teff_gspphot']]
+    def download_item(link):
+        data = manifest.with_retries(progress, manifest.shard_name(link), download_shard, link, args.keep_raw, retries=args.retries)
+        return (link, data), len(data)
 
-            accepted += 1
+    def shard_done(result):
+        nonlocal finished
+        (file_name, blocks, accepted, total_rows, zone), size = result
+        metrics.advance()
+        with finished_lock:
+            finished += 1
+            print(f"[{finished}/{total}] Processed {file_name}: Accepted {accepted} lines from {total_rows} (writer queue {data_queue.qsize()} blocks)")
+        return result
 
-            data_queue.put(f"{row[header_indices['ra']]},{row[header_indices['dec']]},{pmra},{pmdec},{row[header_indices['phot_g_mean_mag']]},{row[header_indices['source_id']]},{has_xp_sampled},{teff}\n")
-        
-    os.remove(file_path)
-    return (f"Processed {file_path}: Accepted {accepted} lines from {total}")
+    def stream_item(link):
+        return shard_done(manifest.with_retries(progress, manifest.shard_name(link), stream_shard, link, args.parser,
+                                                args.healpix_levels, args.sink == "columns", args.keep_raw, retries=args.retries))
 
-def write_to_file():
-    print(f"Queue reader started")
-    line_count = 0
-    file_index = 1
-    
-    # Open the first file and write the header
-    file_handle = open(f'data{file_index}.csv', 'w', buffering=1024*2048)
-    file_handle.write(f'ra,dec,pmra,pmdec,phot_g_mean_mag,source_id,has_xp_sampled,teff\n')
-
-    try:
-        while True:
-            data = data_queue.get()
-            if data is None:
-                break  # Stop processing when None is encountered
-            
-            file_handle.write(data)  # Write the data to the current file
-            line_count += 1  # Increment the line counter
-
-            if line_count >= 10_000_000:  # If 10 million lines are written
-                file_handle.close()  # Close the current file
-                
-                # Prepare for the next file
-                file_index += 1
-                file_handle = open(f'data{file_index}.csv', 'w', buffering=1024*2048)
-                file_handle.write(f'ra,dec,pmra,pmdec,phot_g_mean_mag,source_id,has_xp_sampled,teff\n')  # Write the header to the new file
-                line_count = 0  # Reset the line counter
-
-    finally:
-        file_handle.close()  # Ensure the last file is closed after processing is complete
+    def filter_item(item):
+        link, data = item
+        return shard_done(filter_shard(link, data, process_pool, args.parser, args.healpix_levels, args.sink == "columns"))
 
+    def download_failed(link, e):
+        # with_retries has already recorded the failure in the manifest
+        print(f"Exception occurred: {str(e)}")
 
-def main():
-    url = 'https://cdn.gea.esac.esa.int/Gaia/gdr3/gaia_source/'
-    links = fetch_urls(url)
-    
-    print("Starting queue reader")
-    write_thread = threading.Thread(target=write_to_file)
-    write_thread.start()
-    print("Started queue reader")
-    
-    total = len(links)
-    finished = 0
+    def filter_failed(item, e):
+        # A shard that fails to filter is left for --resume to download again
+        print(f"Exception occurred: {str(e)}")
+        progress.record(manifest.shard_name(item[0]), 'failed', error=str(e))
+
+    if stream:
+        download_stage = pipeline.Stage("download", stream_item, url_queue, data_queue, args.download_workers, download_failed,
+                                        max_workers=max_download_workers).start()
+        filter_stage = None
+    else:
+        download_stage = pipeline.Stage("download", download_item, url_queue, download_queue, args.download_workers, download_failed,
+                                        max_workers=max_download_workers).start()
+        filter_stage = pipeline.Stage("filter", filter_item, download_queue, data_queue, args.filter_workers, filter_failed).start()
+
+    # The number of downloads in flight follows the throughput, and is cut back when
+    # the output disk fills, memory runs short or the writer (Postgres with the copy
+    # sink) can't keep up
+    output_dir = {"buckets": args.bucket_dir, "columns": args.columns_dir}.get(args.sink, ".")
+    os.makedirs(output_dir, exist_ok=True)
+    max_rss = args.max_rss * 1024**2 if args.max_rss else governor.default_max_rss()
+    limits = [governor.disk_limit(output_dir, args.min_free_disk * 1024**3), governor.rss_limit(max_rss),
+              governor.queue_limit(data_queue, "COPY" if args.sink == "copy" else "writer")]
+    if args.sink == "copy":
+        limits.append(governor.postgres_limit(args.dsn, args.copy_connections))
+    download_governor = governor.Governor(download_stage, lambda: run_metrics.value('bytes_downloaded'), limits,
+                                          args.min_download_workers, max_download_workers, args.governor_interval, name="download").start()
+
+    for link in links:
+        url_queue.put(link)
+
+    # Each stage drains its input before the next is told to stop. If a writer dies
+    # its queue fails and every stage ahead of it stops early instead
+    download_stage.stop()
+    download_governor.stop()
+    if filter_stage is not None:
+        filter_stage.stop()
+    if process_pool is not None:
+        process_pool.shutdown()
+    if compress_stage is not None:
+        compress_stage.stop()
+    for write_thread in write_threads:
+        write_queue.put(None)
+    for write_thread in write_threads:
+        write_thread.join()
+    write_wall = time.perf_counter() - write_started
+
+    download_stage.report()
+    if filter_stage is not None:
+        download_queue.report("download queue")
+        filter_stage.report()
+    data_queue.report("writer queue" if compress_stage is None else "compress queue")
+    if compress_stage is not None:
+        compress_stage.report()
+        write_queue.report("writer queue")
+    write_idle = write_queue.stats()['get_wait'] / (write_wall * len(write_threads))
+    print(f"[write] {len(write_threads)} writers, busy {100 * (1 - write_idle):.0f}%")
+    run_metrics.stop()
 
-    with ThreadPoolExecutor(max_workers=POOL_SIZE) as executor:
-        futures = {executor.submit(download_and_process_file, link): link for link in links}
-        # Wait for all tasks to complete
-        for future in as_completed(futures):
-            try:
-                result = future.result()  # Ensure any exceptions raised are propagated
-                finished += 1
-                print(f"[{finished}/{total}] {result}")
-            except Exception as e:
-                print(f"Exception occurred: {str(e)}")
-
-    # Signal the worker to stop by putting None into the queue
-    # and wait for the worker thread to complete
-    data_queue.put(None)
-    write_thread.join()
+    failed = progress.entries('failed')
+    if failed:
+        print(f"{len(failed)} shards failed, run again with --resume to retry them")
+    write_error = write_queue.failed()
+    if write_error is not None:
+        print(f"Writer failed: {write_error}, run again with --resume to carry on")
+    progress.close()
+    if write_error is not None:
+        raise SystemExit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,195 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import columnar
+import gaia_filter
+import staging
+import zonemap
+
+#
+# Python replacement for find-127-astrometry.pl and find-127-photometry.pl. Rather than
+# an INSERT ... SELECT ... ORDER BY phot_g_mean_mag LIMIT 127 for every level 8 pixel,
+# 786,432 queries per table, it reads the staging output of fetch_gaia_source.py (csv
+# files, buckets or columnar shards) once and keeps the 127 brightest stars of every
+# pixel and the 127 brightest with XP spectra side by side. The selections are
+# written as csv files ready for COPY:
+#
+#   COPY astrometry (source_id, healpix8) FROM '/path/to/astrometry.csv' CSV HEADER;
+#   COPY photometry (source_id, healpix8, healpix2) FROM '/path/to/photometry.csv' CSV HEADER;
+#
+# The sky is cut into --ranges pixel ranges which --workers processes select one at a
+# time. Where a staging directory has zone maps a range only reads the byte ranges of
+# the input shards that can hold its rows (see zonemap.pieces), and as every input
+# shard covers a narrow pixel range each is read about once for the whole sky
+#
+
+TOP = 127
+HEALPIX8_PIXELS = 12 * 4 ** 8
+CHUNK_ROWS = 1_000_000
+REDUCE_ROWS = 4_000_000
+SELECTIONS = ['astrometry', 'photometry']
+
+def top_k(pixel, mag, source_id, k=TOP):
+    # Indices of the k brightest rows of every pixel, ordered by pixel and then
+    # magnitude. Ties go to the lower source_id and a missing magnitude sorts last,
+    # like NULLS LAST in Postgres
+    if len(pixel) == 0:
+        return np.empty(0, dtype=np.int64)
+    order = np.lexsort((source_id, mag, pixel))
+    pixel = pixel[order]
+    first = np.flatnonzero(np.r_[True, pixel[1:] != pixel[:-1]])
+    rank = np.arange(len(order)) - np.repeat(first, np.diff(np.r_[first, len(order)]))
+    return order[rank < k]
+
+class Selection:
+    # Running top k per pixel of one pixel range for both selections. Rows are added a
+    # chunk at a time and cut back to the k brightest of each pixel whenever another
+    # REDUCE_ROWS have piled up, so memory stays near k rows per pixel however much
+    # is read
+    def __init__(self, first, last, k=TOP):
+        self.first = first
+        self.last = last
+        self.k = k
+        self.parts = {name: [] for name in SELECTIONS}
+        self.rows = {name: 0 for name in SELECTIONS}
+        self.reduced = {name: 0 for name in SELECTIONS}
+
+    def add(self, source_id, mag, xp):
+        pixel = gaia_filter.healpix(source_id)
+        keep = (pixel >= self.first) & (pixel <= self.last)
+        self.append('astrometry', pixel[keep], mag[keep], source_id[keep])
+        keep &= xp
+        self.append('photometry', pixel[keep], mag[keep], source_id[keep])
+
+    def append(self, name, pixel, mag, source_id):
+        if len(pixel) == 0:
+            return
+        self.parts[name].append((pixel, mag, source_id))
+        self.rows[name] += len(pixel)
+        if self.rows[name] - self.reduced[name] > REDUCE_ROWS:
+            self.reduce(name)
+
+    def reduce(self, name):
+        parts = self.parts[name]
+        if not parts:
+            pixel, mag, source_id = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64))
+        else:
+            pixel, mag, source_id = (np.concatenate(column) for column in zip(*parts))
+        keep = top_k(pixel, mag, source_id, self.k)
+        self.parts[name] = [(pixel[keep], mag[keep], source_id[keep])]
+        self.rows[name] = self.reduced[name] = len(keep)
+
+    def result(self, name):
+        # (healpix8, source_id) of the selection, ordered by pixel then magnitude
+        self.reduce(name)
+        pixel, mag, source_id = self.parts[name][0]
+        return pixel, source_id
+
+def read_columns(path, chunk_bytes=gaia_filter.CHUNK_BYTES):
+    # Yields (source_id, phot_g_mean_mag, has_xp_sampled) a chunk at a time from a
+    # columnar shard or a csv staging file, plain or compressed
+    if os.path.isdir(path):
+        descriptor, columns = columnar.load_shard(path, names=['source_id', 'phot_g_mean_mag', 'has_xp_sampled'])
+        for start in range(0, descriptor['rows'], CHUNK_ROWS):
+            yield (np.asarray(columns['source_id'][start:start + CHUNK_ROWS]),
+                   np.asarray(columns['phot_g_mean_mag'][start:start + CHUNK_ROWS], dtype=np.float64),
+                   np.asarray(columns['has_xp_sampled'][start:start + CHUNK_ROWS]))
+        return
+    with staging.open_staging(path) as f:
+        for header_indices, buf in gaia_filter.read_chunks(f, chunk_bytes):
+            fields, starts, newlines = gaia_filter.output_fields(buf, ['source_id', 'phot_g_mean_mag', 'has_xp_sampled'])
+            yield (fields['source_id'].astype(np.int64), gaia_filter.to_float(fields['phot_g_mean_mag']),
+                   fields['has_xp_sampled'] == b'1')
+
+def read_piece(piece):
+    # Like read_columns for one input shard's part of a staging file, the byte range
+    # recorded in its zone map. Pieces without an offset are read whole
+    if piece['offset'] is None:
+        yield from read_columns(piece['path'])
+        return
+    with open(piece['path'], 'rb') as f:
+        f.seek(piece['offset'])
+        block = staging.decompress(f.read(piece['length']), staging.codec_for(piece['path']))
+    if block:
+        fields, starts, newlines = gaia_filter.output_fields(block, ['source_id', 'phot_g_mean_mag', 'has_xp_sampled'])
+        yield (fields['source_id'].astype(np.int64), gaia_filter.to_float(fields['phot_g_mean_mag']),
+               fields['has_xp_sampled'] == b'1')
+
+def input_pieces(paths, first, last):
+    # What to read for pixels first to last, as dicts of path, offset and length.
+    # Directories are narrowed down to the input shards whose zones overlap the range,
+    # files without a zone map and paths given directly are read whole
+    source_ids = zonemap.pixel_source_ids(first, last)
+    found = []
+    for path in paths:
+        if os.path.isdir(path) and not os.path.exists(os.path.join(path, 'descriptor.json')):
+            pieces = zonemap.pieces(path)
+            described = set(piece['path'] for piece in pieces)
+            found.extend(piece for piece in pieces if zonemap.overlaps(piece['zone'], source_ids))
+            found.extend({'path': found_path, 'offset': None, 'length': None}
+                         for found_path in zonemap.matching(path, pixels=(first, last)) if found_path not in described)
+        else:
+            found.append({'path': path, 'offset': None, 'length': None})
+    return found
+
+def select_range(paths, first, last, k=TOP):
+    # Both selections for pixels first to last inclusive, run in a worker process.
+    # Returns {name: (healpix8, source_id)}
+    selection = Selection(first, last, k)
+    for piece in input_pieces(paths, first, last):
+        for source_id, mag, xp in read_piece(piece):
+            selection.add(source_id, mag, xp)
+    return {name: selection.result(name) for name in SELECTIONS}
+
+def pixel_ranges(first, last, count):
+    # Split first to last inclusive into count contiguous ranges
+    bounds = np.linspace(first, last + 1, count + 1).astype(np.int64)
+    return [(int(low), int(high) - 1) for low, high in zip(bounds[:-1], bounds[1:]) if high > low]
+
+def format_rows(columns):
+    # csv lines for a list of integer columns
+    block = b'\n'.join(map(b','.join, zip(*(column.astype(bytes).tolist() for column in columns))))
+    return block + b'\n' if block else block
+
+def write_selection(files, selected):
+    pixel, source_id = selected['astrometry']
+    files['astrometry'].write(format_rows([source_id, pixel]))
+    pixel, source_id = selected['photometry']
+    files['photometry'].write(format_rows([source_id, pixel, gaia_filter.healpix(source_id, 2)]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Select the brightest stars of every level 8 pixel from the staging files, for the astrometry and photometry tables.")
+    parser.add_argument("paths", nargs='+', help="Staging directories (csv, buckets or columns) or individual files and columnar shards")
+    parser.add_argument("--top", type=int, default=TOP, help="Stars to keep per pixel")
+    parser.add_argument("--pixels", type=int, nargs=2, metavar=("FIRST", "LAST"), default=(0, HEALPIX8_PIXELS - 1), help="Level 8 pixel range, inclusive")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes selecting pixel ranges at once")
+    parser.add_argument("--ranges", type=int, default=256, help="Number of pixel ranges the sky is split into")
+    parser.add_argument("--output-dir", default=".", help="Directory for astrometry.csv and photometry.csv")
+    args = parser.parse_args()
+
+    ranges = pixel_ranges(args.pixels[0], args.pixels[1], args.ranges)
+    os.makedirs(args.output_dir, exist_ok=True)
+    names = {'astrometry': 'source_id,healpix8', 'photometry': 'source_id,healpix8,healpix2'}
+    files = {name: open(os.path.join(args.output_dir, f'{name}.csv'), 'wb', buffering=1024*2048) for name in SELECTIONS}
+    start = time.perf_counter()
+    try:
+        for name, header in names.items():
+            files[name].write(f'{header}\n'.encode('utf-8'))
+        # Ranges come back in order so the files are sorted by pixel
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = pool.map(select_range, [args.paths] * len(ranges), [first for first, last in ranges],
+                               [last for first, last in ranges], [args.top] * len(ranges))
+            for i, ((first, last), selected) in enumerate(zip(ranges, results)):
+                write_selection(files, selected)
+                print(f"[{i + 1}/{len(ranges)}] Pixels {first}-{last}: {len(selected['astrometry'][0])} astrometry, "
+                      f"{len(selected['photometry'][0])} photometry stars ({time.perf_counter() - start:.0f}s)")
+    finally:
+        for f in files.values():
+            f.close()
+    print("Done")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import random
+import threading
+import time
+import psycopg2
+import metrics
+import pipeline
+import sinks
+
+#
+# Set-based replacement for find-127-astrometry.pl and find-127-photometry.pl for when
+# Postgres holds the stars, see find_brightest.py for working from the staging files
+# instead. Rather than one INSERT ... SELECT ... LIMIT 127 per level 8 pixel, each
+# statement fills a whole range of pixels, either with a LATERAL join of a
+# generate_series of pixels against the (healpix8, phot_g_mean_mag) index or with
+# ROW_NUMBER() OVER (PARTITION BY healpix8 ...). --connections workers each take
+# ranges off a queue, so disjoint ranges are selected side by side
+#
+# astrometry and photometry are switched to UNLOGGED for the load and back to LOGGED
+# at the end, which writes each table to the WAL once rather than row by row.
+# --verify N then runs the original per pixel query for N random pixels and checks the
+# tables hold the same stars
+#
+
+TOP = 127
+HEALPIX8_PIXELS = 12 * 4 ** 8
+RANGE_PIXELS = 4096
+TABLES = ['astrometry', 'photometry']
+METHODS = ['lateral', 'window']
+
+# Stars of each table and the columns it takes, as the perl scripts select them. Ties
+# on magnitude are broken by source_id so the output doesn't depend on the plan
+WHERE = {'astrometry': "true", 'photometry': "has_xp_sampled is true"}
+COLUMNS = {'astrometry': "source_id, healpix8", 'photometry': "source_id, healpix8, healpix2"}
+SELECT = {'astrometry': "source_id, healpix8", 'photometry': "source_id, healpix8, FLOOR(source_id / 36028797018963968) AS healpix2"}
+
+LATERAL = """
+INSERT INTO {table} ({columns})
+SELECT s.*
+FROM generate_series(%(first)s, %(last)s) AS p(healpix8)
+CROSS JOIN LATERAL (
+    SELECT {select}
+    FROM stars
+    WHERE stars.healpix8 = p.healpix8 AND {where}
+    ORDER BY phot_g_mean_mag, source_id
+    LIMIT %(top)s
+) s;
+"""
+
+WINDOW = """
+INSERT INTO {table} ({columns})
+SELECT {columns}
+FROM (
+    SELECT {select}, ROW_NUMBER() OVER (PARTITION BY healpix8 ORDER BY phot_g_mean_mag, source_id) AS rank
+    FROM stars
+    WHERE healpix8 BETWEEN %(first)s AND %(last)s AND {where}
+) ranked
+WHERE rank <= %(top)s;
+"""
+
+# The original per pixel query and what was loaded for the same pixel, for --verify
+ORIGINAL = "SELECT source_id, phot_g_mean_mag FROM stars WHERE {where} AND healpix8 = %s ORDER BY phot_g_mean_mag LIMIT %s"
+SELECTED = "SELECT t.source_id, s.phot_g_mean_mag FROM {table} t JOIN stars s USING (source_id) WHERE t.healpix8 = %s"
+
+def range_query(table, method='lateral'):
+    template = LATERAL if method == 'lateral' else WINDOW
+    return template.format(table=table, columns=COLUMNS[table], select=SELECT[table], where=WHERE[table])
+
+def pixel_ranges(first, last, size=RANGE_PIXELS):
+    return [(low, min(low + size, last + 1) - 1) for low in range(first, last + 1, size)]
+
+def select_range(conn, first, last, top=TOP, method='lateral'):
+    # Fill both tables for pixels first to last inclusive in one transaction. Returns
+    # {table: rows inserted}
+    rows = {}
+    try:
+        with conn.cursor() as cursor:
+            for table in TABLES:
+                cursor.execute(range_query(table, method), {'first': first, 'last': last, 'top': top})
+                rows[table] = cursor.rowcount
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    return rows
+
+def set_logged(conn, logged):
+    with conn.cursor() as cursor:
+        for table in TABLES:
+            cursor.execute(f"ALTER TABLE {table} SET {'LOGGED' if logged else 'UNLOGGED'}")
+    conn.commit()
+
+def same_selection(expected, selected):
+    # Whether two top k lists of (source_id, magnitude) pick the same stars. LIMIT
+    # cuts ties on the last magnitude arbitrarily, so stars on that magnitude only
+    # need to agree in number
+    if len(expected) != len(selected):
+        return False
+    def key(row):
+        return float('inf') if row[1] is None else row[1]
+    expected = sorted(expected, key=key)
+    selected = sorted(selected, key=key)
+    if [key(row) for row in expected] != [key(row) for row in selected]:
+        return False
+    if not expected:
+        return True
+    boundary = key(expected[-1])
+    return (set(row[0] for row in expected if key(row) < boundary) ==
+            set(row[0] for row in selected if key(row) < boundary))
+
+def verify(conn, pixels, top=TOP):
+    # (table, pixel) of every pixel whose selection differs from the original query
+    mismatches = []
+    with conn.cursor() as cursor:
+        for pixel in pixels:
+            for table in TABLES:
+                cursor.execute(ORIGINAL.format(where=WHERE[table]), (pixel, top))
+                expected = cursor.fetchall()
+                cursor.execute(SELECTED.format(table=table), (pixel,))
+                if not same_selection(expected, cursor.fetchall()):
+                    mismatches.append((table, pixel))
+    conn.rollback()
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the astrometry and photometry tables with the brightest stars of every level 8 pixel, a range of pixels per statement.")
+    parser.add_argument("--dsn", default=sinks.DSN, help="Postgres connection string")
+    parser.add_argument("--connections", type=int, default=4, help="Ranges selected at once, each on its own connection")
+    parser.add_argument("--method", choices=METHODS, default="lateral", help="LATERAL join over a series of pixels, or ROW_NUMBER() over each range")
+    parser.add_argument("--top", type=int, default=TOP, help="Stars to keep per pixel")
+    parser.add_argument("--pixels", type=int, nargs=2, metavar=("FIRST", "LAST"), default=(0, HEALPIX8_PIXELS - 1), help="Level 8 pixel range, inclusive")
+    parser.add_argument("--range-pixels", type=int, default=RANGE_PIXELS, help="Pixels per statement")
+    parser.add_argument("--truncate", action="store_true", help="Empty both tables first")
+    parser.add_argument("--keep-unlogged", action="store_true", help="Leave the tables UNLOGGED afterwards, they are emptied if Postgres crashes")
+    parser.add_argument("--verify", type=int, default=None, metavar="N", help="Compare N random pixels with the original per pixel query afterwards, 0 for every pixel")
+    metrics.add_arguments(parser, "find_brightest_metrics.jsonl")
+    args = parser.parse_args()
+
+    ranges = pixel_ranges(args.pixels[0], args.pixels[1], args.range_pixels)
+    run_metrics = metrics.from_args(args, 'find_brightest', 'pixels', args.pixels[1] - args.pixels[0] + 1).start()
+
+    conn = psycopg2.connect(args.dsn)
+    if args.truncate:
+        with conn.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {', '.join(TABLES)}")
+        conn.commit()
+    set_logged(conn, False)
+
+    # One connection per worker thread, made the first time it takes a range
+    local = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+    timings = []
+    finished = 0
+
+    def worker_connection():
+        if getattr(local, 'conn', None) is None:
+            local.conn = psycopg2.connect(args.dsn)
+            with connections_lock:
+                connections.append(local.conn)
+        return local.conn
+
+    def select_item(pixels):
+        nonlocal finished
+        first, last = pixels
+        start = time.perf_counter()
+        with metrics.stage('query'):
+            rows = select_range(worker_connection(), first, last, args.top, args.method)
+        elapsed = time.perf_counter() - start
+        metrics.count('records', sum(rows.values()))
+        metrics.advance(last - first + 1)
+        with connections_lock:
+            timings.append((elapsed, first, last))
+            finished += 1
+            print(f"[{finished}/{len(ranges)}] Pixels {first}-{last}: {rows['astrometry']} astrometry, "
+                  f"{rows['photometry']} photometry rows in {elapsed:.1f}s")
+
+    def select_failed(pixels, e):
+        print(f"Pixels {pixels[0]}-{pixels[1]} failed: {str(e)}")
+
+    range_queue = pipeline.BlockQueue(max_blocks=len(ranges) + args.connections)
+    stage = pipeline.Stage("select", select_item, range_queue, workers=args.connections, on_error=select_failed).start()
+    for pixels in ranges:
+        range_queue.put(pixels)
+    stage.stop()
+    stage.report()
+    for worker_conn in connections:
+        worker_conn.close()
+
+    # Per range timings, the slowest ranges are the dense ones along the galactic plane
+    if timings:
+        timings.sort(reverse=True)
+        average = sum(elapsed for elapsed, first, last in timings) / len(timings)
+        print(f"Ranges took {average:.1f}s on average, slowest: " +
+              ', '.join(f"{first}-{last} {elapsed:.1f}s" for elapsed, first, last in timings[:5]))
+
+    if not args.keep_unlogged:
+        print("Switching astrometry and photometry back to LOGGED")
+        with metrics.stage('set_logged'):
+            set_logged(conn, True)
+
+    if args.verify is not None:
+        pixels = list(range(args.pixels[0], args.pixels[1] + 1))
+        if args.verify:
+            pixels = sorted(random.sample(pixels, min(args.verify, len(pixels))))
+        with metrics.stage('verify'):
+            mismatches = verify(conn, pixels, args.top)
+        if mismatches:
+            print(f"{len(mismatches)} of {len(pixels) * len(TABLES)} pixel selections differ from the per pixel query, e.g. {mismatches[:10]}")
+        else:
+            print(f"All {len(pixels)} checked pixels match the per pixel query")
+    conn.close()
+    run_metrics.stop()
+
+    if stage.stats()['errors'] or (args.verify is not None and mismatches):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
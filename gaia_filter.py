@@ -0,0 +1,382 @@
+import codecs
+import gzip
+import io
+import operator
+import re
+import numpy as np
+
+#
+# Filtering of GAIA source csv rows shared by fetch_gaia_source.py and process_one_gaia.py.
+# Rows brighter than mag 20 are kept and written out in the column order expected by
+#
+# COPY stars (ra, dec, pmra, pmdec, phot_g_mean_mag, source_id, has_xp_sampled, teff, healpix8) FROM ...
+#
+# The HEALPix columns are worked out from the source_id while filtering, so the stars
+# table is complete as soon as it is loaded
+#
+# Output is produced in blocks of encoded csv lines so that it can be handed between
+# threads or processes without paying for one queue operation per star
+#
+
+OUTPUT_COLUMNS = ['ra', 'dec', 'pmra', 'pmdec', 'phot_g_mean_mag', 'source_id', 'has_xp_sampled', 'teff']
+HEALPIX_LEVELS = [8]
+BLOCK_ROWS = 100_000
+CHUNK_BYTES = 16 * 1024 * 1024
+MAX_MAG = 20
+
+# Source columns we keep, in output order. Everything else in the ~150 column rows is skipped
+PROJECTED_COLUMNS = ['ra', 'dec', 'pmra', 'pmdec', 'phot_g_mean_mag', 'source_id', 'has_xp_sampled', 'teff_gspphot']
+NULLABLE_COLUMNS = ['pmra', 'pmdec', 'teff_gspphot']
+
+# Source ids carry their level 12 HEALPix index in the top bits, shifting by a further
+# 8 bits gives level 8, the level the GAIA files and our catalogues are split by
+HEALPIX8_DIVISOR = 2**43
+
+def healpix_shift(level):
+    # source_id // 2**35 is the level 12 pixel, each level below that drops 2 bits
+    return 35 + 2 * (12 - level)
+
+def healpix(source_id, level=8):
+    # Works for a single source_id or a numpy array of them
+    return source_id >> healpix_shift(level)
+
+def output_columns(healpix_levels=()):
+    return OUTPUT_COLUMNS + [f'healpix{level}' for level in healpix_levels]
+
+def csv_header(healpix_levels=()):
+    return (','.join(output_columns(healpix_levels)) + '\n').encode('utf-8')
+
+def filter_blocks(file, block_rows=BLOCK_ROWS, healpix_levels=()):
+    # Yields (block, accepted, total) for every block_rows accepted lines, plus a final
+    # partial block. Summing accepted and total over all blocks gives the shard counts
+    total = 0
+    accepted = 0
+    lines = []
+
+    header_indices = {}
+
+    for line in file:
+        if line.startswith('#'):
+            continue
+
+        row = line.strip().split(',')
+
+        if header_indices == {}:
+            header_indices = {name: idx for idx, name in enumerate(row)}
+            continue
+
+        total += 1
+
+        has_xp_sampled = 1 if row[header_indices['has_xp_sampled']] == '"True"' else 0
+
+        try:
+            phot_g_mean_mag = float(row[header_indices['phot_g_mean_mag']])
+        except ValueError:
+            continue
+
+        if phot_g_mean_mag > MAX_MAG:
+            continue
+
+        pmra = 0
+        if row[header_indices['pmra']] != 'null':
+            pmra = row[header_indices['pmra']]
+
+        pmdec = 0
+        if row[header_indices['pmdec']] != 'null':
+            pmdec = row[header_indices['pmdec']]
+
+        teff = 0
+        if row[header_indices['teff_gspphot']] != 'null':
+            teff = row[header_indices['teff_gspphot']]
+
+        accepted += 1
+
+        healpix_ids = ''.join(f",{healpix(int(row[header_indices['source_id']]), level)}" for level in healpix_levels)
+
+        lines.append(f"{row[header_indices['ra']]},{row[header_indices['dec']]},{pmra},{pmdec},{row[header_indices['phot_g_mean_mag']]},{row[header_indices['source_id']]},{has_xp_sampled},{teff}{healpix_ids}\n")
+
+        if accepted == block_rows:
+            yield ''.join(lines).encode('utf-8'), accepted, total
+            lines = []
+            accepted = 0
+            total = 0
+
+    if accepted or total:
+        yield ''.join(lines).encode('utf-8'), accepted, total
+
+def filter_lines(file, healpix_levels=()):
+    # The per-line filter working from a binary stream like the chunk parser does
+    return filter_blocks(codecs.iterdecode(file, 'utf-8'), healpix_levels=healpix_levels)
+
+def read_header(file):
+    # Skip the leading comment block and return the column indices from the header line
+    for line in file:
+        if line.startswith(b'#'):
+            continue
+        return {name: idx for idx, name in enumerate(line.decode('utf-8').strip().split(','))}
+    return {}
+
+def to_float(text, dtype=np.float64):
+    # Vectorized float conversion of a text column, 'null' becomes NaN. Falls back
+    # to per-value parsing only if the column holds something numpy can't convert
+    text = np.where(text == b'null', b'nan', text)
+    try:
+        return text.astype(dtype)
+    except ValueError:
+        values = np.empty(len(text), dtype=dtype)
+        for i, value in enumerate(text.tolist()):
+            try:
+                values[i] = float(value)
+            except ValueError:
+                values[i] = np.nan
+        return values
+
+def extract_field(data, start, end):
+    # Gather the bytes between start and end for every line into a fixed width
+    # bytes array, e.g. dtype 'S18' for source_id. Each line's field is one row of a
+    # sliding window over data, so a single fancy index copies them all out, and the
+    # bytes past the end of the shorter fields are then zeroed
+    lengths = end - start
+    width = max(int(lengths.max()), 1)
+    if int(start.max()) + width > len(data):
+        data = np.concatenate((data, np.zeros(width, dtype=np.uint8)))
+    field = np.lib.stride_tricks.sliding_window_view(data, width)[start]
+    field *= np.arange(width) < lengths[:, None]
+    return field.view(f'S{width}').ravel()
+
+def split_fields(buf, header_indices):
+    # Locate every delimiter in the buffer at once. Valid GAIA rows all have the same
+    # number of commas so the positions reshape into a (rows, columns - 1) matrix and
+    # each projected column is a slice of it. Returns None if the buffer doesn't fit
+    # that shape, e.g. a quoted field holding a comma
+    data = np.frombuffer(buf, dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord('\n'))
+    commas = np.flatnonzero(data == ord(','))
+    num_lines = len(newlines)
+    separators = len(header_indices) - 1
+    if len(commas) != num_lines * separators:
+        return None
+
+    starts = np.empty(num_lines, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = newlines[:-1] + 1
+    ends = newlines - (data[np.maximum(newlines - 1, 0)] == ord('\r'))
+    commas = commas.reshape(num_lines, separators)
+    if (commas[:, 0] < starts).any() or (commas[:, -1] > newlines).any():
+        return None
+
+    columns = {}
+    for name in PROJECTED_COLUMNS:
+        idx = header_indices[name]
+        start = starts if idx == 0 else commas[:, idx - 1] + 1
+        end = ends if idx == separators else commas[:, idx]
+        columns[name] = extract_field(data, start, end)
+    return columns
+
+def split_lines(buf, header_indices):
+    # Fallback for buffers the vectorized split can't handle, splits each line but
+    # stops once the last column we need has been reached
+    indices = [header_indices[name] for name in PROJECTED_COLUMNS]
+    last = max(indices)
+    getter = operator.itemgetter(*indices)
+    fields = [getter(line.rstrip(b'\r').split(b',', last + 1)) for line in buf.split(b'\n') if line]
+    if not fields:
+        return {name: np.array([], dtype=bytes) for name in PROJECTED_COLUMNS}
+    return {name: np.array(values, dtype=bytes) for name, values in zip(PROJECTED_COLUMNS, zip(*fields))}
+
+def parse_chunk(buf, header_indices, healpix_levels=()):
+    # Extract only the projected columns from a buffer of complete lines into bytes
+    # arrays and apply the magnitude cut and null substitution as vector operations.
+    # Returns the accepted rows as a dict of arrays keyed by column name, with a
+    # healpix{level} column for each level asked for, the magnitudes of the accepted
+    # rows as floats and the number of rows read
+    columns = split_fields(buf, header_indices)
+    if columns is None:
+        columns = split_lines(buf, header_indices)
+    total = len(columns['source_id'])
+
+    mag = to_float(columns['phot_g_mean_mag'])
+    keep = mag <= MAX_MAG
+
+    columns = {name: values[keep] for name, values in columns.items()}
+    for name in NULLABLE_COLUMNS:
+        columns[name] = np.where(columns[name] == b'null', b'0', columns[name])
+    columns['has_xp_sampled'] = np.where(columns['has_xp_sampled'] == b'"True"', b'1', b'0')
+
+    if healpix_levels:
+        source_id = columns['source_id'].astype(np.int64)
+        for level in healpix_levels:
+            columns[f'healpix{level}'] = healpix(source_id, level).astype(bytes)
+
+    return columns, mag[keep], total
+
+def numeric_columns(columns):
+    # Typed view of a parsed chunk for consumers that don't want csv text
+    numeric = {
+        'ra': columns['ra'].astype(np.float64),
+        'dec': columns['dec'].astype(np.float64),
+        'pmra': columns['pmra'].astype(np.float32),
+        'pmdec': columns['pmdec'].astype(np.float32),
+        'phot_g_mean_mag': columns['phot_g_mean_mag'].astype(np.float32),
+        'source_id': columns['source_id'].astype(np.int64),
+        'has_xp_sampled': columns['has_xp_sampled'] == b'1',
+        'teff': columns['teff_gspphot'].astype(np.float32),
+    }
+    for name, values in columns.items():
+        if name.startswith('healpix'):
+            numeric[name] = values.astype(np.int32)
+    return numeric
+
+def format_chunk(columns, healpix_levels=()):
+    # Emit the accepted rows of a chunk as csv in one go. The fixed width columns are
+    # laid side by side, each followed by its separator, as one rows x width byte
+    # matrix and the NUL padding of the shorter fields is dropped with a single mask,
+    # which leaves the bytes of every line in order
+    names = PROJECTED_COLUMNS + [f'healpix{level}' for level in healpix_levels]
+    rows = len(columns[names[0]])
+    if rows == 0:
+        return b''
+    comma = np.full((rows, 1), ord(','), dtype=np.uint8)
+    parts = []
+    for name in names:
+        values = np.ascontiguousarray(columns[name])
+        parts += [values.view(np.uint8).reshape(rows, values.itemsize), comma]
+    parts[-1] = np.full((rows, 1), ord('\n'), dtype=np.uint8)
+    matrix = np.concatenate(parts, axis=1)
+    return matrix[matrix != 0].tobytes()
+
+def read_chunks(file, chunk_bytes=CHUNK_BYTES):
+    # Yields (header_indices, buffer) for consecutive buffers of complete data lines.
+    # Comment lines only appear at the top of the GAIA files, ahead of the header
+    header_indices = read_header(file)
+    remainder = b''
+    while True:
+        data = file.read(chunk_bytes)
+        if not data:
+            break
+        data = remainder + data
+        cut = data.rfind(b'\n') + 1
+        remainder = data[cut:]
+        if cut:
+            yield header_indices, data[:cut]
+    if remainder.strip():
+        yield header_indices, remainder + b'\n'
+
+def filter_chunks(file, chunk_bytes=CHUNK_BYTES, healpix_levels=()):
+    # Vectorized equivalent of filter_lines, yields (block, accepted, total) per chunk
+    for header_indices, buf in read_chunks(file, chunk_bytes):
+        columns, mag, total = parse_chunk(buf, header_indices, healpix_levels)
+        yield format_chunk(columns, healpix_levels), len(mag), total
+
+def filter_columns(file, chunk_bytes=CHUNK_BYTES, healpix_levels=()):
+    # Like filter_chunks but yields the accepted rows as typed numpy columns rather
+    # than csv, for the columnar staging format
+    for header_indices, buf in read_chunks(file, chunk_bytes):
+        columns, mag, total = parse_chunk(buf, header_indices, healpix_levels)
+        yield numeric_columns(columns), len(mag), total
+
+def concat_columns(chunks):
+    # Join a list of column dicts into one dict of arrays
+    if not chunks:
+        return {}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+def shard_source_id_range(file_name):
+    # GaiaSource_000000-003111.csv.gz holds level 8 pixels 0 to 3111 inclusive,
+    # return the first and last source_id that range can contain
+    match = re.search(r'_(\d+)-(\d+)\.', file_name)
+    if match is None:
+        return None
+    first, last = int(match.group(1)), int(match.group(2))
+    return first * HEALPIX8_DIVISOR, (last + 1) * HEALPIX8_DIVISOR - 1
+
+def output_fields(block, names):
+    # Pull the named columns out of a non-empty block of output csv lines as bytes
+    # arrays, along with the start and end offset of every line. Only the fixed
+    # OUTPUT_COLUMNS ahead of the healpix ones can be asked for, none of them ever
+    # holds a comma
+    data = np.frombuffer(block, dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord('\n'))
+    starts = np.empty(len(newlines), dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = newlines[:-1] + 1
+
+    separators = np.flatnonzero(data == ord(','))
+    per_line = len(separators) // len(newlines)
+    separators = separators.reshape(len(newlines), per_line)
+    fields = {}
+    for name in names:
+        column = OUTPUT_COLUMNS.index(name)
+        start = starts if column == 0 else separators[:, column - 1] + 1
+        fields[name] = extract_field(data, start, separators[:, column])
+    return fields, starts, newlines
+
+def split_by_healpix(block, level):
+    # Partition a block of output csv lines by the HEALPix pixel of their source_id at
+    # the given level. Returns a list of (pixel, block, rows). Lines from one shard
+    # arrive in source_id order so each pixel is normally one contiguous slice
+    if not block:
+        return []
+    fields, starts, newlines = output_fields(block, ['source_id'])
+    pixels = healpix(fields['source_id'].astype(np.int64), level)
+
+    if (np.diff(pixels) >= 0).all():
+        order = None
+    else:
+        order = np.argsort(pixels, kind='stable')
+        pixels = pixels[order]
+
+    buckets = []
+    bounds = np.flatnonzero(np.diff(pixels)) + 1
+    for first, last in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(pixels)]))):
+        if order is None:
+            part = block[starts[first]:newlines[last - 1] + 1]
+        else:
+            part = b''.join(block[starts[i]:newlines[i] + 1] for i in order[first:last])
+        buckets.append((int(pixels[first]), part, int(last - first)))
+    return buckets
+
+PARSERS = {
+    'line': filter_lines,
+    'chunk': filter_chunks,
+}
+
+def filter_gz_stream(stream, parser='chunk', healpix_levels=()):
+    # Decompress and filter a shard read from a file object, an HTTP response body
+    # for instance, a chunk at a time. Returns the filtered csv as a single block
+    # along with the counts
+    blocks = []
+    accepted = 0
+    total = 0
+    with gzip.open(stream, mode='rb') as file:
+        for block, block_accepted, block_total in PARSERS[parser](file, healpix_levels=healpix_levels):
+            blocks.append(block)
+            accepted += block_accepted
+            total += block_total
+    return b''.join(blocks), accepted, total
+
+def filter_gz_bytes(data, parser='chunk', healpix_levels=()):
+    # Worker entry point for the process pool backend, for a complete compressed shard
+    return filter_gz_stream(io.BytesIO(data), parser, healpix_levels)
+
+def filter_gz_path(path, parser='chunk', healpix_levels=()):
+    # Process pool entry point for a shard on local disk, the worker reads the file
+    # itself so the shard is never pickled across
+    with open(path, 'rb') as f:
+        return filter_gz_stream(f, parser, healpix_levels)
+
+def filter_gz_column_stream(stream, healpix_levels=()):
+    # filter_gz_stream for the columnar staging format
+    chunks = []
+    accepted = 0
+    total = 0
+    with gzip.open(stream, mode='rb') as file:
+        for columns, chunk_accepted, chunk_total in filter_columns(file, healpix_levels=healpix_levels):
+            chunks.append(columns)
+            accepted += chunk_accepted
+            total += chunk_total
+    return concat_columns(chunks), accepted, total
+
+def filter_gz_columns(data, healpix_levels=()):
+    # Process pool entry point for the columnar staging format
+    return filter_gz_column_stream(io.BytesIO(data), healpix_levels)
@@ -3,6 +3,8 @@ import logging
 import struct
 import numpy as np
 import math
+import argparse
+import metrics
 
 # Define your database connection parameters
 db_params = {
@@ -66,11 +68,14 @@ def writeIndexRecords(file, conn):
         i = 0
         index_records = 0
         while i <= MAXHEALPIX:
-            cursor.execute(indexquery, (i, ))
-            record = cursor.fetchone()
+            with metrics.stage('index_query'):
+                cursor.execute(indexquery, (i, ))
+                record = cursor.fetchone()
             if record is not None:
                 index_records += record[0]
-            file.write(struct.pack('I', int(index_records)))
+            with metrics.stage('write'):
+                file.write(struct.pack('I', int(index_records)))
+            metrics.advance()
             i += 1
             if i % 1000 == 0:
                 print(f"Index {i}")
@@ -82,18 +87,24 @@ def writeDataRecords(file, conn):
     with conn.cursor() as cursor:
         i = 0
         while i <= MAXHEALPIX:
-            cursor.execute(dataquery, (i,))
+            with metrics.stage('query'):
+                cursor.execute(dataquery, (i,))
             numrecords = 0
             if i % 1000 == 0:
                 print(f"Processing healpix {i}")
-            while True:
-                record = cursor.fetchone()
-                if record is None:
-                    break
-
-                # Write our data
-                writeDataElement(file, record)
-                numrecords += 1
+            # Timed per pixel rather than per record, the writes are buffered so
+            # this is mostly struct packing
+            with metrics.stage('pack'):
+                while True:
+                    record = cursor.fetchone()
+                    if record is None:
+                        break
+
+                    # Write our data
+                    writeDataElement(file, record)
+                    numrecords += 1
+            metrics.count('records', numrecords)
+            metrics.advance()
             i += 1
 
 def writeDataRecordsNew(file, conn):
@@ -183,6 +194,13 @@ def writeDataElement(file, record):
     #logging.debug(f"Wrote {end - start} bytes")
 
 def main():
+    parser = argparse.ArgumentParser(description="Write the Siril astrometric catalogue from the astrometry table.")
+    metrics.add_arguments(parser, "generate_astrometry_metrics.jsonl")
+    args = parser.parse_args()
+
+    # One unit per pixel for the index pass and again for the data pass
+    run_metrics = metrics.from_args(args, 'generate_astrometry', 'pixels', 2 * (MAXHEALPIX + 1)).start()
+
     logging.info("Exporter started")
     with psycopg2.connect(**db_params) as conn:
         conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE)
@@ -197,6 +215,7 @@ def main():
             logging.debug("-----------")
 
         logging.info(f"Finished {total_records}")
+    run_metrics.stop()
         
 if __name__ == "__main__":
     main()
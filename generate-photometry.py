@@ -3,6 +3,9 @@ import logging
 import struct
 import numpy as np
 import math
+import argparse
+import metrics
+import spectra_store
 
 # Define your database connection parameters
 db_params = {
@@ -18,18 +21,25 @@ db_params = {
 
 MAXCHUNKPIXEL = 191 # level 2
 MAXHEALPIX = 786431 # level 8
+PIXELS_PER_CHUNK = 4 ** (8 - 2)
 INT32_MAX = 2**31 -1
 RADEC_SCALE = INT32_MAX / 360.0
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# SQL queries
-dataquery = """
-SELECT s.source_id as source_id, s.ra as ra, s.dec as dec, s.pmra as pmra, s.pmdec as pmdec, s.phot_g_mean_mag as phot_g_mean_mag, s.flux
+# SQL queries. flux is s.flux, s.flux16 for spectra loaded with fetch_spectra.py
+# --flux-format float16, or NULL when the spectra come from a spectra store
+DATAQUERY = """
+SELECT s.source_id as source_id, s.ra as ra, s.dec as dec, s.pmra as pmra, s.pmdec as pmdec, s.phot_g_mean_mag as phot_g_mean_mag, {flux}
 FROM stars s, photometry r
 where s.source_id = r.source_id AND r.healpix8 = %s AND r.healpix2 = %s
 ORDER BY s.source_id;
 """
+dataquery = DATAQUERY.format(flux='s.flux')
+
+# spectra_store.SpectraStore to take the flux from instead of the stars table, set
+# up in main() with --spectra-store
+spectra = None
 #where s.source_id = r.source_id AND r.healpix8 between %s and %s
 
 #indexquery = """
@@ -41,6 +51,12 @@ ORDER BY s.source_id;
 indexquery = """
 select count(healpix8) from photometry where healpix8 = %s and healpix2 = %s
 """
+
+# With a spectra store the index only counts the stars it has a spectrum for, the
+# others are left out of the data records too
+indexidsquery = """
+select source_id from photometry where healpix8 = %s and healpix2 = %s
+"""
 #select healpix8, count(healpix8) from results8 group by healpix8 order by healpix8
 
 
@@ -83,11 +99,18 @@ def writeIndexRecords(file, conn, first_healpix, last_healpix, chunk_healpix):
         i = first_healpix
         index_records = 0
         while i <= last_healpix:
-            cursor.execute(indexquery, (i, chunk_healpix ))
-            record = cursor.fetchone()
+            with metrics.stage('index_query'):
+                if spectra is not None:
+                    cursor.execute(indexidsquery, (i, chunk_healpix))
+                    record = (int((spectra.lookup([row[0] for row in cursor.fetchall()]) >= 0).sum()),)
+                else:
+                    cursor.execute(indexquery, (i, chunk_healpix ))
+                    record = cursor.fetchone()
             if record is not None:
                 index_records += record[0]
-            file.write(struct.pack('I', int(index_records)))
+            with metrics.stage('write'):
+                file.write(struct.pack('I', int(index_records)))
+            metrics.advance()
             if i % 1000 == 0:
                 print(f"Index {i} for chunk {chunk_healpix} is {index_records}")
             i += 1
@@ -107,18 +130,39 @@ def writeDataRecords(file, conn, chunk_healpix):
 
         i = first_healpix
         while i <= last_healpix:
-            cursor.execute(dataquery, (i,chunk_healpix))
+            with metrics.stage('query'):
+                cursor.execute(dataquery, (i,chunk_healpix))
             numrecords = 0
             if i % 1000 == 0:
                 print(f"Processing healpix {i} for chunk {chunk_healpix}")
-            while True:
-                record = cursor.fetchone()
-                if record is None:
-                    break
-
-                # Write our data
-                writeDataElement(file, record)
-                numrecords += 1
+            # Timed per pixel rather than per record, the writes are buffered so
+            # this is mostly flux scaling and struct packing
+            with metrics.stage('pack'):
+                if spectra is not None:
+                    # The pixel's spectra in one batched lookup, already in the form
+                    # they are written in. Stars missing from the store were left out
+                    # of the index as well
+                    records = cursor.fetchall()
+                    idx = spectra.lookup([record[0] for record in records])
+                    missing = [record[0] for record, row in zip(records, idx) if row < 0]
+                    if missing:
+                        logging.warning(f"Healpix {i}: {len(missing)} of {len(records)} stars have no spectrum in the store and are left out, e.g. {missing[:5]}")
+                        metrics.count('missing_spectra', len(missing))
+                    records = [record for record, row in zip(records, idx) if row >= 0]
+                    for record, row in zip(records, spectra.flux[idx[idx >= 0]]):
+                        writeDataElement(file, record[:6] + (row.tobytes(),))
+                    numrecords = len(records)
+                else:
+                    while True:
+                        record = cursor.fetchone()
+                        if record is None:
+                            break
+
+                        # Write our data
+                        writeDataElement(file, record)
+                        numrecords += 1
+            metrics.count('records', numrecords)
+            metrics.advance()
             i += 1
         print(f"Written data records {i} for chunk {chunk_healpix}")
 
@@ -154,6 +198,11 @@ def writeDataElement(file, record):
 
     ## Prep flux data
     flux = record[6]
+    if isinstance(flux, (bytes, memoryview)):
+        # flux16 is stored exactly as it is written below, so it is copied as it is
+        file.write(flux)
+        return
+
     largest_num = max(abs(num) for num in flux)
     e = math.ceil(-math.log10(largest_num))
     file.write(struct.pack('B', e))
@@ -167,6 +216,23 @@ def writeDataElement(file, record):
     #logging.debug(f"Wrote {end - start} bytes")
 
 def main():
+    parser = argparse.ArgumentParser(description="Write the chunked Siril photometric catalogue from the photometry table.")
+    parser.add_argument("--flux-column", choices=["flux", "flux16"], default="flux", help="Read the real[] flux column, or flux16 with spectra already in catalogue form")
+    parser.add_argument("--spectra-store", default=None, help="Take the flux from the spectra store in this directory, built with fetch_spectra.py --sink store")
+    metrics.add_arguments(parser, "generate_photometry_metrics.jsonl")
+    args = parser.parse_args()
+
+    global dataquery, spectra
+    if args.spectra_store is not None:
+        spectra = spectra_store.SpectraStore(args.spectra_store)
+        logging.info(f"Opened spectra store {args.spectra_store} with {len(spectra)} spectra")
+        dataquery = DATAQUERY.format(flux='NULL')
+    else:
+        dataquery = DATAQUERY.format(flux='s.' + args.flux_column)
+
+    # One unit per pixel for the index pass and again for the data pass of every chunk
+    run_metrics = metrics.from_args(args, 'generate_photometry', 'pixels', 2 * (MAXCHUNKPIXEL + 1) * PIXELS_PER_CHUNK).start()
+
     logging.info("Exporter started")
     with psycopg2.connect(**db_params) as conn:
         conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE)
@@ -183,6 +249,7 @@ def main():
             i+=1
 
         logging.info(f"Finished {total_records}")
+    run_metrics.stop()
         
 if __name__ == "__main__":
     main()
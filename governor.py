@@ -0,0 +1,178 @@
+import os
+import shutil
+import threading
+import time
+import metrics
+
+#
+# Adaptive concurrency for the fetch scripts. Instead of a fixed pool size a governor
+# thread looks at the stage it controls every interval and resizes it within
+# [min_workers, max_workers]:
+#
+#  - while nothing is under pressure it adds a worker, and keeps adding while
+#    throughput keeps rising. When a new worker doesn't buy at least GAIN more
+#    throughput it is taken away again and the count is held for HOLD intervals
+#    before probing upwards again
+#  - when any limit is under pressure (scratch disk nearly full, RSS too high, the
+#    writer or Postgres falling behind) a quarter of the workers are shed at once
+#
+# Limits are plain functions returning a reason string when under pressure and None
+# otherwise, see the helpers below. A limit holding something open, like the Postgres
+# connection, also has a close() the governor calls when it stops
+#
+
+INTERVAL = 15
+GAIN = 0.05
+HOLD = 4
+MIN_WORKERS = 1
+MAX_WORKERS = 64
+MIN_FREE_DISK = 10 * 1024**3
+
+def rss():
+    # Resident set size of this process in bytes, None where /proc isn't available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def default_max_rss():
+    # Three quarters of physical memory
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * 3 // 4
+    except (OSError, ValueError):
+        return None
+
+def disk_limit(path, min_free=MIN_FREE_DISK):
+    def check():
+        free = shutil.disk_usage(path).free
+        if free < min_free:
+            return f"{free / 1024**3:.1f} GB free on {os.path.abspath(path)}"
+    return check
+
+def rss_limit(max_rss):
+    def check():
+        used = rss()
+        if used is not None and max_rss is not None and used > max_rss:
+            return f"RSS {used / 1024**2:.0f} MB"
+    return check
+
+def queue_limit(queue, name, fraction=0.8):
+    # The consumer of a BlockQueue, e.g. the writer or the COPY connections, is
+    # falling behind once the queue stays this full
+    def check():
+        stats = queue.stats()
+        if stats['bytes'] > fraction * queue.max_bytes or stats['depth'] >= fraction * queue.max_blocks:
+            return f"{name} {stats['depth']} blocks / {stats['bytes'] / 1024**2:.0f} MB behind"
+    return check
+
+def postgres_limit(dsn, max_waiting):
+    # Backends of the target database stuck waiting on locks or I/O, a sign that
+    # Postgres has more work than it can get through
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+
+    def check():
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT count(*) FROM pg_stat_activity
+                WHERE datname = current_database() AND state = 'active' AND wait_event_type IN ('Lock', 'LWLock', 'IO')
+            """)
+            waiting = cursor.fetchone()[0]
+        if waiting > max_waiting:
+            return f"{waiting} Postgres backends waiting"
+    check.close = conn.close
+    return check
+
+class Governor:
+    # stage is anything with resize(workers) returning the new count, e.g. a
+    # pipeline.Stage. throughput returns a running total of useful work such as bytes
+    # downloaded, the governor works from how fast it grows
+    def __init__(self, stage, throughput, limits=(), min_workers=MIN_WORKERS, max_workers=MAX_WORKERS, interval=INTERVAL, name='governor'):
+        self.stage = stage
+        self.throughput = throughput
+        self.limits = list(limits)
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.name = name
+        self.workers = stage.workers
+        self.last_total = None
+        self.last_rate = None
+        self.last_change = 0
+        self.hold = 0
+        self.history = []
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def pressure(self):
+        for check in self.limits:
+            reason = check()
+            if reason is not None:
+                return reason
+        return None
+
+    def decide(self, rate, reason):
+        # New worker count from the latest throughput and any pressure
+        workers = self.workers
+        if reason is not None:
+            self.hold = HOLD
+            return max(self.min_workers, workers - max(1, workers // 4))
+        if self.last_change > 0 and self.last_rate is not None and rate < self.last_rate * (1 + GAIN):
+            # The last worker added didn't pay for itself
+            self.hold = HOLD
+            return max(self.min_workers, workers - 1)
+        if self.hold > 0:
+            self.hold -= 1
+            return workers
+        return min(self.max_workers, workers + 1)
+
+    def step(self, elapsed):
+        total = self.throughput()
+        if self.last_total is None:
+            self.last_total = total
+            return self.workers
+        rate = (total - self.last_total) / elapsed
+        reason = self.pressure()
+        workers = self.decide(rate, reason)
+        if workers != self.workers:
+            workers = self.stage.resize(workers)
+            print(f"[{self.name}] {self.workers} -> {workers} workers at {rate / 1024**2:.1f} MB/s" + (f" ({reason})" if reason else ""))
+        # Resizes happen on interval boundaries, so the next interval runs entirely
+        # at the new count and compares directly with this one
+        self.last_change = workers - self.workers
+        self.last_rate = rate
+        self.last_total = total
+        self.workers = workers
+        self.history.append((time.time(), workers, rate, reason))
+        return workers
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.stopping.wait(self.interval):
+            now = time.perf_counter()
+            try:
+                self.step(now - last)
+            except Exception as e:
+                # A limit that can't be checked this time, e.g. a dropped connection,
+                # shouldn't stop the governor
+                print(f"[{self.name}] {e}")
+            last = now
+
+    def start(self):
+        metrics.get().gauge(f'{self.name}_workers', lambda: self.workers)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        for check in self.limits:
+            if hasattr(check, 'close'):
+                check.close()
+        if self.history:
+            counts = [workers for when, workers, rate, reason in self.history]
+            print(f"[{self.name}] workers ranged {min(counts)}-{max(counts)}, ended at {self.workers}")
@@ -0,0 +1,40 @@
+import argparse
+import psycopg2
+import sinks
+import staging
+
+#
+# Load csv staging files, plain or compressed, into the stars table with COPY ... FROM
+# STDIN. The column list comes from each file's header, so files written with or
+# without healpix columns both load
+#
+# e.g. python load_staging.py data*.csv.gz
+#
+
+def load_file(conn, path, table='stars'):
+    with staging.open_staging(path) as f:
+        columns = f.readline().decode('utf-8').strip()
+        with conn.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH CSV", f)
+            rows = cursor.rowcount
+    conn.commit()
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Load csv staging files into the stars table.")
+    parser.add_argument("paths", nargs='+', help="data{N}.csv, .csv.gz, .csv.zst or .csv.lz4 files")
+    parser.add_argument("--dsn", default=sinks.DSN, help="Postgres connection string")
+    parser.add_argument("--table", default="stars")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        for path in args.paths:
+            print(f"Loading {path}")
+            rows = load_file(conn, path, args.table)
+            print(f"Loaded {rows} rows from {path}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+import time
+
+#
+# A durable record of how far an ingest run has got. Every state change of a shard
+# is appended to a JSON-lines file and fsync'd, the last line for a shard wins.
+# With --resume the fetch scripts skip shards already marked done and retry the rest
+#
+# Settings the output depends on, such as the sink and codec, go on lines of their own
+# so a resume can't carry on files that were written another way
+#
+
+RETRIES = 5
+BACKOFF = 30
+
+class Manifest:
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.shards = {}
+        # Every status each shard has been through, in this run and resumed ones
+        self.history = {}
+        self.settings = None
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line from a crash
+                    if 'settings' in entry:
+                        self.settings = entry['settings']
+                        continue
+                    self.shards[entry['shard']] = entry
+                    self.history.setdefault(entry['shard'], set()).add(entry['status'])
+        self.file = open(path, 'a' if resume else 'w')
+        if self.file.tell() > 0:
+            self.file.write('\n')  # Make sure a torn last line can't swallow the next record
+
+    def record(self, shard, status, **fields):
+        entry = {'shard': shard, 'status': status, 'time': time.time(), **fields}
+        with self.lock:
+            self.shards[shard] = entry
+            self.history.setdefault(shard, set()).add(status)
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return entry
+
+    def check_settings(self, **settings):
+        # Record the settings of this run. Returns a message naming the ones that
+        # differ from those a resumed manifest was written with, recording nothing,
+        # or None if they match. Manifests from before settings were kept always match
+        if self.settings is not None:
+            changed = [f"{name} {self.settings[name]} (now {value})" for name, value in settings.items()
+                       if name in self.settings and self.settings[name] != value]
+            if changed:
+                return f"{self.path} was written with " + ", ".join(changed)
+        self.settings = settings
+        with self.lock:
+            self.file.write(json.dumps({'settings': settings, 'time': time.time()}) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return None
+
+    def get(self, shard):
+        with self.lock:
+            return self.shards.get(shard)
+
+    def seen(self, shard, status):
+        # Whether the shard was ever recorded with this status, not just last
+        with self.lock:
+            return status in self.history.get(shard, ())
+
+    def done(self, shard):
+        entry = self.get(shard)
+        return entry is not None and entry['status'] == 'done'
+
+    def entries(self, status=None):
+        with self.lock:
+            return [entry for entry in self.shards.values() if status is None or entry['status'] == status]
+
+    def pending(self, shards):
+        # Shards still to do, i.e. never seen, failed or interrupted part way through
+        return [shard for shard in shards if not self.done(shard_name(shard))]
+
+    def close(self):
+        self.file.close()
+
+def shard_name(url):
+    return url.split('/')[-1]
+
+def with_retries(manifest, shard, fn, *args, retries=RETRIES, backoff=BACKOFF):
+    # Run fn, recording each failure in the manifest and backing off exponentially
+    # between attempts. The last failure is re-raised
+    for attempt in range(1, retries + 1):
+        manifest.record(shard, 'started', attempt=attempt)
+        try:
+            return fn(*args)
+        except Exception as e:
+            manifest.record(shard, 'failed', attempt=attempt, error=str(e))
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            print(f"[{shard}] attempt {attempt} failed ({e}), retrying in {delay}s")
+            time.sleep(delay)
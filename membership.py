@@ -0,0 +1,86 @@
+import io
+import os
+import numpy as np
+
+#
+# In-memory set of the stars.source_id values that have XP sampled spectra, used by
+# fetch_spectra.py to drop spectra for stars we don't hold before they ever reach
+# Postgres. About 34 million ids to mag 20, kept as one sorted int64 array (~270 MB)
+# and probed with searchsorted, which releases the GIL so every worker thread can
+# filter at once against the one shared copy
+#
+
+QUERY = "SELECT source_id FROM stars WHERE has_xp_sampled"
+COPY_BYTES = 16 * 1024 * 1024
+
+class SourceIdSet:
+    def __init__(self, source_ids):
+        self.ids = np.unique(np.asarray(source_ids, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def contains(self, source_ids):
+        # Boolean mask of which of source_ids are in the set
+        source_ids = np.asarray(source_ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.zeros(len(source_ids), dtype=bool)
+        idx = np.searchsorted(self.ids, source_ids)
+        return self.ids[np.minimum(idx, len(self.ids) - 1)] == source_ids
+
+    def save(self, path):
+        np.save(path, self.ids)
+
+    @classmethod
+    def load(cls, path):
+        members = cls.__new__(cls)
+        members.ids = np.load(path)
+        return members
+
+class IdCollector(io.RawIOBase):
+    # File like target for COPY ... TO STDOUT that turns the stream of text ids into
+    # int64 arrays a chunk at a time, rather than holding the whole text in memory
+    def __init__(self):
+        self.remainder = b''
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = len(data)
+        data = self.remainder + bytes(data)
+        cut = data.rfind(b'\n') + 1
+        self.remainder = data[cut:]
+        if cut:
+            self.chunks.append(np.array(data[:cut].split()).astype(np.int64))
+        return size
+
+    def ids(self):
+        if self.remainder.strip():
+            self.chunks.append(np.array(self.remainder.split()).astype(np.int64))
+            self.remainder = b''
+        return np.concatenate(self.chunks) if self.chunks else np.array([], dtype=np.int64)
+
+def from_database(conn, query=QUERY):
+    collector = IdCollector()
+    with conn.cursor() as cursor:
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT", collector, size=COPY_BYTES)
+    return SourceIdSet(collector.ids())
+
+def build(dsn, cache=None):
+    # Load the set from cache if given and present, otherwise query it once and save
+    # it there for the next run. Delete the cache after reloading stars
+    if cache is not None and os.path.exists(cache):
+        print(f"Loading XP source ids from {cache}")
+        return SourceIdSet.load(cache)
+    import psycopg2
+    print("Loading XP source ids from the stars table")
+    conn = psycopg2.connect(dsn)
+    try:
+        members = from_database(conn)
+    finally:
+        conn.close()
+    if cache is not None:
+        members.save(cache)
+    return members
@@ -0,0 +1,260 @@
+import json
+import os
+import threading
+import time
+
+#
+# Shared instrumentation for the ingest and catalogue build scripts. Each script
+# times its stages (download, gunzip, parse, queue wait, COPY, query, packing, write),
+# counts bytes and records, and reports how many of its units of work are done so an
+# ETA can be worked out. A background thread appends a JSON-lines snapshot every
+# interval, so runs can be compared afterwards, and can also keep a Prometheus
+# textfile up to date for node_exporter's textfile collector
+#
+# Stage times are self time: a stage nested inside another on the same thread is
+# taken out of the outer one, so a download wait inside a gunzip read is counted as
+# download only. Times from worker threads are summed, so a stage can report more
+# seconds than the run has been going
+#
+
+INTERVAL = 30
+PROMETHEUS_PREFIX = 'gaia_ingest'
+
+class Stage:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.metrics.enter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.exit(self.name)
+        return False
+
+class TimedReader:
+    # Wraps a file like object, counting the time spent in read() against a stage
+    # and the bytes returned against a counter
+    def __init__(self, metrics, source, stage, counter):
+        self.metrics = metrics
+        self.source = source
+        self.stage = stage
+        self.counter = counter
+
+    def read(self, size=-1):
+        with self.metrics.stage(self.stage):
+            data = self.source.read(size)
+        self.metrics.count(self.counter, len(data))
+        return data
+
+    def readline(self, size=-1):
+        with self.metrics.stage(self.stage):
+            line = self.source.readline(size)
+        self.metrics.count(self.counter, len(line))
+        return line
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+class Metrics:
+    def __init__(self, job='ingest', unit='shards', total=None, path=None, prometheus=None, interval=INTERVAL):
+        self.job = job
+        self.unit = unit
+        self.total = total
+        self.path = path
+        self.prometheus = prometheus
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.done = 0
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.gauges = {}
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def enter(self):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append([time.perf_counter(), 0.0])
+
+    def exit(self, name):
+        start, nested = self.local.stack.pop()
+        elapsed = time.perf_counter() - start
+        if self.local.stack:
+            self.local.stack[-1][1] += elapsed
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - nested
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def value(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def gauge(self, name, fn):
+        # fn is called for the current value whenever a snapshot is taken
+        with self.lock:
+            self.gauges[name] = fn
+
+    def set_total(self, total):
+        with self.lock:
+            self.total = total
+
+    def advance(self, units=1):
+        with self.lock:
+            self.done += units
+
+    def reader(self, source, stage, counter):
+        return TimedReader(self, source, stage, counter)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            done, total = self.done, self.total
+            rate = done / elapsed if elapsed > 0 else 0.0
+            eta = None
+            if total is not None and rate > 0:
+                eta = max(0.0, (total - done) / rate)
+            snapshot = {
+                'job': self.job,
+                'time': time.time(),
+                'elapsed': round(elapsed, 3),
+                'unit': self.unit,
+                'done': done,
+                'total': total,
+                'rate': round(rate, 3),
+                'eta': None if eta is None else round(eta, 1),
+                'stages': {name: {'seconds': round(seconds, 3), 'calls': self.calls[name]} for name, seconds in self.seconds.items()},
+                'counters': dict(self.counters),
+                'rates': {name: round(value / elapsed, 3) if elapsed > 0 else 0.0 for name, value in self.counters.items()},
+            }
+            gauges = dict(self.gauges)
+        snapshot['gauges'] = {name: fn() for name, fn in gauges.items()}
+        return snapshot
+
+    def write(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+        if self.prometheus is not None:
+            write_prometheus(self.prometheus, snapshot)
+        return snapshot
+
+    def start(self):
+        # Snapshot every interval seconds until stop()
+        def run():
+            while not self.stopping.wait(self.interval):
+                print(status_line(self.write()))
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # Final snapshot and a summary of where the time went
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        snapshot = self.write()
+        report(snapshot)
+        return snapshot
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds // 60 % 60:02d}m{seconds % 60:02d}s"
+
+def status_line(snapshot):
+    total = '?' if snapshot['total'] is None else snapshot['total']
+    return (f"[{snapshot['job']}] {snapshot['done']}/{total} {snapshot['unit']}, {snapshot['rate']:.2f}/s, "
+            f"elapsed {format_duration(snapshot['elapsed'])}, ETA {format_duration(snapshot['eta'])}")
+
+def report(snapshot):
+    print(status_line(snapshot))
+    stages = sorted(snapshot['stages'].items(), key=lambda item: -item[1]['seconds'])
+    busy = sum(stage['seconds'] for name, stage in stages) or 1.0
+    for name, stage in stages:
+        print(f"  {name:<16} {stage['seconds']:>10.1f}s {100 * stage['seconds'] / busy:5.1f}% {stage['calls']:>10} calls")
+    for name, value in sorted(snapshot['counters'].items()):
+        print(f"  {name:<16} {value:>14} ({snapshot['rates'][name]:.1f}/s)")
+
+def prometheus_lines(snapshot, prefix=PROMETHEUS_PREFIX):
+    job = snapshot['job']
+    lines = [f'# TYPE {prefix}_stage_seconds_total counter']
+    lines += [f'{prefix}_stage_seconds_total{{job="{job}",stage="{name}"}} {stage["seconds"]}' for name, stage in sorted(snapshot['stages'].items())]
+    lines += [f'# TYPE {prefix}_stage_calls_total counter']
+    lines += [f'{prefix}_stage_calls_total{{job="{job}",stage="{name}"}} {stage["calls"]}' for name, stage in sorted(snapshot['stages'].items())]
+    lines += [f'# TYPE {prefix}_count_total counter']
+    lines += [f'{prefix}_count_total{{job="{job}",name="{name}"}} {value}' for name, value in sorted(snapshot['counters'].items())]
+    lines += [f'# TYPE {prefix}_gauge gauge']
+    lines += [f'{prefix}_gauge{{job="{job}",name="{name}"}} {value}' for name, value in sorted(snapshot['gauges'].items())]
+    lines += [f'# TYPE {prefix}_done gauge', f'{prefix}_done{{job="{job}"}} {snapshot["done"]}']
+    if snapshot['total'] is not None:
+        lines += [f'# TYPE {prefix}_total gauge', f'{prefix}_total{{job="{job}"}} {snapshot["total"]}']
+    if snapshot['eta'] is not None:
+        lines += [f'# TYPE {prefix}_eta_seconds gauge', f'{prefix}_eta_seconds{{job="{job}"}} {snapshot["eta"]}']
+    return lines
+
+def write_prometheus(path, snapshot):
+    # Written to a temporary file and renamed so the collector never sees half a file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(prometheus_lines(snapshot)) + '\n')
+    os.replace(tmp_path, path)
+
+# One Metrics per process, set up by the script's main() with configure(). Library
+# code records against it through the functions below, which do nothing useful
+# until then beyond keeping counts in memory
+_metrics = Metrics()
+
+def configure(**kwargs):
+    global _metrics
+    _metrics = Metrics(**kwargs)
+    return _metrics
+
+def add_arguments(parser, path):
+    # The --metrics, --prometheus and --metrics-interval options every script takes,
+    # path is the default snapshot file
+    parser.add_argument("--metrics", default=path, help="File to append periodic JSON-lines metrics snapshots to")
+    parser.add_argument("--prometheus", default=None, help="Also keep this Prometheus textfile up to date")
+    parser.add_argument("--metrics-interval", type=int, default=INTERVAL, help="Seconds between metrics snapshots")
+
+def from_args(args, job, unit, total, directory=None):
+    # configure() from the options add_arguments() added, with the snapshot file
+    # inside directory if one is given
+    path = os.path.join(directory, args.metrics) if directory is not None else args.metrics
+    return configure(job=job, unit=unit, total=total, path=path, prometheus=args.prometheus, interval=args.metrics_interval)
+
+def get():
+    return _metrics
+
+def stage(name):
+    return _metrics.stage(name)
+
+def count(name, value=1):
+    _metrics.count(name, value)
+
+def advance(units=1):
+    _metrics.advance(units)
+
+def reader(source, stage, counter):
+    return _metrics.reader(source, stage, counter)
@@ -0,0 +1,65 @@
+import numpy as np
+import gaia_filter
+import columnar
+import membership
+import staging
+import zonemap
+
+#
+# Partition-wise join of the XP spectra shards with the staged star rows written by
+# fetch_gaia_source.py, for fetch_spectra.py --join-stars. Spectra and GaiaSource
+# files are both split by level 8 HEALPix range, e.g.
+#
+#   XpSampledMeanSpectrum_000000-003111.csv.gz
+#
+# and the zone maps of the staging output record the source_id range of every input
+# shard's rows. So each spectra shard only has to be matched against the few star
+# pieces whose range overlaps its own: their has_xp_sampled source_ids are read,
+# sorted and merged with the spectra rows, rather than probing the whole stars table
+# or holding every source_id in memory. Workers each join their own partition
+#
+
+class StarShards:
+    # Index of the staged star pieces that hold stars with XP spectra
+    def __init__(self, directory):
+        self.directory = directory
+        self.pieces = sorted((piece for piece in zonemap.pieces(directory)
+                              if piece['zone'] is not None and piece['zone']['source_id'] is not None
+                              and piece['zone']['has_xp_sampled']),
+                             key=lambda piece: piece['zone']['source_id'])
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def overlapping(self, first=None, last=None):
+        return [piece for piece in self.pieces if zonemap.overlaps(piece['zone'], (first, last), xp=True)]
+
+    def source_ids(self, first=None, last=None):
+        # Sorted source_ids of the stars with XP spectra from first to last inclusive
+        parts = [read_piece(piece) for piece in self.overlapping(first, last)]
+        source_ids = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        if first is not None:
+            source_ids = source_ids[source_ids >= first]
+        if last is not None:
+            source_ids = source_ids[source_ids <= last]
+        return np.sort(source_ids)
+
+    def members(self, file_name):
+        # The stars a spectra shard can update, from its name. A file without a range
+        # in its name is matched against every piece
+        source_ids = gaia_filter.shard_source_id_range(file_name)
+        return membership.SourceIdSet(self.source_ids(*(source_ids or (None, None))))
+
+def read_piece(piece):
+    # has_xp_sampled source_ids of one piece, from a columnar shard or the byte range
+    # of a csv staging file or bucket the input shard was written to
+    if piece['offset'] is None:
+        descriptor, columns = columnar.load_shard(piece['path'], names=['source_id', 'has_xp_sampled'])
+        return np.asarray(columns['source_id'][columns['has_xp_sampled']], dtype=np.int64)
+    with open(piece['path'], 'rb') as f:
+        f.seek(piece['offset'])
+        block = staging.decompress(f.read(piece['length']), staging.codec_for(piece['path']))
+    if not block:
+        return np.empty(0, dtype=np.int64)
+    fields, starts, newlines = gaia_filter.output_fields(block, ['source_id', 'has_xp_sampled'])
+    return fields['source_id'][fields['has_xp_sampled'] == b'1'].astype(np.int64)
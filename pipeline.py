@@ -0,0 +1,264 @@
+import collections
+import threading
+import time
+
+#
+# Plumbing shared by the ingest scripts for moving blocks of rows between threads
+#
+
+QUEUE_BLOCKS = 64
+QUEUE_MEMORY = 512 * 1024 * 1024
+
+class BlockQueue:
+    # A bounded FIFO of blocks. Producers block once either max_blocks items or
+    # max_bytes of payload are waiting, which keeps memory flat when the consumer
+    # falls behind. A block bigger than max_bytes is still let through on its own
+    # so that one oversized shard can't deadlock the pipeline
+    #
+    # A consumer that dies calls fail(). Whatever is waiting is dropped, producers stop
+    # blocking and their items are thrown away, and get() returns None as if the end
+    # had been reached, so nothing upstream waits forever on a consumer that is gone
+    def __init__(self, max_blocks=QUEUE_BLOCKS, max_bytes=QUEUE_MEMORY):
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.items = collections.deque()
+        self.bytes = 0
+        self.condition = threading.Condition()
+        self.error = None
+
+        # Counters
+        self.puts = 0
+        self.gets = 0
+        self.peak_blocks = 0
+        self.peak_bytes = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def full(self, size):
+        if not self.items:
+            return False
+        return len(self.items) >= self.max_blocks or self.bytes + size > self.max_bytes
+
+    def put(self, item, size=0):
+        with self.condition:
+            if self.full(size) and self.error is None:
+                start = time.perf_counter()
+                while self.full(size) and self.error is None:
+                    self.condition.wait()
+                self.put_wait += time.perf_counter() - start
+            if self.error is not None:
+                return
+            self.items.append((item, size))
+            self.bytes += size
+            self.puts += 1
+            self.peak_blocks = max(self.peak_blocks, len(self.items))
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            if not self.items and self.error is None:
+                start = time.perf_counter()
+                while not self.items and self.error is None:
+                    self.condition.wait()
+                self.get_wait += time.perf_counter() - start
+            if self.error is not None:
+                return None
+            item, size = self.items.popleft()
+            self.bytes -= size
+            self.gets += 1
+            self.condition.notify_all()
+            return item
+
+    def get_batch(self, max_items):
+        # Wait for one item, then take up to max_items - 1 more that are already
+        # waiting. Stops short of a None so each worker still gets its own, and returns
+        # None rather than a list when that None is first in line
+        first = self.get()
+        if first is None:
+            return None
+        batch = [first]
+        with self.condition:
+            while len(batch) < max_items and self.items and self.items[0][0] is not None:
+                item, size = self.items.popleft()
+                self.bytes -= size
+                self.gets += 1
+                batch.append(item)
+            self.condition.notify_all()
+        return batch
+
+    def fail(self, error):
+        # Called by the consumer when it can't go on, the first error is kept
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.items.clear()
+            self.bytes = 0
+            self.condition.notify_all()
+
+    def failed(self):
+        with self.condition:
+            return self.error
+
+    def qsize(self):
+        with self.condition:
+            return len(self.items)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'puts': self.puts,
+                'gets': self.gets,
+                'depth': len(self.items),
+                'bytes': self.bytes,
+                'peak_blocks': self.peak_blocks,
+                'peak_bytes': self.peak_bytes,
+                'put_wait': round(self.put_wait, 3),
+                'get_wait': round(self.get_wait, 3),
+            }
+
+    def report(self, name):
+        stats = self.stats()
+        print(f"[{name}] {stats['puts']} blocks, peak depth {stats['peak_blocks']} blocks / {stats['peak_bytes'] / 1024**2:.1f} MB, "
+              f"producers blocked {stats['put_wait']:.1f}s, consumer waited {stats['get_wait']:.1f}s")
+
+class Stage:
+    # A pool of worker threads taking items off in_queue, running fn on each and
+    # putting whatever it returns on out_queue. fn returns (item, size) or None if
+    # there is nothing to pass on. Exceptions are handed to on_error and the worker
+    # carries on with the next item. Each worker needs its own None to stop, see stop()
+    #
+    # Time is split into busy (inside fn), blocked (waiting for room in out_queue) and
+    # idle (waiting for input), which is what the utilisation report shows
+    #
+    # Only workers threads work on items at once, resize() changes that while the
+    # stage runs up to max_workers. Threads are started as the count first reaches
+    # them, so a stage that never grows never has more than it started with
+    #
+    # With batch above 1 fn is given a list of up to batch items at a time, whatever
+    # is waiting when a worker comes for more, and counts as one item
+    #
+    # When out_queue fails the stage fails in_queue too and its workers stop, so a
+    # dead sink stops every stage back to the first
+    def __init__(self, name, fn, in_queue, out_queue=None, workers=1, on_error=None, max_workers=None, batch=1):
+        self.name = name
+        self.fn = fn
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.workers = workers
+        self.max_workers = max(workers, max_workers or workers)
+        self.on_error = on_error
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.gate = threading.Condition(self.lock)
+        self.active = 0
+        self.capacity = 0.0
+        self.resized = None
+        self.threads = []
+        self.stopping = False
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.started = None
+        self.finished = None
+
+    def run(self):
+        while True:
+            item = self.in_queue.get() if self.batch == 1 else self.in_queue.get_batch(self.batch)
+            if item is None:
+                break
+            # Items are taken off the queue first and only worked on once one of the
+            # worker slots is free, so a resize applies straight away even to the
+            # threads that were waiting for input
+            with self.gate:
+                while self.active >= self.workers:
+                    self.gate.wait()
+                self.active += 1
+            try:
+                self.process(item)
+            finally:
+                with self.gate:
+                    self.active -= 1
+                    self.gate.notify_all()
+            if self.out_queue is not None and self.out_queue.failed() is not None:
+                self.in_queue.fail(self.out_queue.failed())
+
+    def process(self, item):
+        start = time.perf_counter()
+        try:
+            result = self.fn(item)
+        except Exception as e:
+            result = None
+            with self.lock:
+                self.errors += 1
+            if self.on_error is not None:
+                self.on_error(item, e)
+        busy = time.perf_counter() - start
+        if result is not None and self.out_queue is not None:
+            self.out_queue.put(*result)
+        with self.lock:
+            self.items += 1
+            self.busy += busy
+            self.blocked += time.perf_counter() - start - busy
+
+    def resize(self, workers):
+        # Let between 1 and max_workers threads work on items from now on. Workers
+        # already busy finish their item before the new limit bites
+        with self.gate:
+            now = time.perf_counter()
+            self.capacity += (now - self.resized) * self.workers
+            self.resized = now
+            self.workers = max(1, min(workers, self.max_workers))
+            if self.started is not None and not self.stopping:
+                self.spawn()
+            self.gate.notify_all()
+            return self.workers
+
+    def spawn(self):
+        # Start threads until there is one for each worker slot, called with the lock
+        # held. Threads are never taken away again, ones above the limit just wait
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.run, name=f'{self.name}-{len(self.threads)}')
+            self.threads.append(thread)
+            thread.start()
+
+    def start(self):
+        with self.gate:
+            self.started = self.resized = time.perf_counter()
+            self.spawn()
+        return self
+
+    def stop(self):
+        # Wait for everything already queued to go through, then stop the workers
+        with self.lock:
+            self.stopping = True
+            threads = list(self.threads)
+        for thread in threads:
+            self.in_queue.put(None)
+        for thread in threads:
+            thread.join()
+        with self.lock:
+            self.finished = time.perf_counter()
+
+    def stats(self):
+        with self.lock:
+            end = self.finished or time.perf_counter()
+            wall = end - self.started
+            capacity = self.capacity + (end - self.resized) * self.workers or 1.0
+            return {
+                'workers': self.workers,
+                'items': self.items,
+                'errors': self.errors,
+                'wall': round(wall, 3),
+                'busy': round(self.busy, 3),
+                'blocked': round(self.blocked, 3),
+                'utilisation': round(self.busy / capacity, 3),
+                'blocked_fraction': round(self.blocked / capacity, 3),
+            }
+
+    def report(self):
+        stats = self.stats()
+        print(f"[{self.name}] {stats['workers']} workers, {stats['items']} items ({stats['errors']} failed), "
+              f"busy {100 * stats['utilisation']:.0f}%, blocked on output {100 * stats['blocked_fraction']:.0f}%, "
+              f"idle {100 * (1 - stats['utilisation'] - stats['blocked_fraction']):.0f}%")
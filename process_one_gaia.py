@@ -1,102 +1,180 @@
-import sys
-import requests
 import threading
-from bs4 import BeautifulSoup
+import argparse
+import glob
 import os
-import shutil
-import csv
 import gzip
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import queue
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import gaia_filter
+import pipeline
+import manifest
+import metrics
+import sinks
 
 #
 # This file will process a single downloaded GAIA source csv in case you need
 # to reprocess one. You'll need to import into the database with a COPY command
 #
+# Given a directory, a glob or several files it runs in batch mode instead, e.g. to
+# rebuild from a local mirror of the shards without touching the network:
+#
+#   python process_one_gaia.py /mirror/gaia_source --output-dir staging
+#
+# Batch mode filters the shards on a pool of worker processes and writes rotating
+# data{N}.csv files through the same writer as fetch_gaia_source.py, starting after
+# any data{N}.csv already in the output directory. Progress is kept in a manifest
+# there so an interrupted batch can be picked up with --resume
+#
 
-POOL_SIZE = 16
-lock = threading.Lock()
-data_queue = queue.Queue()
+data_queue = pipeline.BlockQueue()
 
-def process_file(file_path):
+def process_file(file_path, delete=True):
     print(f"Processing {file_path}")
-    with gzip.open(file_path, mode='rt', encoding='utf-8') as file:
+    with gzip.open(file_path, mode='rb') as file:
 
         total = 0
         accepted = 0
 
-        header_indices = {}
-
-        for line in file:
-            if line.startswith('#'):
-                continue
-
-            row = line.strip().split(',')
-
-            if header_indices == {}:
-                header_indices = {name: idx for idx, name in enumerate(row)}
-                continue
-
-            total += 1
-
-            has_xp_sampled = 1 if row[header_indices['has_xp_sampled']] == '"True"' else 0
-
-
-            try:
-                phot_g_mean_mag = float(row[header_indices['phot_g_mean_mag']])
-            except ValueError:
-                continue
-
-            if phot_g_mean_mag > 20:
-                continue
-
-            pmra = 0
-            if row[header_indices['pmra']] != 'null':
-                pmra = row[header_indices['pmra']]
-
-            pmdec = 0
-            if row[header_indices['pmdec']] != 'null':
-                pmdec = row[header_indices['pmdec']]
+        for block, block_accepted, block_total in gaia_filter.filter_chunks(file, healpix_levels=gaia_filter.HEALPIX_LEVELS):
+            data_queue.put(block, len(block))
+            accepted += block_accepted
+            total += block_total
 
-
-            teff = 0
-            if row[header_indices['teff_gspphot']] != 'null':
-                teff = row[header_indices['teff_gspphot']]
-
-            accepted += 1
-
-            data_queue.put(f"{row[header_indices['ra']]},{row[header_indices['dec']]},{pmra},{pmdec},{row[header_indices['phot_g_mean_mag']]},{row[header_indices['source_id']]},{has_xp_sampled},{teff}\n")
-        
-    os.remove(file_path)
+    if delete:
+        os.remove(file_path)
     return (f"Processed {file_path}: Accepted {accepted} lines from {total}")
 
 def write_to_file():
     print(f"Queue reader started")
     #with open('data.csv', 'w') as file_handle:
-    with open('data.csv', 'w', buffering=1024*2048) as file_handle:  # buffer
-        file_handle.write(f'ra,dec,pmra,pmdec,phot_g_mean_mag,source_id,has_xp_sampled,teff\n')
+    with open('data.csv', 'wb', buffering=1024*2048) as file_handle:  # buffer
+        file_handle.write(gaia_filter.csv_header(gaia_filter.HEALPIX_LEVELS))
         while True:
             data = data_queue.get()
             if data is None:
                 break  # Stop processing when None is encountered
             file_handle.write(data)
 
-def main():
-
-    if len(sys.argv) > 1:
-        filename = sys.argv[1]  # The first command-line argument
-    else:
-        print(f"{sys.argv[0]} <filename>")
-        sys.exit()
-
-    print("Starting queue reader")
-    write_thread = threading.Thread(target=write_to_file)
+def expand_paths(paths):
+    # Shards named by a list of files, directories and globs, in order and without
+    # duplicates
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(glob.glob(os.path.join(path, '*.csv.gz'))))
+        elif glob.has_magic(path):
+            found.extend(sorted(glob.glob(path)))
+        else:
+            found.append(path)
+    return list(dict.fromkeys(found))
+
+def filter_local_shard(file_path, process_pool=None, healpix_levels=gaia_filter.HEALPIX_LEVELS):
+    # Filter a local shard the same way a downloaded one is. Only the path goes to the
+    # worker process, which decompresses the file as it reads it
+    metrics.count('bytes_read', os.path.getsize(file_path))
+    with metrics.stage('filter'):
+        if process_pool is None:
+            block, accepted, total = gaia_filter.filter_gz_path(file_path, healpix_levels=healpix_levels)
+        else:
+            block, accepted, total = process_pool.submit(gaia_filter.filter_gz_path, file_path, healpix_levels=healpix_levels).result()
+    return sinks.shard_item(os.path.basename(file_path), block, accepted, total)
+
+def process_batch(paths, args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress = manifest.Manifest(os.path.join(args.output_dir, args.manifest), resume=args.resume)
+    if args.resume:
+        pending = progress.pending(paths)
+        print(f"Resuming, {len(paths) - len(pending)} of {len(paths)} shards already done")
+        paths = pending
+
+    run_metrics = metrics.from_args(args, 'process_one_gaia', 'shards', len(paths), args.output_dir)
+    run_metrics.gauge('writer_queue_blocks', data_queue.qsize)
+    run_metrics.start()
+
+    # Shards are written after the last data{N}.csv already there, unless a resumed
+    # manifest says where to carry on from
+    first_index = sinks.next_free_index(args.output_dir)
+    write_thread = threading.Thread(target=sinks.write_csv, args=(data_queue, progress, gaia_filter.output_columns(args.healpix_levels),
+                                                                  'none', None, args.output_dir, first_index))
     write_thread.start()
-    print("Started queue reader")
-    
-    process_file(filename)
+
+    process_pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'))
+    total = len(paths)
+    finished = 0
+    finished_lock = threading.Lock()
+
+    def filter_item(file_path):
+        nonlocal finished
+        result = filter_local_shard(file_path, process_pool, args.healpix_levels)
+        (file_name, blocks, accepted, total_rows, zone), size = result
+        metrics.advance()
+        with finished_lock:
+            finished += 1
+            print(f"[{finished}/{total}] Processed {file_path}: Accepted {accepted} lines from {total_rows}")
+        return result
+
+    def filter_failed(file_path, e):
+        print(f"Exception occurred: {str(e)}")
+        progress.record(manifest.shard_name(file_path), 'failed', error=str(e))
+
+    # One thread per worker process hands it shards and passes the results on. If the
+    # writer dies data_queue fails and the filter stage stops taking shards
+    path_queue = pipeline.BlockQueue(max_blocks=len(paths) + args.workers)
+    filter_stage = pipeline.Stage("filter", filter_item, path_queue, data_queue, args.workers, filter_failed).start()
+    for file_path in paths:
+        path_queue.put(file_path)
+    filter_stage.stop()
+    process_pool.shutdown()
     data_queue.put(None)
     write_thread.join()
 
+    filter_stage.report()
+    data_queue.report("writer queue")
+    run_metrics.stop()
+
+    # Inputs are only removed once the manifest says they are safely written
+    if args.delete:
+        for file_path in paths:
+            if progress.done(manifest.shard_name(file_path)):
+                os.remove(file_path)
+
+    failed = progress.entries('failed')
+    if failed:
+        print(f"{len(failed)} shards failed, run again with --resume to retry them")
+    write_error = data_queue.failed()
+    if write_error is not None:
+        print(f"Writer failed: {write_error}, run again with --resume to carry on")
+    progress.close()
+    if write_error is not None:
+        raise SystemExit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter local GAIA source csv.gz files into csv files ready for COPY.")
+    parser.add_argument("paths", nargs='+', help="A shard to reprocess into data.csv, or directories, globs or several shards to process as a batch")
+    parser.add_argument("--delete", action="store_true", help="Remove each input once it has been processed in batch mode")
+    parser.add_argument("--keep", action="store_true", help="Keep the input of a single shard, which is otherwise removed once processed")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of shards being filtered at once in batch mode")
+    parser.add_argument("--output-dir", default=".", help="Directory for the data{N}.csv files, manifest and metrics in batch mode")
+    parser.add_argument("--healpix-levels", type=int, nargs='*', default=gaia_filter.HEALPIX_LEVELS, help="Append a healpix{level} column for each level")
+    parser.add_argument("--manifest", default="process_one_gaia_manifest.jsonl", help="File in the output directory recording the progress of every shard")
+    parser.add_argument("--resume", action="store_true", help="Skip shards the manifest says are done and carry on writing where the last batch stopped")
+    metrics.add_arguments(parser, "process_one_gaia_metrics.jsonl")
+    args = parser.parse_args()
+
+    paths = expand_paths(args.paths)
+    if len(args.paths) == 1 and paths == args.paths and not os.path.isdir(args.paths[0]):
+        # A single shard goes to data.csv as before
+        print("Starting queue reader")
+        write_thread = threading.Thread(target=write_to_file)
+        write_thread.start()
+        print("Started queue reader")
+
+        print(process_file(paths[0], not args.keep))
+        data_queue.put(None)
+        write_thread.join()
+    else:
+        print(f"Processing {len(paths)} shards into {args.output_dir}")
+        process_batch(paths, args)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+import xp_spectra
+
+#
+# A standalone store of XP spectra keyed by source_id, for building the photometric
+# catalogue without loading the spectra into Postgres. A store is a directory holding
+#
+#   source_ids.npy   sorted int64 source_ids
+#   flux.npy         uint8 (rows, 687) matrix, row i the spectrum of source_ids[i] in
+#                    catalogue form: a one byte exponent and 343 float16 values, see
+#                    xp_spectra.export_flux
+#   store.json       row count and width
+#
+# Both arrays open with np.load(mmap_mode='r'), so a lookup only touches the pages it
+# needs. fetch_spectra.py --sink store writes one segment per shard under
+# segments/ as it goes and merges them into the store at the end of the run
+#
+
+SEGMENTS = 'segments'
+MERGE_ROWS = 1_000_000
+
+def segment_directory(directory, shard):
+    return os.path.join(directory, SEGMENTS, shard.split('.')[0])
+
+def write_segment(directory, shard, source_ids, flux):
+    # Save one shard's spectra through a temporary directory, so a segment is either
+    # complete or missing
+    target = segment_directory(directory, shard)
+    staging = target + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    order = np.argsort(source_ids, kind='stable')
+    np.save(os.path.join(staging, 'source_ids.npy'), source_ids[order])
+    np.save(os.path.join(staging, 'flux.npy'), flux[order])
+    for name in os.listdir(staging):
+        with open(os.path.join(staging, name), 'rb') as f:
+            os.fsync(f.fileno())
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(staging, target)
+    return target
+
+def load_shard(file, members=None):
+    # Parse a decompressed spectra file into sorted source_ids and catalogue form flux
+    source_ids = []
+    flux = []
+    rows = 0
+    for buf in xp_spectra.read_chunks(file):
+        chunk_ids, chunk_flux, chunk_rows = xp_spectra.parse_chunk(buf, members)
+        rows += chunk_rows
+        if len(chunk_ids):
+            source_ids.append(chunk_ids)
+            flux.append(xp_spectra.export_flux(chunk_flux))
+    if not source_ids:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.uint8), rows
+    return np.concatenate(source_ids), np.concatenate(flux), rows
+
+def list_segments(directory):
+    root = os.path.join(directory, SEGMENTS)
+    if not os.path.isdir(root):
+        return []
+    return sorted(os.path.join(root, name) for name in os.listdir(root) if not name.endswith('.tmp'))
+
+def clean(directory):
+    # Remove segments that were part way through being written
+    root = os.path.join(directory, SEGMENTS)
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            if name.endswith('.tmp'):
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+def merge(directory, remove_segments=False):
+    # Merge every segment into the store. Shards cover separate source_id ranges, so
+    # the segments are normally just laid end to end in order of their first id; only
+    # if they overlap are the rows sorted as well
+    segments = []
+    for path in list_segments(directory):
+        source_ids = np.load(os.path.join(path, 'source_ids.npy'), mmap_mode='r')
+        flux = np.load(os.path.join(path, 'flux.npy'), mmap_mode='r')
+        if len(source_ids):
+            segments.append((int(source_ids[0]), int(source_ids[-1]), source_ids, flux))
+    segments.sort(key=lambda segment: segment[:2])
+    rows = sum(len(segment[2]) for segment in segments)
+    width = segments[0][3].shape[1] if segments else 0
+    overlapping = any(previous[1] >= following[0] for previous, following in zip(segments, segments[1:]))
+
+    ids_name = os.path.join(directory, 'source_ids.npy.tmp')
+    flux_name = os.path.join(directory, 'flux.npy.tmp')
+    out_ids = np.lib.format.open_memmap(ids_name, mode='w+', dtype=np.int64, shape=(rows,))
+    out_flux = np.lib.format.open_memmap(flux_name, mode='w+', dtype=np.uint8, shape=(rows, width))
+    position = 0
+    for first, last, source_ids, flux in segments:
+        out_ids[position:position + len(source_ids)] = source_ids
+        for start in range(0, len(source_ids), MERGE_ROWS):
+            end = min(start + MERGE_ROWS, len(source_ids))
+            out_flux[position + start:position + end] = flux[start:end]
+        position += len(source_ids)
+
+    if overlapping:
+        # Gather the rows into sorted order in a second file a block at a time
+        order = np.argsort(out_ids, kind='stable')
+        out_ids[:] = out_ids[order]
+        sorted_name = os.path.join(directory, 'flux.sorted.npy.tmp')
+        sorted_flux = np.lib.format.open_memmap(sorted_name, mode='w+', dtype=np.uint8, shape=(rows, width))
+        for start in range(0, rows, MERGE_ROWS):
+            sorted_flux[start:start + MERGE_ROWS] = out_flux[order[start:start + MERGE_ROWS]]
+        del out_flux
+        os.replace(sorted_name, flux_name)
+        out_flux = sorted_flux
+
+    out_ids.flush()
+    out_flux.flush()
+    del out_ids, out_flux
+    os.replace(ids_name, os.path.join(directory, 'source_ids.npy'))
+    os.replace(flux_name, os.path.join(directory, 'flux.npy'))
+    with open(os.path.join(directory, 'store.json'), 'w') as f:
+        json.dump({'rows': rows, 'width': width, 'segments': len(segments)}, f, indent=1)
+    if remove_segments:
+        shutil.rmtree(os.path.join(directory, SEGMENTS), ignore_errors=True)
+    return rows
+
+def decode_flux(rows):
+    # float32 spectra back from catalogue form rows
+    rows = np.asarray(rows)
+    exponents = rows[:, 0].astype(np.float64)
+    values = np.ascontiguousarray(rows[:, 1:]).view('<f2').astype(np.float64)
+    return (values / 10 ** exponents[:, None]).astype(np.float32)
+
+class SpectraStore:
+    # Read side of a merged store
+    def __init__(self, directory, mmap_mode='r'):
+        self.directory = directory
+        self.source_ids = np.load(os.path.join(directory, 'source_ids.npy'), mmap_mode=mmap_mode)
+        self.flux = np.load(os.path.join(directory, 'flux.npy'), mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.source_ids)
+
+    def lookup(self, source_ids):
+        # Row of each source_id, -1 where it isn't in the store. One binary search per
+        # id over the memory mapped array
+        source_ids = np.asarray(source_ids, dtype=np.int64)
+        if len(self.source_ids) == 0:
+            return np.full(len(source_ids), -1, dtype=np.int64)
+        idx = np.searchsorted(self.source_ids, source_ids)
+        idx = np.minimum(idx, len(self.source_ids) - 1)
+        return np.where(self.source_ids[idx] == source_ids, idx, -1)
+
+    def get_flux(self, source_ids):
+        # Catalogue form flux rows for source_ids, in the order given. Every id must be
+        # in the store
+        idx = self.lookup(source_ids)
+        missing = idx < 0
+        if missing.any():
+            raise KeyError(f"{int(missing.sum())} source_ids have no spectrum, e.g. {int(np.asarray(source_ids)[missing][0])}")
+        return self.flux[idx]
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the segments of a spectra store, or look up spectra in one.")
+    parser.add_argument("directory", help="Spectra store directory")
+    parser.add_argument("--merge", action="store_true", help="Merge the segments under DIRECTORY/segments into the store")
+    parser.add_argument("--remove-segments", action="store_true", help="Delete the segments once merged")
+    parser.add_argument("--lookup", type=int, nargs='*', default=[], help="Print the spectrum of these source_ids")
+    args = parser.parse_args()
+
+    if args.merge:
+        clean(args.directory)
+        print(f"Merged {merge(args.directory, args.remove_segments)} spectra into {args.directory}")
+    if args.lookup:
+        store = SpectraStore(args.directory)
+        for source_id, flux in zip(args.lookup, decode_flux(store.get_flux(args.lookup))):
+            print(source_id, flux.tolist())
+
+if __name__ == "__main__":
+    main()
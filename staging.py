@@ -0,0 +1,83 @@
+import gzip
+import io
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+#
+# Compressed csv staging files. Every shard is compressed on its own into a complete
+# gzip member, zstd frame or lz4 frame and the members are appended to the file one
+# after another. The command line tools decompress concatenated members as one stream,
+# so a staging file loads with
+#
+#   COPY stars (...) FROM PROGRAM 'zcat /path/to/data1.csv.gz' CSV HEADER NULL "null";
+#
+# (zstd -dc or lz4 -dc for the others), or with load_staging.py, and because shard
+# boundaries are member boundaries a resumed run can still truncate a file back to
+# the end of its last complete shard
+#
+
+CODECS = ['none', 'gzip', 'zstd', 'lz4']
+DEFAULT_LEVELS = {'gzip': 1, 'zstd': 3, 'lz4': 0}
+EXTENSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+PROGRAMS = {'gzip': 'zcat', 'zstd': 'zstd -dc', 'lz4': 'lz4 -dc'}
+
+def available(codec):
+    if codec == 'zstd':
+        return zstandard is not None
+    if codec == 'lz4':
+        return lz4 is not None
+    return codec in CODECS
+
+def level_for(codec, level=None):
+    return DEFAULT_LEVELS.get(codec) if level is None else level
+
+def compress(data, codec, level=None):
+    # One self contained member holding data
+    level = level_for(codec, level)
+    if codec == 'none':
+        return data
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == 'lz4':
+        return lz4.frame.compress(data, compression_level=level)
+    raise ValueError(f"Unknown codec {codec}")
+
+def decompress(data, codec):
+    # Contents of one member written by compress
+    if codec == 'none':
+        return data
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'lz4':
+        return lz4.frame.decompress(data)
+    raise ValueError(f"Unknown codec {codec}")
+
+def codec_for(path):
+    for codec, extension in EXTENSIONS.items():
+        if extension and path.endswith(extension):
+            return codec
+    return 'none'
+
+def open_staging(path):
+    # Binary file object over the decompressed contents of a staging file
+    codec = codec_for(path)
+    if codec == 'gzip':
+        return gzip.open(path, 'rb')
+    if codec == 'zstd':
+        # The zstandard reader has no readline or line iteration of its own
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True))
+    if codec == 'lz4':
+        return lz4.frame.open(path, 'rb')
+    return open(path, 'rb')
@@ -0,0 +1,83 @@
+import gzip
+import random
+
+#
+# Generates synthetic GAIA source shards for benchmarks and tests. The layout follows
+# the real GaiaSource csv files: a block of '#' comment lines, a header and then
+# about 150 columns per row, with the columns we keep at roughly their real positions.
+# make_spectra_shard does the same for the XP sampled mean spectrum files
+#
+
+NUM_COLUMNS = 152
+COLUMN_POSITIONS = {
+    'solution_id': 0,
+    'designation': 1,
+    'source_id': 2,
+    'random_index': 3,
+    'ra': 5,
+    'dec': 7,
+    'pmra': 13,
+    'pmdec': 15,
+    'phot_g_mean_mag': 69,
+    'has_xp_sampled': 95,
+    'teff_gspphot': 130,
+}
+
+def header_columns():
+    columns = [f"col_{i}" for i in range(NUM_COLUMNS)]
+    for name, idx in COLUMN_POSITIONS.items():
+        columns[idx] = name
+    return columns
+
+def make_rows(num_rows, seed=0, healpix8=None):
+    # Yields csv lines (without the header). Source ids increase through the shard like
+    # the real files do. When healpix8 is given every star lands in that level 8 pixel
+    rng = random.Random(seed)
+    filler = ['0.123456'] * NUM_COLUMNS
+    base = 0 if healpix8 is None else healpix8 * 2**43
+    step = 2**40 if healpix8 is None else 2**43 // (num_rows + 1)
+    for i in range(num_rows):
+        row = list(filler)
+        source_id = base + (i + 1) * step + rng.randrange(1024)
+        row[COLUMN_POSITIONS['solution_id']] = '375316653866487564'
+        row[COLUMN_POSITIONS['designation']] = f'"Gaia DR3 {source_id}"'
+        row[COLUMN_POSITIONS['source_id']] = str(source_id)
+        row[COLUMN_POSITIONS['random_index']] = str(rng.randrange(1_000_000_000))
+        row[COLUMN_POSITIONS['ra']] = repr(rng.uniform(0, 360))
+        row[COLUMN_POSITIONS['dec']] = repr(rng.uniform(-90, 90))
+        row[COLUMN_POSITIONS['pmra']] = 'null' if rng.random() < 0.2 else repr(rng.gauss(0, 10))
+        row[COLUMN_POSITIONS['pmdec']] = 'null' if rng.random() < 0.2 else repr(rng.gauss(0, 10))
+        row[COLUMN_POSITIONS['phot_g_mean_mag']] = 'null' if rng.random() < 0.01 else f"{rng.uniform(3, 21.5):.6f}"
+        row[COLUMN_POSITIONS['has_xp_sampled']] = '"True"' if rng.random() < 0.03 else '"False"'
+        row[COLUMN_POSITIONS['teff_gspphot']] = 'null' if rng.random() < 0.5 else f"{rng.uniform(3000, 9000):.4f}"
+        yield ','.join(row) + '\n'
+
+def make_shard(file_path, num_rows, seed=0, healpix8=None):
+    with gzip.open(file_path, mode='wt', encoding='utf-8', compresslevel=1) as f:
+        f.write('# %ECSV 1.0\n# ---\n# delimiter: \',\'\n')
+        f.write(','.join(header_columns()) + '\n')
+        for line in make_rows(num_rows, seed, healpix8):
+            f.write(line)
+    return file_path
+
+SPECTRA_COLUMNS = ['source_id', 'solution_id', 'ra', 'dec', 'flux', 'flux_error']
+SPECTRA_SAMPLES = 343
+
+def make_spectra_rows(num_rows, seed=0, samples=SPECTRA_SAMPLES):
+    # Yields XP sampled mean spectrum csv lines, with the flux and flux_error arrays
+    # quoted the way the GAIA files have them
+    rng = random.Random(seed)
+    for i in range(num_rows):
+        source_id = (i + 1) * 2**40 + rng.randrange(1024)
+        scale = rng.uniform(1e-18, 1e-15)
+        flux = ','.join(f"{scale * rng.uniform(0.1, 2):.7E}" for j in range(samples))
+        flux_error = ','.join(f"{scale * rng.uniform(0.001, 0.02):.7E}" for j in range(samples))
+        yield f'{source_id},375316653866487564,{rng.uniform(0, 360)!r},{rng.uniform(-90, 90)!r},"[{flux}]","[{flux_error}]"\n'
+
+def make_spectra_shard(file_path, num_rows, seed=0):
+    with gzip.open(file_path, mode='wt', encoding='utf-8', compresslevel=1) as f:
+        f.write('# %ECSV 1.0\n# ---\n# delimiter: \',\'\n')
+        f.write(','.join(SPECTRA_COLUMNS) + '\n')
+        for line in make_spectra_rows(num_rows, seed):
+            f.write(line)
+    return file_path
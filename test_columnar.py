@@ -0,0 +1,49 @@
+import io
+import os
+import numpy as np
+import columnar
+import gaia_filter
+import synthetic_gaia
+
+
+def parse(num_rows, seed=0):
+    text = ','.join(synthetic_gaia.header_columns()) + '\n' + ''.join(synthetic_gaia.make_rows(num_rows, seed=seed))
+    chunks = [columns for columns, accepted, total in gaia_filter.filter_columns(io.BytesIO(text.encode('utf-8')), healpix_levels=[8])]
+    return gaia_filter.concat_columns(chunks)
+
+
+def test_round_trip(tmp_path):
+    columns = parse(1000)
+    path, descriptor = columnar.save_shard(str(tmp_path), 'GaiaSource_000000-003111.csv.gz', columns, 1000)
+    assert os.path.basename(path) == 'GaiaSource_000000-003111'
+    assert descriptor['rows'] == len(columns['source_id'])
+
+    descriptor, loaded = columnar.load_shard(path)
+    assert loaded['ra'].dtype == np.float64
+    assert loaded['pmra'].dtype == np.float32
+    assert loaded['source_id'].dtype == np.int64
+    assert loaded['has_xp_sampled'].dtype == np.bool_
+    assert loaded['healpix8'].dtype == np.int32
+    for name, values in columns.items():
+        assert np.array_equal(loaded[name], values)
+
+
+def test_matches_csv_output():
+    text = ','.join(synthetic_gaia.header_columns()) + '\n' + ''.join(synthetic_gaia.make_rows(500, seed=3))
+    csv = b''.join(block for block, accepted, total in gaia_filter.filter_chunks(io.BytesIO(text.encode('utf-8'))))
+    columns = parse(500, seed=3)
+    first = csv.split(b'\n')[0].split(b',')
+    assert float(first[0]) == columns['ra'][0]
+    assert int(first[5]) == columns['source_id'][0]
+    assert len(columns['source_id']) == csv.count(b'\n')
+
+
+def test_empty_shard_and_clean(tmp_path):
+    columns = {name: values[:0] for name, values in parse(10).items()}
+    path, descriptor = columnar.save_shard(str(tmp_path), 'GaiaSource_000001-000002.csv.gz', columns, 0)
+    os.makedirs(str(tmp_path / 'GaiaSource_000003-000004.tmp'))
+    columnar.clean(str(tmp_path))
+    assert columnar.list_shards(str(tmp_path)) == [path]
+    descriptor, loaded = columnar.load_shard(path)
+    assert descriptor['rows'] == 0
+    assert len(loaded['ra']) == 0
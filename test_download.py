@@ -0,0 +1,75 @@
+import pytest
+import download
+import fake_gaia_server
+import fetch_gaia_source
+
+
+@pytest.fixture(scope='module')
+def server():
+    files = fake_gaia_server.gaia_source_files(num_shards=2, num_rows=2000)
+    files['/blob/data.bin'] = bytes(range(256)) * 4096
+    server, url = fake_gaia_server.start_server(files)
+    yield url, files
+    server.shutdown()
+
+
+def test_ranged_download_matches(server, tmp_path):
+    url, files = server
+    expected = files['/blob/data.bin']
+    assert download.fetch_bytes(url + '/blob/data.bin', parts=4, part_size=100_000) == expected
+    path = download.fetch_file(url + '/blob/data.bin', str(tmp_path / 'data.bin'), parts=3, part_size=100_000)
+    with open(path, 'rb') as f:
+        assert f.read() == expected
+
+
+def test_ranges_cover_file():
+    parts = download.ranges(1000, 4, 100)
+    assert parts[0][0] == 0
+    assert parts[-1][1] == 999
+    assert all(a[1] + 1 == b[0] for a, b in zip(parts, parts[1:]))
+    assert download.ranges(50, 4, 100) == [(0, 49)]
+
+
+def test_stalled_download_times_out():
+    server, url = fake_gaia_server.start_server({'/slow.bin': b'x' * 1000}, stall=5)
+    try:
+        with pytest.raises(Exception):
+            download.fetch_bytes(url + '/slow.bin', timeout=(5, 0.5))
+    finally:
+        server.shutdown()
+
+
+def test_listing_and_processing(server):
+    url, _ = server
+    links = fetch_gaia_source.fetch_urls(url + '/gaia_source/')
+    assert len(links) == 2
+    assert links[0].endswith('GaiaSource_000000-393215.csv.gz')
+
+    data = fetch_gaia_source.download_shard(links[0])
+    (shard, blocks, accepted, total, zone), size = fetch_gaia_source.filter_shard(links[0], data)
+    assert shard == 'GaiaSource_000000-393215.csv.gz'
+    assert total == 2000
+    assert b''.join(blocks).count(b'\n') == accepted
+    assert size == len(blocks[0])
+    assert zone['rows'] == accepted
+
+
+def test_streamed_shard_matches_buffered(server, tmp_path, monkeypatch):
+    url, files = server
+    link = fetch_gaia_source.fetch_urls(url + '/gaia_source/')[1]
+    buffered = fetch_gaia_source.filter_shard(link, fetch_gaia_source.download_shard(link))
+    monkeypatch.chdir(tmp_path)
+    streamed = fetch_gaia_source.stream_shard(link, keep_raw=True)
+    assert streamed == buffered
+    with open(tmp_path / 'GaiaSource_393216-786431.csv.gz', 'rb') as f:
+        assert f.read() == files['/gaia_source/GaiaSource_393216-786431.csv.gz']
+
+    (shard, columns, accepted, total, zone), size = fetch_gaia_source.stream_shard(link, columns=True)
+    assert len(columns[0]['source_id']) == accepted == buffered[0][2]
+
+
+def test_connection_pool_fits_every_part_of_every_worker(monkeypatch):
+    for name in ['PARTS', 'POOL_MAXSIZE', '_session']:
+        monkeypatch.setattr(download, name, getattr(download, name))
+    download.configure(parts=6, workers=32)
+    assert download.session().get_adapter('https://cdn.example/')._pool_maxsize == 192
@@ -0,0 +1,135 @@
+import io
+import os
+import psycopg2
+import pytest
+import fetch_spectra
+import spectra_store
+import synthetic_gaia
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        sql = ' '.join(sql.split())
+        if self.conn.fail_on and sql.startswith(self.conn.fail_on):
+            self.conn.closed = 1
+            raise psycopg2.OperationalError('server closed the connection')
+        self.conn.statements.append(sql)
+        self.rowcount = 2
+
+    def copy_expert(self, sql, file, size=8192):
+        self.conn.statements.append('COPY')
+        self.conn.copied.append(file.read())
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+        self.commits = 0
+        self.closed = 0
+        self.fail_on = None
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        self.connections = []
+        self.returned = []
+
+    def getconn(self, key=None):
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    def putconn(self, conn, key=None, close=False):
+        self.returned.append((conn, close))
+
+
+def test_staging_table_is_created_once_and_truncated_per_shard():
+    pool = FakePool()
+    table = fetch_spectra.StagingTable(pool, 'spectra_staging_0')
+    assert table.load(io.StringIO('source_id\n1\n')) == 2
+    assert table.load(io.StringIO('source_id\n2\n')) == 2
+
+    assert len(pool.connections) == 1
+    statements = pool.connections[0].statements
+    assert statements[0] == 'DROP TABLE IF EXISTS spectra_staging_0'
+    assert sum(statement.startswith('CREATE UNLOGGED TABLE spectra_staging_0') for statement in statements) == 1
+    assert sum(statement.startswith('PREPARE spectra_staging_0_update') for statement in statements) == 1
+    assert statements[3:] == ['TRUNCATE spectra_staging_0', 'COPY', 'EXECUTE spectra_staging_0_update'] * 2
+    assert pool.connections[0].copied == ['source_id\n1\n', 'source_id\n2\n']
+
+    table.close()
+    assert statements[-1] == 'DROP TABLE IF EXISTS spectra_staging_0'
+    assert pool.returned == [(pool.connections[0], False)]
+
+
+def test_staging_table_replaces_a_lost_connection():
+    pool = FakePool()
+    table = fetch_spectra.StagingTable(pool, 'spectra_staging_0')
+    table.connect().fail_on = 'TRUNCATE'
+    with pytest.raises(psycopg2.OperationalError):
+        table.load(io.StringIO('source_id\n1\n'))
+    assert pool.returned == [(pool.connections[0], True)]
+
+    assert table.load(io.StringIO('source_id\n1\n')) == 2
+    assert len(pool.connections) == 2
+
+
+def test_staging_table_loads_a_batch_in_one_transaction():
+    pool = FakePool()
+    table = fetch_spectra.StagingTable(pool, 'spectra_staging_0')
+    assert table.load(io.StringIO('1\n'), io.StringIO('2\n'), io.StringIO('3\n')) == 2
+
+    conn = pool.connections[0]
+    assert conn.statements[3:] == ['TRUNCATE spectra_staging_0', 'COPY', 'COPY', 'COPY', 'EXECUTE spectra_staging_0_update']
+    assert conn.copied == ['1\n', '2\n', '3\n']
+    assert conn.commits == 2
+
+
+def test_parse_and_apply_shards_to_the_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_spectra, 'store_dir', str(tmp_path / 'store'))
+    items = []
+    for i in range(2):
+        file_name = f'XpSampledMeanSpectrum_00000{i}-00000{i}.csv.gz'
+        file_path = synthetic_gaia.make_spectra_shard(str(tmp_path / file_name), 10, seed=i)
+        item, size = fetch_spectra.parse_shard(file_name, file_path)
+        assert size > 0
+        assert not os.path.exists(file_path)
+        items.append(item)
+
+    fetch_spectra.apply_shards(items)
+    assert spectra_store.merge(fetch_spectra.store_dir) == 20
+
+
+def test_parse_shard_copy_formats(tmp_path, monkeypatch):
+    file_name = 'XpSampledMeanSpectrum_000000-000001.csv.gz'
+    for copy_format in ['text', 'binary']:
+        monkeypatch.setattr(fetch_spectra, 'copy_format', copy_format)
+        file_path = synthetic_gaia.make_spectra_shard(str(tmp_path / file_name), 5)
+        (name, num, kept, payload), size = fetch_spectra.parse_shard(file_name, file_path)
+        assert (num, kept) == (5, 5)
+        data = b''.join(payload)
+        assert data.startswith(b'PGCOPY') == (copy_format == 'binary')
+        assert size == len(data)
+
+    table = fetch_spectra.StagingTable(FakePool(), 'spectra_staging_0', flux_format='float16', copy_format='text')
+    assert table.copy_format == 'binary'
@@ -0,0 +1,124 @@
+import io
+import numpy as np
+import pytest
+import columnar
+import find_brightest
+import gaia_filter
+import staging
+import zonemap
+
+PIXEL = gaia_filter.HEALPIX8_DIVISOR
+
+
+def make_stars(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    source_id = np.unique(rng.integers(0, 6 * PIXEL, rows))
+    mag = rng.uniform(5, 20, len(source_id)).round(2)
+    mag[rng.random(len(source_id)) < 0.05] = np.nan
+    xp = rng.random(len(source_id)) < 0.3
+    return source_id, mag, xp
+
+
+def brute_force(source_id, mag, xp, k, first=0, last=5):
+    # What the perl scripts select, one pixel at a time
+    selected = {'astrometry': [], 'photometry': []}
+    pixel = gaia_filter.healpix(source_id)
+    for p in range(first, last + 1):
+        for name, keep in [('astrometry', pixel == p), ('photometry', (pixel == p) & xp)]:
+            rows = sorted(zip(np.where(np.isnan(mag[keep]), np.inf, mag[keep]), source_id[keep]))[:k]
+            selected[name].extend(int(row[1]) for row in rows)
+    return selected
+
+
+def test_top_k_matches_brute_force(monkeypatch):
+    monkeypatch.setattr(find_brightest, 'REDUCE_ROWS', 50)
+    source_id, mag, xp = make_stars(2000)
+    selection = find_brightest.Selection(1, 4, k=7)
+    for start in range(0, len(source_id), 97):
+        selection.add(source_id[start:start + 97], mag[start:start + 97], xp[start:start + 97])
+
+    expected = brute_force(source_id, mag, xp, 7, 1, 4)
+    for name in find_brightest.SELECTIONS:
+        pixel, selected = selection.result(name)
+        assert selected.tolist() == expected[name]
+        assert (pixel == gaia_filter.healpix(selected)).all()
+
+
+def csv_lines(source_id, mag, xp):
+    return [b','.join([b'1.0', b'2.0', b'null', b'null', b'null' if np.isnan(m) else b'%.2f' % m, b'%d' % s, b'1' if x else b'0', b'null', b'%d' % gaia_filter.healpix(s)])
+            for s, m, x in zip(source_id, mag, xp)]
+
+
+def csv_header():
+    return b','.join(name.encode() for name in gaia_filter.output_columns([8])) + b'\n'
+
+
+def test_select_range_reads_csv_and_columnar_shards(tmp_path):
+    source_id, mag, xp = make_stars(3000, seed=1)
+    half = len(source_id) // 2
+    lines = csv_lines(source_id[:half], mag[:half], xp[:half])
+    with open(tmp_path / 'data1.csv', 'wb') as f:
+        f.write(csv_header())
+        f.write(b'\n'.join(lines) + b'\n')
+    columns = {'source_id': source_id[half:], 'phot_g_mean_mag': mag[half:].astype(np.float32), 'has_xp_sampled': xp[half:]}
+    columnar.save_shard(str(tmp_path), 'GaiaSource_000003-000005.csv.gz', columns, zone=zonemap.from_columns(columns))
+
+    selected = find_brightest.select_range([str(tmp_path)], 0, 5, k=5)
+    expected = brute_force(source_id, mag.astype(np.float32), xp, 5)
+    for name in find_brightest.SELECTIONS:
+        assert selected[name][1].tolist() == expected[name]
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'zstd', 'lz4'])
+def test_select_range_reads_compressed_csv(tmp_path, codec):
+    if not staging.available(codec):
+        pytest.skip(f'{codec} is not installed')
+    # Laid out as the csv sink writes it, the header and every shard in a member of
+    # their own
+    source_id, mag, xp = make_stars(2000, seed=2)
+    lines = csv_lines(source_id, mag, xp)
+    path = str(tmp_path / ('data1.csv' + staging.EXTENSIONS[codec]))
+    with open(path, 'wb') as f:
+        f.write(staging.compress(csv_header(), codec))
+        for part in [lines[:700], lines[700:]]:
+            f.write(staging.compress(b'\n'.join(part) + b'\n', codec))
+
+    selected = find_brightest.select_range([path], 0, 5, k=5)
+    expected = brute_force(source_id, mag, xp, 5)
+    for name in find_brightest.SELECTIONS:
+        assert selected[name][1].tolist() == expected[name]
+
+
+def test_ranges_read_only_the_shards_they_overlap(tmp_path):
+    # One data1.csv holding two input shards, pixels 0-2 and 3-5, with its zone map
+    source_id, mag, xp = make_stars(3000, seed=3)
+    path = str(tmp_path / 'data1.csv')
+    shards = []
+    with open(path, 'wb') as f:
+        f.write(csv_header())
+        for name, keep in [('a.csv.gz', source_id < 3 * PIXEL), ('b.csv.gz', source_id >= 3 * PIXEL)]:
+            block = b'\n'.join(csv_lines(source_id[keep], mag[keep], xp[keep])) + b'\n'
+            shards.append({'shard': name, 'offset': f.tell(), 'length': len(block), 'zone': zonemap.from_csv(block)})
+            f.write(block)
+    zonemap.write_sidecar(path, shards)
+
+    pieces = find_brightest.input_pieces([str(tmp_path)], 0, 2)
+    assert [(piece['path'], piece['offset']) for piece in pieces] == [(path, shards[0]['offset'])]
+    assert [piece['offset'] for piece in find_brightest.input_pieces([str(tmp_path)], 2, 3)] == [shards[0]['offset'], shards[1]['offset']]
+
+    expected = brute_force(source_id, mag, xp, 5)
+    for name in find_brightest.SELECTIONS:
+        selected = [find_brightest.select_range([str(tmp_path)], first, last, k=5)[name][1] for first, last in [(0, 2), (3, 5)]]
+        assert np.concatenate(selected).tolist() == expected[name]
+
+
+def test_pixel_ranges_and_output():
+    assert find_brightest.pixel_ranges(0, 9, 3) == [(0, 2), (3, 5), (6, 9)]
+    assert find_brightest.pixel_ranges(0, 1, 4) == [(0, 0), (1, 1)]
+
+    files = {'astrometry': io.BytesIO(), 'photometry': io.BytesIO()}
+    source_id = np.array([5, 2**55 + 1])
+    find_brightest.write_selection(files, {'astrometry': (gaia_filter.healpix(source_id), source_id),
+                                           'photometry': (gaia_filter.healpix(source_id[1:]), source_id[1:])})
+    assert files['astrometry'].getvalue() == b'5,0\n%d,4096\n' % (2**55 + 1)
+    assert files['photometry'].getvalue() == b'%d,4096,1\n' % (2**55 + 1)
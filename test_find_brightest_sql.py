@@ -0,0 +1,93 @@
+import psycopg2
+import pytest
+import find_brightest_sql
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        sql = ' '.join(sql.split())
+        if self.conn.fail_on and self.conn.fail_on in sql:
+            raise psycopg2.OperationalError('canceling statement')
+        self.conn.statements.append((sql, params))
+        self.rowcount = 10
+        self.rows = self.conn.results.pop(0) if self.conn.results else []
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, results=()):
+        self.statements = []
+        self.results = list(results)
+        self.commits = 0
+        self.rollbacks = 0
+        self.fail_on = None
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_range_queries():
+    lateral = ' '.join(find_brightest_sql.range_query('photometry').split())
+    assert lateral.startswith('INSERT INTO photometry (source_id, healpix8, healpix2)')
+    assert 'generate_series(%(first)s, %(last)s)' in lateral
+    assert 'has_xp_sampled is true' in lateral
+    window = ' '.join(find_brightest_sql.range_query('astrometry', 'window').split())
+    assert 'PARTITION BY healpix8 ORDER BY phot_g_mean_mag, source_id' in window
+    assert window.endswith('WHERE rank <= %(top)s;')
+
+
+def test_pixel_ranges():
+    assert find_brightest_sql.pixel_ranges(0, 9, 4) == [(0, 3), (4, 7), (8, 9)]
+
+
+def test_select_range_fills_both_tables_in_one_transaction():
+    conn = FakeConnection()
+    assert find_brightest_sql.select_range(conn, 0, 4095) == {'astrometry': 10, 'photometry': 10}
+    assert [sql.split(' (')[0] for sql, params in conn.statements] == ['INSERT INTO astrometry', 'INSERT INTO photometry']
+    assert conn.statements[0][1] == {'first': 0, 'last': 4095, 'top': 127}
+    assert conn.commits == 1
+
+    conn = FakeConnection()
+    conn.fail_on = 'INSERT INTO photometry'
+    with pytest.raises(psycopg2.OperationalError):
+        find_brightest_sql.select_range(conn, 0, 4095)
+    assert (conn.commits, conn.rollbacks) == (0, 1)
+
+
+def test_same_selection_allows_ties_at_the_cut():
+    expected = [(1, 10.0), (2, 11.0), (3, 12.0)]
+    assert find_brightest_sql.same_selection(expected, [(2, 11.0), (1, 10.0), (3, 12.0)])
+    assert find_brightest_sql.same_selection(expected, [(1, 10.0), (2, 11.0), (4, 12.0)])
+    assert not find_brightest_sql.same_selection(expected, [(1, 10.0), (5, 11.0), (3, 12.0)])
+    assert not find_brightest_sql.same_selection(expected, [(1, 10.0), (2, 11.0)])
+    assert find_brightest_sql.same_selection([(1, 10.0), (2, None)], [(1, 10.0), (3, None)])
+    assert find_brightest_sql.same_selection([], [])
+
+
+def test_verify_reports_differing_pixels():
+    # Original and selected rows for astrometry then photometry of each pixel
+    conn = FakeConnection(results=[
+        [(1, 10.0)], [(1, 10.0)], [], [],
+        [(2, 9.0), (3, 9.5)], [(2, 9.0), (4, 9.6)], [(3, 9.5)], [(3, 9.5)],
+    ])
+    assert find_brightest_sql.verify(conn, [7, 8]) == [('astrometry', 8)]
+    assert conn.statements[0][1] == (7, 127)
@@ -0,0 +1,123 @@
+import gzip
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import fetch_gaia_source
+import gaia_filter
+import synthetic_gaia
+
+HEADER = 'source_id,ra,dec,pmra,pmdec,phot_g_mean_mag,has_xp_sampled,teff_gspphot,extra\n'
+
+
+def run(parser, text):
+    blocks = []
+    accepted = 0
+    total = 0
+    for block, block_accepted, block_total in gaia_filter.PARSERS[parser](io.BytesIO(text.encode('utf-8'))):
+        blocks.append(block)
+        accepted += block_accepted
+        total += block_total
+    return b''.join(blocks), accepted, total
+
+
+def test_filter_rows():
+    text = ('# comment\n' + HEADER +
+            '1,10.5,20.5,null,2.5,19.9,"True",null,x\n'
+            '2,11.5,21.5,1.5,null,20.1,"False",5000.0,x\n'
+            '3,12.5,22.5,1.5,-2.5,null,"False",5000.0,x\n'
+            '4,13.5,23.5,1.5,-2.5,20,"False",5000.0,x\n')
+    for parser in gaia_filter.PARSERS:
+        output, accepted, total = run(parser, text)
+        assert output == b'10.5,20.5,0,2.5,19.9,1,1,0\n13.5,23.5,1.5,-2.5,20,4,0,5000.0\n'
+        assert accepted == 2
+        assert total == 4
+
+
+def test_parsers_match_on_synthetic_shard():
+    text = '# comment\n' + ','.join(synthetic_gaia.header_columns()) + '\n' + ''.join(synthetic_gaia.make_rows(5000, seed=1))
+    line_output = run('line', text)
+    chunk_output = run('chunk', text)
+    assert line_output == chunk_output
+    assert 0 < line_output[1] < 5000
+
+
+def test_chunk_boundaries():
+    text = HEADER + ''.join(f'{i},1.0,2.0,3.0,4.0,15.0,"False",null,x\n' for i in range(10))
+    blocks = list(gaia_filter.filter_chunks(io.BytesIO(text.encode('utf-8')), chunk_bytes=100))
+    assert len(blocks) > 1
+    assert sum(accepted for block, accepted, total in blocks) == 10
+    assert b''.join(block for block, accepted, total in blocks).count(b'\n') == 10
+
+
+def test_quoted_comma_falls_back_to_split():
+    text = HEADER + '1,1.0,2.0,3.0,4.0,15.0,"False",null,"a,b"\n2,1.0,2.0,3.0,4.0,15.0,"False",null,x\n'
+    for parser in gaia_filter.PARSERS:
+        output, accepted, total = run(parser, text)
+        assert output == b'1.0,2.0,3.0,4.0,15.0,1,0,0\n1.0,2.0,3.0,4.0,15.0,2,0,0\n'
+
+
+def test_extract_and_format_fields_of_any_width():
+    buf = b'1,ab,\n22,,c\n333,d,ef'
+    data = np.frombuffer(buf, dtype=np.uint8)
+    assert gaia_filter.extract_field(data, np.array([0, 6, 12]), np.array([1, 8, 15])).tolist() == [b'1', b'22', b'333']
+    # The last field runs up to the end of the buffer, narrower than the widest one
+    assert gaia_filter.extract_field(data, np.array([2, 9, 19]), np.array([4, 9, 20])).tolist() == [b'ab', b'', b'f']
+
+    columns = {name: np.array([b'1', b'22', b'333']) for name in gaia_filter.PROJECTED_COLUMNS}
+    columns['pmra'] = np.array([b'', b'0', b'-1.5'])
+    columns['healpix8'] = np.array([b'7', b'12', b'3'])
+    expected = b''.join(b','.join(values) + b'\n' for values in zip(*(columns[name].tolist() for name in gaia_filter.PROJECTED_COLUMNS + ['healpix8'])))
+    assert gaia_filter.format_chunk(columns, [8]) == expected
+    assert gaia_filter.format_chunk({name: values[:0] for name, values in columns.items()}, [8]) == b''
+
+
+def test_filter_gz_bytes():
+    text = HEADER + '7,1.0,2.0,null,null,12.0,"True",6000.0,x\n'
+    data = gzip.compress(text.encode('utf-8'))
+    assert gaia_filter.filter_gz_bytes(data) == (b'1.0,2.0,0,0,12.0,7,1,6000.0\n', 1, 1)
+
+
+def test_healpix_columns():
+    source_id = 5 * 2**43 + 7
+    text = HEADER + f'{source_id},1.0,2.0,3.0,4.0,15.0,"False",null,x\n'
+    for parser in gaia_filter.PARSERS:
+        blocks = list(gaia_filter.PARSERS[parser](io.BytesIO(text.encode('utf-8')), healpix_levels=[8, 2]))
+        assert blocks[0][0] == f'1.0,2.0,3.0,4.0,15.0,{source_id},0,0,5,0\n'.encode('utf-8')
+    assert gaia_filter.csv_header([8, 2]).endswith(b',teff,healpix8,healpix2\n')
+    assert gaia_filter.healpix(786431 * 2**43, 8) == 786431
+    assert gaia_filter.healpix(786431 * 2**43, 2) == 191
+
+
+def test_parsers_match_with_healpix():
+    text = ','.join(synthetic_gaia.header_columns()) + '\n' + ''.join(synthetic_gaia.make_rows(2000, seed=2))
+    blocks = {}
+    for parser in gaia_filter.PARSERS:
+        blocks[parser] = b''.join(block for block, accepted, total in gaia_filter.PARSERS[parser](io.BytesIO(text.encode('utf-8')), healpix_levels=[8]))
+    assert blocks['line'] == blocks['chunk']
+
+
+def test_split_by_healpix():
+    lines = [f'1.0,2.0,0,0,15.0,{source_id},0,0\n'.encode('utf-8') for source_id in [2**55 + 1, 1, 2**55 + 2, 2]]
+    buckets = gaia_filter.split_by_healpix(b''.join(lines), 2)
+    assert buckets == [(0, lines[1] + lines[3], 2), (1, lines[0] + lines[2], 2)]
+    assert gaia_filter.split_by_healpix(b'', 2) == []
+
+
+def test_process_backend_matches_thread_backend(tmp_path):
+    path = synthetic_gaia.make_shard(str(tmp_path / 'GaiaSource_000001-000001.csv.gz'), 2000, seed=3)
+    with open(path, 'rb') as f:
+        data = f.read()
+    # Shards go to spawned workers as pickled bytes, as with --backend process
+    with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for parser in gaia_filter.PARSERS:
+            assert fetch_gaia_source.filter_shard(path, data, pool, parser, [8]) == fetch_gaia_source.filter_shard(path, data, None, parser, [8])
+
+        (shard, [columns], accepted, total, zone), size = fetch_gaia_source.filter_shard(path, data, pool, healpix_levels=[8], columns=True)
+        (expected_shard, [expected], *expected_counts), expected_size = fetch_gaia_source.filter_shard(path, data, None, healpix_levels=[8], columns=True)
+    assert 0 < accepted < total
+    assert (shard, accepted, total, zone, size) == (expected_shard, *expected_counts, expected_size)
+    assert list(columns) == list(expected)
+    for name in expected:
+        assert columns[name].dtype == expected[name].dtype
+        np.testing.assert_array_equal(columns[name], expected[name])
@@ -0,0 +1,87 @@
+import governor
+import pipeline
+
+
+class FakeStage:
+    def __init__(self, workers):
+        self.workers = workers
+
+    def resize(self, workers):
+        self.workers = workers
+        return workers
+
+
+def test_grows_while_throughput_rises_then_backs_off():
+    stage = FakeStage(2)
+    total = [0]
+    g = governor.Governor(stage, lambda: total[0], max_workers=10)
+    g.step(1.0)
+    counts = []
+    for rate in [100, 150, 200, 202, 202, 202, 202, 202, 202]:
+        total[0] += rate
+        counts.append(g.step(1.0))
+    # Up while each extra worker pays, one back when it stops paying, then hold
+    assert counts[:5] == [3, 4, 5, 4, 4]
+    assert counts[-1] == 5
+
+
+def test_sheds_workers_under_pressure_and_respects_bounds():
+    stage = FakeStage(8)
+    full = ['disk full']
+    g = governor.Governor(stage, lambda: 0, limits=[lambda: full[0] if full else None], min_workers=3, max_workers=8)
+    g.step(1.0)
+    assert g.step(1.0) == 6
+    assert g.step(1.0) == 5
+    assert g.step(1.0) == 4
+    assert g.step(1.0) == 3
+    assert g.step(1.0) == 3
+    assert stage.workers == 3
+
+
+def test_queue_limit():
+    q = pipeline.BlockQueue(max_blocks=10, max_bytes=100)
+    check = governor.queue_limit(q, 'writer')
+    assert check() is None
+    q.put('a', 90)
+    assert 'writer' in check()
+
+
+def test_stage_resize_limits_concurrency():
+    import threading
+    import time
+    in_queue = pipeline.BlockQueue()
+    running = []
+    peak = [0]
+    lock = threading.Lock()
+
+    def work(item):
+        with lock:
+            running.append(item)
+            peak[0] = max(peak[0], len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(item)
+
+    stage = pipeline.Stage('work', work, in_queue, workers=4, max_workers=4).start()
+    assert stage.resize(2) == 2
+    for i in range(20):
+        in_queue.put(i)
+    stage.stop()
+    assert peak[0] <= 2
+    assert stage.stats()['items'] == 20
+
+
+def test_stop_closes_the_postgres_connection(monkeypatch):
+    import psycopg2
+
+    class FakeConnection:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    conn = FakeConnection()
+    monkeypatch.setattr(psycopg2, 'connect', lambda dsn: conn)
+    g = governor.Governor(FakeStage(2), lambda: 0, limits=[governor.postgres_limit('dbname=gaia', 4)], interval=60).start()
+    g.stop()
+    assert conn.closed
@@ -0,0 +1,63 @@
+import pytest
+import manifest
+
+
+def test_last_record_wins_on_resume(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    progress = manifest.Manifest(path)
+    progress.record('a.csv.gz', 'started', attempt=1)
+    progress.record('a.csv.gz', 'done', accepted=5, total=10)
+    progress.record('b.csv.gz', 'started', attempt=1)
+    progress.close()
+
+    # Simulate a crash part way through writing a record
+    with open(path, 'a') as f:
+        f.write('{"shard": "c.csv')
+
+    progress = manifest.Manifest(path, resume=True)
+    assert progress.done('a.csv.gz')
+    assert not progress.done('b.csv.gz')
+    assert progress.pending(['http://host/a.csv.gz', 'http://host/b.csv.gz', 'http://host/c.csv.gz']) == ['http://host/b.csv.gz', 'http://host/c.csv.gz']
+    progress.record('b.csv.gz', 'done', accepted=1, total=2)
+    progress.close()
+
+    progress = manifest.Manifest(path, resume=True)
+    assert progress.done('b.csv.gz')
+    assert len(progress.entries('done')) == 2
+
+
+def test_with_retries(tmp_path):
+    progress = manifest.Manifest(str(tmp_path / 'manifest.jsonl'))
+    attempts = []
+
+    def flaky(value):
+        attempts.append(value)
+        if len(attempts) < 3:
+            raise IOError('connection reset')
+        return value
+
+    assert manifest.with_retries(progress, 'a.csv.gz', flaky, 42, retries=3, backoff=0) == 42
+    assert len(attempts) == 3
+    assert progress.get('a.csv.gz')['status'] == 'started'
+
+    with pytest.raises(ZeroDivisionError):
+        manifest.with_retries(progress, 'b.csv.gz', lambda: 1 / 0, retries=2, backoff=0)
+    assert progress.get('b.csv.gz')['status'] == 'failed'
+    assert progress.get('b.csv.gz')['attempt'] == 2
+
+
+def test_resume_refuses_other_settings(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    progress = manifest.Manifest(path)
+    assert progress.check_settings(sink='csv', compress='zstd') is None
+    progress.record('a.csv.gz', 'done', accepted=5, total=10)
+    progress.close()
+
+    progress = manifest.Manifest(path, resume=True)
+    assert progress.check_settings(sink='csv', compress='gzip') == f"{path} was written with compress zstd (now gzip)"
+    assert progress.check_settings(sink='csv', compress='zstd') is None
+    assert len(progress.entries()) == 1
+    progress.close()
+
+    progress = manifest.Manifest(path, resume=True)
+    assert progress.settings == {'sink': 'csv', 'compress': 'zstd'}
@@ -0,0 +1,23 @@
+import membership
+
+
+def test_contains():
+    members = membership.SourceIdSet([30, 10, 20, 10])
+    assert len(members) == 3
+    assert members.contains([5, 10, 15, 30, 40]).tolist() == [False, True, False, True, False]
+    assert membership.SourceIdSet([]).contains([1, 2]).tolist() == [False, False]
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'ids.npy')
+    membership.SourceIdSet([3, 1, 2]).save(path)
+    assert membership.SourceIdSet.load(path).ids.tolist() == [1, 2, 3]
+
+
+def test_collector_handles_ids_split_across_writes():
+    collector = membership.IdCollector()
+    text = b''.join(b'%d\n' % (i * 2**40) for i in range(1000))
+    for i in range(0, len(text), 7):
+        collector.write(text[i:i + 7])
+    assert collector.ids().tolist() == [i * 2**40 for i in range(1000)]
+
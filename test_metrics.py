@@ -0,0 +1,72 @@
+import io
+import json
+import time
+import metrics
+
+
+def test_nested_stages_count_self_time():
+    m = metrics.Metrics()
+    with m.stage('outer'):
+        time.sleep(0.05)
+        with m.stage('inner'):
+            time.sleep(0.1)
+    stages = m.snapshot()['stages']
+    assert stages['inner']['seconds'] >= 0.1
+    assert 0.05 <= stages['outer']['seconds'] < 0.1
+    assert stages['outer']['calls'] == 1
+
+
+def test_counters_progress_and_eta():
+    m = metrics.Metrics(total=10)
+    m.started -= 10
+    m.count('rows', 5)
+    m.count('rows', 7)
+    m.advance(2)
+    m.gauge('depth', lambda: 3)
+    snapshot = m.snapshot()
+    assert snapshot['counters'] == {'rows': 12}
+    assert snapshot['done'] == 2
+    assert 39 < snapshot['eta'] < 41
+    assert snapshot['gauges'] == {'depth': 3}
+
+
+def test_reader_counts_bytes_and_lines():
+    m = metrics.Metrics()
+    reader = m.reader(io.BytesIO(b'a,b\n1,2\n3,4\n'), 'gunzip', 'bytes')
+    assert next(reader) == b'a,b\n'
+    assert list(reader) == [b'1,2\n', b'3,4\n']
+    assert reader.read() == b''
+    snapshot = m.snapshot()
+    assert snapshot['counters']['bytes'] == 12
+    assert snapshot['stages']['gunzip']['calls'] == 5
+
+
+def test_snapshots_and_prometheus_textfile(tmp_path):
+    path = tmp_path / 'metrics.jsonl'
+    prometheus = tmp_path / 'ingest.prom'
+    m = metrics.Metrics(job='test', total=4, path=str(path), prometheus=str(prometheus), interval=0.05).start()
+    with m.stage('copy'):
+        m.count('rows_written', 100)
+    m.advance()
+    time.sleep(0.2)
+    final = m.stop()
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) >= 2
+    assert lines[-1] == final
+    assert final['counters'] == {'rows_written': 100}
+    text = prometheus.read_text()
+    assert 'gaia_ingest_count_total{job="test",name="rows_written"} 100' in text
+    assert 'gaia_ingest_stage_calls_total{job="test",stage="copy"} 1' in text
+    assert 'gaia_ingest_total{job="test"} 4' in text
+
+
+def test_options_from_the_command_line(tmp_path):
+    import argparse
+    parser = argparse.ArgumentParser()
+    metrics.add_arguments(parser, "job_metrics.jsonl")
+    args = parser.parse_args(["--metrics-interval", "5"])
+    m = metrics.from_args(args, 'job', 'pixels', 10, str(tmp_path))
+    assert m.path == str(tmp_path / "job_metrics.jsonl")
+    assert (m.job, m.unit, m.total, m.prometheus, m.interval) == ('job', 'pixels', 10, None, 5)
+    assert metrics.get() is m
@@ -0,0 +1,49 @@
+import numpy as np
+import columnar
+import gaia_filter
+import partition_join
+import staging
+import zonemap
+
+PIXEL = gaia_filter.HEALPIX8_DIVISOR
+
+
+def csv_block(source_ids, xp):
+    return b''.join(b'1.0,2.0,null,null,12.0,%d,%d,null\n' % (source_id, flag) for source_id, flag in zip(source_ids, xp))
+
+
+def write_staging_file(path, shards, codec):
+    # A csv staging file holding each shard as its own member, with its sidecar
+    entries = []
+    with open(path, 'wb') as f:
+        f.write(staging.compress(b'ra,dec,pmra,pmdec,phot_g_mean_mag,source_id,has_xp_sampled,teff\n', codec))
+        for name, source_ids, xp in shards:
+            block = csv_block(source_ids, xp)
+            offset = f.tell()
+            f.write(staging.compress(block, codec))
+            entries.append({'shard': name, 'offset': offset, 'length': f.tell() - offset, 'zone': zonemap.from_csv(block)})
+    zonemap.write_sidecar(path, entries)
+
+
+def test_members_come_from_overlapping_pieces(tmp_path):
+    directory = str(tmp_path)
+    write_staging_file(str(tmp_path / 'data1.csv.gz'), [
+        ('GaiaSource_000000-000001.csv.gz', [5, PIXEL + 3, PIXEL + 1], [1, 1, 0]),
+        ('GaiaSource_000002-000003.csv.gz', [2 * PIXEL + 1, 3 * PIXEL], [1, 1]),
+    ], 'gzip')
+    write_staging_file(str(tmp_path / 'data2.csv'), [
+        ('GaiaSource_000004-000004.csv.gz', [4 * PIXEL + 7], [0]),
+    ], 'none')
+    source_id = np.array([5 * PIXEL + 2, 5 * PIXEL + 9], dtype=np.int64)
+    columns = {'source_id': source_id, 'phot_g_mean_mag': np.array([10, 11], dtype=np.float32),
+               'has_xp_sampled': np.array([True, False])}
+    columnar.save_shard(directory, 'GaiaSource_000005-000005.csv.gz', columns, zone=zonemap.from_columns(columns))
+
+    shards = partition_join.StarShards(directory)
+    # The piece without any XP spectra is left out
+    assert len(shards) == 3
+    assert shards.members('XpSampledMeanSpectrum_000000-000001.csv.gz').ids.tolist() == [5, PIXEL + 3]
+    assert shards.members('XpSampledMeanSpectrum_000001-000002.csv.gz').ids.tolist() == [PIXEL + 3, 2 * PIXEL + 1]
+    assert shards.members('XpSampledMeanSpectrum_000004-000005.csv.gz').ids.tolist() == [5 * PIXEL + 2]
+    assert len(shards.overlapping(0, PIXEL - 1)) == 1
+    assert len(shards.members('spectra.csv.gz')) == 5
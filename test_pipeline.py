@@ -0,0 +1,114 @@
+import threading
+import pipeline
+
+
+def test_block_queue_fifo():
+    q = pipeline.BlockQueue(max_blocks=4, max_bytes=100)
+    for i in range(3):
+        q.put(i, 10)
+    assert [q.get() for i in range(3)] == [0, 1, 2]
+    stats = q.stats()
+    assert stats['puts'] == 3
+    assert stats['peak_blocks'] == 3
+    assert stats['peak_bytes'] == 30
+    assert stats['bytes'] == 0
+
+
+def test_block_queue_memory_ceiling_blocks_producer():
+    q = pipeline.BlockQueue(max_blocks=10, max_bytes=100)
+    q.put('a', 80)
+    done = threading.Event()
+
+    def producer():
+        q.put('b', 80)
+        done.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    assert not done.wait(0.2)
+    assert q.get() == 'a'
+    assert done.wait(5)
+    thread.join()
+    assert q.get() == 'b'
+    assert q.stats()['put_wait'] > 0
+
+
+def test_block_queue_lets_oversized_block_through_when_empty():
+    q = pipeline.BlockQueue(max_blocks=10, max_bytes=10)
+    q.put('big', 1000)
+    assert q.get() == 'big'
+
+
+def test_stage_passes_results_on_and_reports_errors():
+    in_queue = pipeline.BlockQueue()
+    out_queue = pipeline.BlockQueue()
+    failed = []
+
+    def double(item):
+        if item == 3:
+            raise ValueError('bad item')
+        return item * 2, 1
+
+    stage = pipeline.Stage('double', double, in_queue, out_queue, workers=2, on_error=lambda item, e: failed.append(item)).start()
+    for i in range(5):
+        in_queue.put(i)
+    stage.stop()
+
+    assert sorted(out_queue.get() for i in range(4)) == [0, 2, 4, 8]
+    assert failed == [3]
+    stats = stage.stats()
+    assert stats['items'] == 5
+    assert stats['errors'] == 1
+    assert 0 <= stats['utilisation'] <= 1
+
+
+def test_block_queue_get_batch_stops_at_none():
+    q = pipeline.BlockQueue()
+    for item in [1, 2, 3, None, 4]:
+        q.put(item, 10)
+    assert q.get_batch(2) == [1, 2]
+    assert q.get_batch(5) == [3]
+    assert q.get_batch(5) is None
+    assert q.get_batch(5) == [4]
+    assert q.stats()['bytes'] == 0
+
+
+def test_stage_batches_waiting_items():
+    in_queue = pipeline.BlockQueue()
+    batches = []
+    for i in range(5):
+        in_queue.put(i)
+    stage = pipeline.Stage('batch', batches.append, in_queue, batch=3).start()
+    stage.stop()
+    assert batches == [[0, 1, 2], [3, 4]]
+
+
+def test_failed_queue_releases_producers_and_stops_stages():
+    url_queue = pipeline.BlockQueue()
+    out_queue = pipeline.BlockQueue(max_blocks=1)
+    stage = pipeline.Stage('produce', lambda item: (item, 1), url_queue, out_queue).start()
+    for i in range(20):
+        url_queue.put(i)
+    # Nobody reads out_queue, so the stage can get no further than its second item
+    out_queue.fail(OSError('disk full'))
+    stage.stop()
+    assert stage.stats()['items'] <= 2
+    assert isinstance(url_queue.failed(), OSError)
+    assert out_queue.get() is None
+    out_queue.put('dropped')
+    assert out_queue.qsize() == 0
+
+
+def test_stage_starts_threads_only_as_it_grows():
+    in_queue = pipeline.BlockQueue()
+    stage = pipeline.Stage('grow', lambda item: None, in_queue, workers=2, max_workers=64).start()
+    assert len(stage.threads) == 2
+    assert stage.resize(5) == 5
+    assert len(stage.threads) == 5
+    stage.resize(1)
+    assert len(stage.threads) == 5
+    for i in range(10):
+        in_queue.put(i)
+    stage.stop()
+    assert stage.stats()['items'] == 10
+    assert not any(thread.is_alive() for thread in stage.threads)
@@ -0,0 +1,81 @@
+import argparse
+import os
+import pytest
+import fetch_gaia_source
+import metrics
+import process_one_gaia
+import sinks
+import synthetic_gaia
+
+
+def batch_args(output_dir, **kwargs):
+    args = dict(output_dir=output_dir, workers=2, healpix_levels=[8], manifest='manifest.jsonl', resume=False,
+                metrics='metrics.jsonl', metrics_interval=metrics.INTERVAL, prometheus=None, delete=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_expand_paths(tmp_path):
+    for name in ['GaiaSource_000001-000002.csv.gz', 'GaiaSource_000003-000004.csv.gz', 'notes.txt']:
+        (tmp_path / name).write_bytes(b'')
+    first = str(tmp_path / 'GaiaSource_000001-000002.csv.gz')
+    assert process_one_gaia.expand_paths([str(tmp_path), first]) == [first, str(tmp_path / 'GaiaSource_000003-000004.csv.gz')]
+    assert process_one_gaia.expand_paths([str(tmp_path / '*0001-*.csv.gz')]) == [first]
+
+
+def test_batch_keeps_inputs_and_existing_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_one_gaia, 'data_queue', process_one_gaia.pipeline.BlockQueue())
+    mirror = tmp_path / 'mirror'
+    output = tmp_path / 'staging'
+    mirror.mkdir()
+    output.mkdir()
+    (output / 'data1.csv').write_bytes(b'earlier run\n')
+    paths = [synthetic_gaia.make_shard(str(mirror / f'GaiaSource_00000{i}-00000{i}.csv.gz'), 300, seed=i) for i in range(3)]
+
+    process_one_gaia.process_batch(paths, batch_args(str(output)))
+
+    assert all(os.path.exists(path) for path in paths)
+    assert (output / 'data1.csv').read_bytes() == b'earlier run\n'
+    lines = (output / 'data2.csv').read_bytes().splitlines()
+    assert lines[0] == b'ra,dec,pmra,pmdec,phot_g_mean_mag,source_id,has_xp_sampled,teff,healpix8'
+    assert 0 < len(lines) - 1 < 900
+    assert os.path.exists(output / 'data2.csv.zone.json')
+
+
+def test_batch_delete_removes_processed_inputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_one_gaia, 'data_queue', process_one_gaia.pipeline.BlockQueue())
+    path = synthetic_gaia.make_shard(str(tmp_path / 'GaiaSource_000001-000001.csv.gz'), 100)
+    process_one_gaia.process_batch([path], batch_args(str(tmp_path / 'staging'), workers=1, delete=True))
+    assert not os.path.exists(path)
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_batch_stops_and_exits_non_zero_when_writer_dies(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_one_gaia, 'data_queue', process_one_gaia.pipeline.BlockQueue(max_blocks=1))
+
+    def disk_full(*args, **kwargs):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(sinks, 'open_output', disk_full)
+    paths = [synthetic_gaia.make_shard(str(tmp_path / f'GaiaSource_00000{i}-00000{i}.csv.gz'), 100, seed=i) for i in range(4)]
+    with pytest.raises(SystemExit) as exit_info:
+        process_one_gaia.process_batch(paths, batch_args(str(tmp_path / 'staging'), workers=1, delete=True))
+    assert exit_info.value.code == 1
+    assert all(os.path.exists(path) for path in paths)
+
+
+def test_filter_local_shard_matches_downloaded_path(tmp_path):
+    path = synthetic_gaia.make_shard(str(tmp_path / 'GaiaSource_000001-000001.csv.gz'), 200)
+    with open(path, 'rb') as f:
+        expected = fetch_gaia_source.filter_shard(path, f.read(), healpix_levels=[8])
+    assert process_one_gaia.filter_local_shard(path, healpix_levels=[8]) == expected
+
+
+def test_process_file_removes_the_shard_unless_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_one_gaia, 'data_queue', process_one_gaia.pipeline.BlockQueue())
+    kept = synthetic_gaia.make_shard(str(tmp_path / 'GaiaSource_000001-000001.csv.gz'), 50)
+    removed = synthetic_gaia.make_shard(str(tmp_path / 'GaiaSource_000002-000002.csv.gz'), 50, seed=1)
+    process_one_gaia.process_file(kept, delete=False)
+    process_one_gaia.process_file(removed)
+    assert os.path.exists(kept)
+    assert not os.path.exists(removed)
@@ -0,0 +1,229 @@
+import gzip
+import os
+import threading
+import psycopg2
+import pytest
+import gaia_filter
+import pipeline
+import manifest
+import sinks
+import staging
+
+
+class FakeCursor:
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+
+    def copy_expert(self, sql, file):
+        self.copied.append((sql, file.read()))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.cursor_ = FakeCursor()
+        self.commits = 0
+
+    def cursor(self):
+        return self.cursor_
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_write_csv_records_offsets(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    progress = manifest.Manifest('manifest.jsonl')
+    data_queue = pipeline.BlockQueue()
+    data_queue.put(('a.csv.gz', [b'1,2\n', b'3,4\n'], 2, 5, None))
+    data_queue.put(('b.csv.gz', [b'5,6\n'], 1, 1, None))
+    data_queue.put(None)
+    sinks.write_csv(data_queue, progress)
+
+    with open('data1.csv', 'rb') as f:
+        data = f.read()
+    entry = progress.get('b.csv.gz')
+    assert data[entry['offset']:entry['offset'] + entry['length']] == b'5,6\n'
+    assert progress.get('a.csv.gz')['accepted'] == 2
+
+
+def test_write_csv_resume_truncates_partial_shard(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    progress = manifest.Manifest('manifest.jsonl')
+    data_queue = pipeline.BlockQueue()
+    data_queue.put(('a.csv.gz', [b'1,2\n'], 1, 1, None))
+    data_queue.put(None)
+    sinks.write_csv(data_queue, progress)
+    progress.close()
+    with open('data1.csv', 'ab') as f:
+        f.write(b'partial')
+
+    progress = manifest.Manifest('manifest.jsonl', resume=True)
+    data_queue.put(('b.csv.gz', [b'3,4\n'], 1, 1, None))
+    data_queue.put(None)
+    sinks.write_csv(data_queue, progress)
+    with open('data1.csv', 'rb') as f:
+        assert f.read().split(b'\n', 1)[1] == b'1,2\n3,4\n'
+
+
+def test_compressed_csv_is_one_gzip_member_per_shard(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    progress = manifest.Manifest('manifest.jsonl')
+    write_queue = pipeline.BlockQueue()
+    write_queue.put(*sinks.compress_shard(('a.csv.gz', [b'1,2\n', b'3,4\n'], 2, 5, None), 'gzip'))
+    write_queue.put(*sinks.compress_shard(('b.csv.gz', [b'5,6\n'], 1, 1, None), 'gzip'))
+    write_queue.put(None)
+    sinks.write_csv(write_queue, progress, ['x', 'y'], 'gzip')
+
+    with staging.open_staging('data1.csv.gz') as f:
+        assert f.read() == b'x,y\n1,2\n3,4\n5,6\n'
+    with open('data1.csv.gz', 'rb') as f:
+        data = f.read()
+    entry = progress.get('b.csv.gz')
+    assert gzip.decompress(data[entry['offset']:entry['offset'] + entry['length']]) == b'5,6\n'
+
+
+def test_copy_to_database_clears_shard_range_only_on_retry(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    progress = manifest.Manifest(path)
+    conn = FakeConnection()
+    data_queue = pipeline.BlockQueue()
+    data_queue.put(('GaiaSource_000000-003111.csv.gz', [b'1,2\n'], 1, 1, None))
+    data_queue.put(None)
+    sinks.copy_to_database(data_queue, progress, conn)
+
+    # Nothing can be in stars for a shard never copied before
+    assert conn.cursor_.statements == []
+    assert conn.cursor_.copied[0][1] == b'1,2\n'
+    assert conn.commits == 1
+    assert progress.done('GaiaSource_000000-003111.csv.gz')
+
+    # A resumed run retrying a shard that got as far as COPY clears its range first
+    progress.record('GaiaSource_003112-006223.csv.gz', 'copying')
+    progress.record('GaiaSource_003112-006223.csv.gz', 'failed', error='server closed the connection')
+    progress.close()
+    progress = manifest.Manifest(path, resume=True)
+    progress.record('GaiaSource_003112-006223.csv.gz', 'started', attempt=1)
+    conn = FakeConnection()
+    data_queue = pipeline.BlockQueue()
+    data_queue.put(('GaiaSource_003112-006223.csv.gz', [b'3,4\n'], 1, 1, None))
+    data_queue.put(None)
+    sinks.copy_to_database(data_queue, progress, conn)
+
+    sql, params = conn.cursor_.statements[0]
+    assert sql.startswith('DELETE FROM stars')
+    assert params == (3112 * 2**43, 6224 * 2**43 - 1)
+    assert conn.cursor_.copied[0][1] == b'3,4\n'
+    assert progress.done('GaiaSource_003112-006223.csv.gz')
+
+
+def test_failed_sink_releases_producers(tmp_path):
+    progress = manifest.Manifest(str(tmp_path / 'manifest.jsonl'))
+    data_queue = pipeline.BlockQueue(max_blocks=1)
+    data_queue.put(('a.csv.gz', [b'1,2\n'], 1, 1, None))
+    producer = threading.Thread(target=data_queue.put, args=(('b.csv.gz', [b'3,4\n'], 1, 1, None),))
+    producer.start()
+
+    # The output directory doesn't exist, so the writer dies opening its first file
+    with pytest.raises(FileNotFoundError):
+        sinks.write_csv(data_queue, progress, directory=str(tmp_path / 'missing'))
+    producer.join(5)
+    assert not producer.is_alive()
+    assert isinstance(data_queue.failed(), FileNotFoundError)
+    assert not progress.done('a.csv.gz')
+
+
+def test_copy_to_database_lost_connection_fails_queue(tmp_path):
+    progress = manifest.Manifest(str(tmp_path / 'manifest.jsonl'))
+    conn = FakeConnection()
+
+    def lost(sql, file):
+        raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def rollback():
+        raise psycopg2.InterfaceError('connection already closed')
+
+    conn.cursor_.copy_expert = lost
+    conn.rollback = rollback
+    data_queue = pipeline.BlockQueue()
+    data_queue.put(('a.csv.gz', [b'1,2\n'], 1, 1, None))
+    data_queue.put(('b.csv.gz', [b'3,4\n'], 1, 1, None))
+    with pytest.raises(psycopg2.OperationalError):
+        sinks.copy_to_database(data_queue, progress, conn)
+    assert progress.get('a.csv.gz')['status'] == 'failed'
+    assert isinstance(data_queue.failed(), psycopg2.OperationalError)
+    assert data_queue.get() is None
+
+
+def star(source_id):
+    return f'1.0,2.0,0,0,15.0,{source_id},0,0,{source_id >> 43}\n'.encode('utf-8')
+
+
+def test_write_buckets_partitions_by_healpix(tmp_path):
+    progress = manifest.Manifest(str(tmp_path / 'manifest.jsonl'))
+    directory = str(tmp_path / 'buckets')
+    data_queue = pipeline.BlockQueue()
+    data_queue.put(('a.csv.gz', [star(1) + star(2**55 + 1)], 2, 2, None))
+    data_queue.put(('b.csv.gz', [star(2)], 1, 1, None))
+    data_queue.put(None)
+    sinks.write_buckets(data_queue, progress, 2, gaia_filter.output_columns([8]), directory)
+
+    with open(sinks.bucket_file_name(directory, 2, 0), 'rb') as f:
+        assert f.read() == gaia_filter.csv_header([8]) + star(1) + star(2)
+    with open(sinks.bucket_file_name(directory, 2, 1), 'rb') as f:
+        assert f.read() == gaia_filter.csv_header([8]) + star(2**55 + 1)
+    assert [output[3] for output in progress.get('a.csv.gz')['outputs']] == [1, 1]
+
+
+def test_write_buckets_resume_drops_partial_shards(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    directory = str(tmp_path / 'buckets')
+    progress = manifest.Manifest(path)
+    data_queue = pipeline.BlockQueue()
+    data_queue.put(('a.csv.gz', [star(1)], 1, 1, None))
+    data_queue.put(None)
+    sinks.write_buckets(data_queue, progress, 2, directory=directory)
+    progress.close()
+
+    # A crash left half a shard behind in an existing bucket and a new one
+    with open(sinks.bucket_file_name(directory, 2, 0), 'ab') as f:
+        f.write(b'partial')
+    with open(sinks.bucket_file_name(directory, 2, 5), 'wb') as f:
+        f.write(b'partial')
+
+    progress = manifest.Manifest(path, resume=True)
+    data_queue.put(None)
+    sinks.write_buckets(data_queue, progress, 2, directory=directory)
+    with open(sinks.bucket_file_name(directory, 2, 0), 'rb') as f:
+        assert f.read().endswith(star(1))
+    assert not os.path.exists(sinks.bucket_file_name(directory, 2, 5))
+
+
+def test_compressed_staging_files_read_line_by_line(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for codec in ['gzip', 'zstd', 'lz4']:
+        if not staging.available(codec):
+            continue
+        os.makedirs(codec)
+        progress = manifest.Manifest(f'manifest_{codec}.jsonl')
+        write_queue = pipeline.BlockQueue()
+        write_queue.put(*sinks.compress_shard(('a.csv.gz', [b'1,2\n', b'3,4\n'], 2, 2, None), codec))
+        write_queue.put(*sinks.compress_shard(('b.csv.gz', [b'5,6\n'], 1, 1, None), codec))
+        write_queue.put(None)
+        sinks.write_csv(write_queue, progress, ['x', 'y'], codec, directory=codec)
+
+        with staging.open_staging(sinks.output_name(1, codec, codec)) as f:
+            assert f.readline() == b'x,y\n'
+            assert list(f) == [b'1,2\n', b'3,4\n', b'5,6\n']
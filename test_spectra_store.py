@@ -0,0 +1,140 @@
+import gzip
+import numpy as np
+import pytest
+import membership
+import spectra_store
+import synthetic_gaia
+import xp_spectra
+
+
+def rows_for(source_ids, width=5):
+    # Catalogue form rows whose bytes identify the source_id they belong to
+    source_ids = np.asarray(source_ids, dtype=np.int64)
+    return (source_ids[:, None] + np.arange(width)).astype(np.uint8)
+
+
+def test_merge_and_lookup(tmp_path):
+    directory = str(tmp_path)
+    spectra_store.write_segment(directory, 'b.csv.gz', np.array([50, 40]), rows_for([50, 40]))
+    spectra_store.write_segment(directory, 'a.csv.gz', np.array([30, 10, 20]), rows_for([30, 10, 20]))
+    spectra_store.write_segment(directory, 'c.csv.gz', np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.uint8))
+    assert spectra_store.merge(directory) == 5
+
+    store = spectra_store.SpectraStore(directory)
+    assert len(store) == 5
+    assert store.source_ids.tolist() == [10, 20, 30, 40, 50]
+    assert store.lookup([40, 15, 10, 60]).tolist() == [3, -1, 0, -1]
+    assert (store.get_flux([50, 10]) == rows_for([50, 10])).all()
+    with pytest.raises(KeyError):
+        store.get_flux([10, 15])
+
+
+def test_merge_sorts_overlapping_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(spectra_store, 'MERGE_ROWS', 2)
+    directory = str(tmp_path)
+    spectra_store.write_segment(directory, 'a.csv.gz', np.array([10, 30, 50]), rows_for([10, 30, 50]))
+    spectra_store.write_segment(directory, 'b.csv.gz', np.array([20, 40]), rows_for([20, 40]))
+    assert spectra_store.merge(directory, remove_segments=True) == 5
+    assert spectra_store.list_segments(directory) == []
+
+    store = spectra_store.SpectraStore(directory)
+    assert store.source_ids.tolist() == [10, 20, 30, 40, 50]
+    assert (store.flux[:] == rows_for([10, 20, 30, 40, 50])).all()
+
+
+def test_empty_store(tmp_path):
+    directory = str(tmp_path)
+    assert spectra_store.merge(directory) == 0
+    store = spectra_store.SpectraStore(directory)
+    assert store.lookup([1]).tolist() == [-1]
+
+
+def test_clean_removes_partial_segments(tmp_path):
+    directory = str(tmp_path)
+    spectra_store.write_segment(directory, 'a.csv.gz', np.array([1]), rows_for([1]))
+    (tmp_path / spectra_store.SEGMENTS / 'b.tmp').mkdir()
+    spectra_store.clean(directory)
+    assert [path.split('/')[-1] for path in spectra_store.list_segments(directory)] == ['a']
+    assert not (tmp_path / spectra_store.SEGMENTS / 'b.tmp').exists()
+
+
+def test_load_shard_matches_export_flux(tmp_path):
+    file_path = synthetic_gaia.make_spectra_shard(str(tmp_path / 'XpSampledMeanSpectrum_1.csv.gz'), 20)
+    with gzip.open(file_path, mode='rb') as file:
+        source_ids, flux, rows = spectra_store.load_shard(file)
+    assert rows == 20
+    assert flux.shape == (20, 1 + 2 * synthetic_gaia.SPECTRA_SAMPLES)
+
+    with gzip.open(file_path, mode='rb') as file:
+        expected_ids, expected_flux, rows = xp_spectra.parse_chunk(b''.join(xp_spectra.read_chunks(file)))
+    assert source_ids.tolist() == expected_ids.tolist()
+    assert (flux == xp_spectra.export_flux(expected_flux)).all()
+    assert np.allclose(spectra_store.decode_flux(flux), expected_flux, rtol=1e-3)
+
+    members = membership.SourceIdSet(expected_ids[::2])
+    with gzip.open(file_path, mode='rb') as file:
+        source_ids, flux, rows = spectra_store.load_shard(file, members)
+    assert rows == 20
+    assert source_ids.tolist() == expected_ids[::2].tolist()
+
+
+class FakeCursor:
+    # Answers the queries generate-photometry.py makes for one chunk of two pixels
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        if 'order by healpix8 asc' in sql:
+            self.rows = [(min(self.pixels),)]
+        elif 'order by healpix8 desc' in sql:
+            self.rows = [(max(self.pixels),)]
+        elif 'FROM stars' in sql:
+            self.rows = [(source_id, 1.0, 2.0, None, None, 12.0, None) for source_id in self.pixels[params[0]]]
+        else:
+            self.rows = [(source_id,) for source_id in self.pixels[params[0]]]
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, pixels):
+        self.pixels = pixels
+
+    def cursor(self):
+        return FakeCursor(self.pixels)
+
+
+def test_photometry_export_leaves_out_stars_missing_from_store(tmp_path, monkeypatch):
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('generate_photometry', 'generate-photometry.py')
+    generate_photometry = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generate_photometry)
+
+    directory = str(tmp_path)
+    spectra_store.write_segment(directory, 'a.csv.gz', np.array([10, 20]), rows_for([10, 20]))
+    spectra_store.merge(directory)
+    monkeypatch.setattr(generate_photometry, 'spectra', spectra_store.SpectraStore(directory))
+    monkeypatch.setattr(generate_photometry, 'dataquery', generate_photometry.DATAQUERY.format(flux='NULL'))
+
+    # Star 15 has no spectrum, so it is neither counted in the index nor written
+    path = tmp_path / 'chunk.dat'
+    with open(path, 'wb+') as f:
+        generate_photometry.writeDataRecords(f, FakeConnection({0: [10, 15], 1: [20]}), 0)
+    data = path.read_bytes()
+    header_size = 128
+    assert np.frombuffer(data[header_size:header_size + 8], dtype=np.uint32).tolist() == [1, 2]
+    records = data[header_size + 8:]
+    assert len(records) == 2 * (14 + 5)
+    assert records[14:19] == rows_for([10]).tobytes()
+    assert records[33:38] == rows_for([20]).tobytes()
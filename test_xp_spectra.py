@@ -0,0 +1,109 @@
+import gzip
+import io
+import struct
+import numpy as np
+import membership
+import synthetic_gaia
+import xp_spectra
+
+TEXT = ('# comment\n'
+        'source_id,solution_id,ra,dec,flux,flux_error\n'
+        '1,9,1.0,2.0,"[1.0,2.5E-17]","[0.1,0.2]"\n'
+        '2,9,1.0,2.0,"[3.0,4.0]","[0.1,0.2]"\n'
+        '3,9,1.0,2.0,"[5.0,null]","[0.1,0.2]"\n').encode('utf-8')
+
+
+def parse_copy(stream):
+    # Decode a COPY binary stream of (bigint, real[]) rows
+    assert stream.startswith(xp_spectra.COPY_HEADER)
+    position = len(xp_spectra.COPY_HEADER)
+    rows = []
+    while True:
+        fields, = struct.unpack_from('>h', stream, position)
+        position += 2
+        if fields == -1:
+            break
+        length, source_id = struct.unpack_from('>iq', stream, position)
+        position += 12
+        length, ndim, has_null, element_type, dim, lower_bound = struct.unpack_from('>iiiIii', stream, position)
+        position += 24
+        values = struct.unpack_from('>' + 'if' * dim, stream, position)[1::2]
+        position += 8 * dim
+        assert (ndim, element_type, lower_bound) == (1, xp_spectra.FLOAT4OID, 1)
+        rows.append((source_id, values))
+    assert position == len(stream)
+    return rows
+
+
+def test_copy_stream_round_trip_with_members_and_nulls():
+    counts = {}
+    members = membership.SourceIdSet([1, 3])
+    stream = xp_spectra.StreamReader(xp_spectra.copy_blocks(io.BytesIO(TEXT), members, counts)).read()
+    rows = parse_copy(stream)
+    assert [source_id for source_id, values in rows] == [1, 3]
+    assert rows[0][1] == (1.0, np.float32(2.5e-17))
+    assert rows[1][1][0] == 5.0 and np.isnan(rows[1][1][1])
+    assert counts == {'read': 3, 'kept': 2}
+
+
+def test_vectorized_parse_matches_line_parse(tmp_path):
+    path = synthetic_gaia.make_spectra_shard(str(tmp_path / 'XpSampledMeanSpectrum_000000-003111.csv.gz'), 50)
+    with gzip.open(path, 'rb') as f:
+        chunks = list(xp_spectra.read_chunks(f, chunk_bytes=20_000))
+    assert len(chunks) > 1
+    for buf in chunks:
+        source_ids, flux, rows = xp_spectra.parse_chunk(buf)
+        line_ids, line_flux, line_rows = xp_spectra.parse_lines(buf)
+        assert flux.shape == (rows, synthetic_gaia.SPECTRA_SAMPLES)
+        assert np.array_equal(source_ids, line_ids)
+        assert np.array_equal(flux, line_flux)
+
+
+def test_stream_reader_sizes():
+    reader = xp_spectra.StreamReader([b'abc', b'', b'defg'])
+    assert reader.read(2) == b'ab'
+    assert reader.read(3) == b'cde'
+    assert reader.read() == b'fg'
+    assert reader.read(5) == b''
+
+
+def load_generate_photometry():
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('generate_photometry', 'generate-photometry.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_export_flux_matches_catalogue_writer():
+    generate_photometry = load_generate_photometry()
+    rng = np.random.default_rng(5)
+    flux = (rng.uniform(-0.1, 2.0, size=(4, synthetic_gaia.SPECTRA_SAMPLES)) * np.array([[1e-17], [3e-16], [1e-15], [7e-19]])).astype(np.float32)
+    exported = xp_spectra.export_flux(flux)
+    for row, values in zip(exported, flux):
+        expected = io.BytesIO()
+        generate_photometry.writeDataElement(expected, (0, 0.0, 0.0, None, None, None, [float(value) for value in values]))
+        written = io.BytesIO()
+        generate_photometry.writeDataElement(written, (0, 0.0, 0.0, None, None, None, row.tobytes()))
+        assert written.getvalue() == expected.getvalue()
+        assert len(row) == 1 + 2 * synthetic_gaia.SPECTRA_SAMPLES
+
+
+def test_float16_copy_stream():
+    stream = xp_spectra.StreamReader(xp_spectra.copy_blocks(io.BytesIO(TEXT), flux_format='float16')).read()
+    position = len(xp_spectra.COPY_HEADER)
+    fields, length, source_id, payload_length = struct.unpack_from('>hiqi', stream, position)
+    assert (fields, length, source_id, payload_length) == (2, 8, 1, 5)
+    payload = stream[position + 18:position + 18 + payload_length]
+    assert payload[0] == 0
+    assert np.frombuffer(payload[1:], dtype='<f2').tolist() == [1.0, np.float16(2.5e-17)]
+
+
+def test_text_blocks_keep_source_id_and_flux():
+    counts = {}
+    members = membership.SourceIdSet([1, 3])
+    csv = b''.join(xp_spectra.text_blocks(io.BytesIO(TEXT + b'4,9,1.0,2.0,,\n'), members, counts))
+    assert csv == b'1,"{1.0,2.5E-17}"\n3,"{5.0,null}"\n'
+    assert counts == {'read': 4, 'kept': 2}
+    csv = b''.join(xp_spectra.text_blocks(io.BytesIO(TEXT + b'4,9,1.0,2.0,,\n')))
+    assert csv.endswith(b'4,\n')
@@ -0,0 +1,111 @@
+import io
+import json
+import os
+import numpy as np
+import columnar
+import gaia_filter
+import manifest
+import pipeline
+import sinks
+import synthetic_gaia
+import zonemap
+
+
+def star(source_id, mag=15.0, xp=0):
+    return f'1.0,2.0,0,0,{mag},{source_id},{xp},0,{source_id >> 43}\n'.encode('utf-8')
+
+
+def test_from_csv_and_merge():
+    zone = zonemap.from_csv(star(5 * 2**43, 12.5, 1) + star(7 * 2**43 + 3, 18.0))
+    assert zone == {'rows': 2, 'source_id': [5 * 2**43, 7 * 2**43 + 3], 'healpix8': [5, 7],
+                    'phot_g_mean_mag': [12.5, 18.0], 'has_xp_sampled': 1}
+    merged = zonemap.merge([zone, zonemap.empty(), zonemap.from_csv(star(2**43, 9.0))])
+    assert merged['rows'] == 3
+    assert merged['healpix8'] == [1, 7]
+    assert merged['phot_g_mean_mag'] == [9.0, 18.0]
+
+
+def test_columns_zone_matches_csv_zone():
+    text = ','.join(synthetic_gaia.header_columns()) + '\n' + ''.join(synthetic_gaia.make_rows(1000, seed=2))
+    csv = b''.join(block for block, accepted, total in gaia_filter.filter_chunks(io.BytesIO(text.encode('utf-8'))))
+    chunks = [columns for columns, accepted, total in gaia_filter.filter_columns(io.BytesIO(text.encode('utf-8')))]
+    csv_zone = zonemap.from_csv(csv)
+    columns_zone = zonemap.from_columns(gaia_filter.concat_columns(chunks))
+    assert csv_zone['rows'] == columns_zone['rows'] > 0
+    assert csv_zone['source_id'] == columns_zone['source_id']
+    assert csv_zone['has_xp_sampled'] == columns_zone['has_xp_sampled']
+    assert abs(csv_zone['phot_g_mean_mag'][0] - columns_zone['phot_g_mean_mag'][0]) < 1e-4
+
+
+def test_overlaps():
+    zone = zonemap.from_csv(star(100 * 2**43, 14.0) + star(200 * 2**43, 16.0))
+    assert zonemap.overlaps(zone, zonemap.pixel_source_ids(150, 160))
+    assert not zonemap.overlaps(zone, zonemap.pixel_source_ids(201, 300))
+    assert zonemap.overlaps(zone, zonemap.pixel_source_ids(0, 0, level=2))
+    assert not zonemap.overlaps(zone, mag=(None, 13.0))
+    assert zonemap.overlaps(zone, mag=(15.0, None))
+    assert not zonemap.overlaps(zone, xp=True)
+    assert not zonemap.overlaps(zonemap.empty())
+
+
+def test_csv_sidecars_select_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sinks, 'LINES_PER_FILE', 1)
+    progress = manifest.Manifest('manifest.jsonl')
+    data_queue = pipeline.BlockQueue()
+    for shard, block in [('a.csv.gz', star(10 * 2**43, 11.0)), ('b.csv.gz', star(20 * 2**43, 17.0))]:
+        data_queue.put((shard, [block], 1, 1, zonemap.from_csv(block)))
+    data_queue.put(('c.csv.gz', [star(30 * 2**43)], 1, 1, None))
+    data_queue.put(None)
+    sinks.write_csv(data_queue, progress)
+
+    with open('data1.csv.zone.json') as f:
+        sidecar = json.load(f)
+    assert sidecar['zone']['healpix8'] == [10, 10]
+    assert sidecar['shards'][0]['shard'] == 'a.csv.gz'
+    # data3.csv holds a shard without a zone so it is never skipped
+    assert not os.path.exists('data3.csv.zone.json')
+    assert zonemap.matching('.', pixels=(15, 25)) == ['./data2.csv', './data3.csv']
+    assert zonemap.matching('.', mag=(None, 12.0)) == ['./data1.csv', './data3.csv']
+
+
+def test_bucket_sidecars_survive_resume(tmp_path):
+    path = str(tmp_path / 'manifest.jsonl')
+    directory = str(tmp_path / 'buckets')
+    progress = manifest.Manifest(path)
+    data_queue = pipeline.BlockQueue()
+    block = star(1, 12.0) + star(2**55 + 1, 16.0)
+    data_queue.put(('a.csv.gz', [block], 2, 2, zonemap.from_csv(block)))
+    data_queue.put(None)
+    sinks.write_buckets(data_queue, progress, 2, gaia_filter.output_columns([8]), directory)
+    progress.close()
+
+    progress = manifest.Manifest(path, resume=True)
+    data_queue.put(('b.csv.gz', [star(2, 19.0)], 1, 1, zonemap.from_csv(star(2, 19.0))))
+    data_queue.put(None)
+    sinks.write_buckets(data_queue, progress, 2, gaia_filter.output_columns([8]), directory)
+
+    with open(zonemap.sidecar_name(sinks.bucket_file_name(directory, 2, 0))) as f:
+        sidecar = json.load(f)
+    assert [shard['shard'] for shard in sidecar['shards']] == ['a.csv.gz', 'b.csv.gz']
+    assert sidecar['zone']['phot_g_mean_mag'] == [12.0, 19.0]
+    assert zonemap.matching(directory, pixels=(1, 1), level=2) == [sinks.bucket_file_name(directory, 2, 1)]
+
+
+def test_columnar_descriptor_carries_zone(tmp_path):
+    text = ','.join(synthetic_gaia.header_columns()) + '\n' + ''.join(synthetic_gaia.make_rows(200, seed=4))
+    chunks = [columns for columns, accepted, total in gaia_filter.filter_columns(io.BytesIO(text.encode('utf-8')))]
+    columns = gaia_filter.concat_columns(chunks)
+    zone = zonemap.from_columns(columns)
+    path, descriptor = columnar.save_shard(str(tmp_path), 'GaiaSource_000000-003111.csv.gz', columns, 200, zone)
+    assert zonemap.load(str(tmp_path)) == [(path, zone)]
+    assert zonemap.matching(str(tmp_path), mag=(None, zone['phot_g_mean_mag'][0] - 1)) == []
+
+
+def test_columnar_shard_without_zone_is_always_matched(tmp_path):
+    columns = {'source_id': np.array([5, 6], dtype=np.int64), 'phot_g_mean_mag': np.array([12.0, 13.0], dtype=np.float32),
+               'has_xp_sampled': np.array([True, False])}
+    with_zone, descriptor = columnar.save_shard(str(tmp_path), 'GaiaSource_000000-000001.csv.gz', columns, zone=zonemap.from_columns(columns))
+    without_zone, descriptor = columnar.save_shard(str(tmp_path), 'GaiaSource_000002-000003.csv.gz', columns)
+    assert zonemap.matching(str(tmp_path), pixels=(100, 200)) == [without_zone]
+    assert zonemap.matching(str(tmp_path), pixels=(0, 0)) == [with_zone, without_zone]
@@ -0,0 +1,274 @@
+import math
+import struct
+import warnings
+import numpy as np
+
+#
+# Parsing of the GAIA XP sampled mean spectrum csv files for fetch_spectra.py. Lines
+# look like
+#
+#   source_id,solution_id,ra,dec,"[f1,f2,...,f343]","[e1,e2,...,e343]"
+#
+# Only source_id and flux are used and flux_error is never looked at. By default
+# (text_blocks) each kept line is cut down to source_id,"{f1,...,f343}" for COPY ...
+# WITH CSV, without parsing any numbers, and Postgres parses the flux itself. The
+# binary format (copy_blocks) parses the flux into float32 here and sends it as COPY
+# ... WITH (FORMAT binary), so Postgres gets about a third of the bytes and parses no
+# text, but the parsing here is slower than the rewrite. Which is faster end to end
+# depends on where the bottleneck is, benchmark_spectra_loader.py --dsn measures both
+#
+# With the float16 format flux is instead sent as a bytea already in the form the
+# photometric catalogue stores it (see export_flux), for the stars.flux16 column
+#
+
+CHUNK_BYTES = 16 * 1024 * 1024
+FLOAT4OID = 700
+FLUX_FORMATS = ['real', 'float16']
+COPY_FORMATS = ['text', 'binary']
+
+# COPY binary framing: signature, flags and header extension length, then one tuple per
+# row and a -1 field count to finish
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+
+def read_chunks(file, chunk_bytes=CHUNK_BYTES):
+    # Yields buffers of complete data lines, skipping the comment block and header
+    for line in file:
+        if not line.startswith(b'#'):
+            break
+    remainder = b''
+    while True:
+        data = file.read(chunk_bytes)
+        if not data:
+            break
+        data = remainder + data
+        cut = data.rfind(b'\n') + 1
+        remainder = data[cut:]
+        if cut:
+            yield data[:cut]
+    if remainder.strip():
+        yield remainder + b'\n'
+
+def parse_flux(buf, starts, ends, samples):
+    # float32 (rows, samples) array from the text between each start and end, each
+    # of which holds samples values. The whole chunk is joined and parsed in one go,
+    # which only falls back to parsing value by value if a row holds something other
+    # than numbers
+    text = b','.join(buf[start:end] for start, end in zip(starts.tolist(), ends.tolist()))
+    rows = len(starts)
+    values = np.empty(0, dtype=np.float32)
+    with warnings.catch_warnings():
+        # Older numpy only warns when it stops short at something that isn't a
+        # number, the length check below picks that up. Newer numpy raises
+        warnings.simplefilter('ignore', DeprecationWarning)
+        try:
+            values = np.fromstring(text, dtype=np.float32, sep=',')
+        except ValueError:
+            pass
+    if len(values) == rows * samples:
+        return values.reshape(rows, samples)
+    parsed = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        row = []
+        for value in buf[start:end].split(b','):
+            try:
+                row.append(float(value))
+            except ValueError:
+                row.append(np.nan)
+        parsed.append(row)
+    return np.array(parsed, dtype=np.float32)
+
+def parse_chunk(buf, members=None):
+    # Returns (source_ids, flux, rows read) for a buffer of complete lines, keeping
+    # only the rows whose source_id is in members when given. flux is the first
+    # bracketed field of each line
+    data = np.frombuffer(buf, dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord('\n'))
+    rows = len(newlines)
+    if rows == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32), 0
+    starts = np.empty(rows, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = newlines[:-1] + 1
+
+    # Every line has the same number of brackets, so the first of each per line is
+    # a strided slice. A null flux would break that and falls back to line by line
+    opens = np.flatnonzero(data == ord('['))
+    closes = np.flatnonzero(data == ord(']'))
+    commas = np.flatnonzero(data == ord(','))
+    per_line = len(opens) // rows
+    if per_line == 0 or len(opens) != per_line * rows or len(closes) != len(opens):
+        return parse_lines(buf, members)
+    opens = opens[::per_line]
+    closes = closes[::per_line]
+    if (opens < starts).any() or (closes > newlines).any():
+        return parse_lines(buf, members)
+
+    # Spectra all have the same number of samples, one more than the commas between
+    # the brackets
+    samples = np.searchsorted(commas, closes) - np.searchsorted(commas, opens) + 1
+    if (samples != samples[0]).any():
+        return parse_lines(buf, members)
+
+    first_commas = commas[np.searchsorted(commas, starts)]
+    source_ids = np.array([buf[start:end] for start, end in zip(starts.tolist(), first_commas.tolist())]).astype(np.int64)
+    if members is not None:
+        keep = members.contains(source_ids)
+        source_ids, opens, closes = source_ids[keep], opens[keep], closes[keep]
+    return source_ids, parse_flux(buf, opens + 1, closes, int(samples[0])), rows
+
+def parse_lines(buf, members=None):
+    # Line at a time fallback for chunks the vectorized split can't handle
+    source_ids = []
+    fluxes = []
+    rows = 0
+    for line in buf.split(b'\n'):
+        if not line.strip():
+            continue
+        rows += 1
+        source_id = int(line[:line.index(b',')])
+        if members is not None and not members.contains([source_id])[0]:
+            continue
+        source_ids.append(source_id)
+        start = line.find(b'[')
+        if start == -1:
+            fluxes.append(None)
+            continue
+        fluxes.append([float(value) if value.strip() not in (b'', b'null') else np.nan
+                       for value in line[start + 1:line.index(b']', start)].split(b',')])
+    samples = max((len(flux) for flux in fluxes if flux is not None), default=0)
+    flux = np.full((len(fluxes), samples), np.nan, dtype=np.float32)
+    for i, values in enumerate(fluxes):
+        if values is not None:
+            flux[i, :len(values)] = values
+    return np.array(source_ids, dtype=np.int64), flux, rows
+
+def text_rows(buf, members=None):
+    # Returns (rows read, rows kept, csv) for a buffer of complete lines, each kept row
+    # written as source_id,"{flux}" with no parsing of the values. A line without a
+    # flux array gets an empty field, which COPY reads as NULL
+    lines = [line for line in buf.split(b'\n') if line.strip()]
+    rows = len(lines)
+    source_ids = [line[:line.index(b',')] for line in lines]
+    if members is not None and lines:
+        keep = members.contains(np.array(source_ids).astype(np.int64)).tolist()
+        lines = [line for line, kept in zip(lines, keep) if kept]
+        source_ids = [source_id for source_id, kept in zip(source_ids, keep) if kept]
+    out = []
+    for source_id, line in zip(source_ids, lines):
+        start = line.find(b'[')
+        if start == -1:
+            out.append(source_id + b',\n')
+        else:
+            out.append(b'%s,"{%s}"\n' % (source_id, line[start + 1:line.index(b']', start)]))
+    return rows, len(out), b''.join(out)
+
+def copy_rows(source_ids, flux):
+    # COPY binary tuples of (bigint source_id, real[] flux) for every row, built as
+    # one numpy record array rather than row by row
+    rows, samples = flux.shape
+    record = np.dtype([
+        ('fields', '>i2'), ('id_length', '>i4'), ('source_id', '>i8'),
+        ('array_length', '>i4'), ('ndim', '>i4'), ('has_null', '>i4'), ('element_type', '>u4'),
+        ('dim', '>i4'), ('lower_bound', '>i4'),
+        ('elements', [('length', '>i4'), ('value', '>f4')], (samples,)),
+    ])
+    out = np.empty(rows, dtype=record)
+    out['fields'] = 2
+    out['id_length'] = 8
+    out['source_id'] = source_ids
+    out['array_length'] = 20 + 8 * samples
+    out['ndim'] = 1
+    out['has_null'] = 0
+    out['element_type'] = FLOAT4OID
+    out['dim'] = samples
+    out['lower_bound'] = 1
+    out['elements']['length'] = 4
+    out['elements']['value'] = flux
+    return out.tobytes()
+
+def export_flux(flux):
+    # Each spectrum exactly as writeDataElement in generate-photometry.py writes it:
+    # one byte e, the power of ten that brings the largest value just under 1, then
+    # every value times 10**e as a little endian float16. Returns a
+    # (rows, 1 + 2 * samples) uint8 matrix
+    rows, samples = flux.shape
+    largest = np.abs(flux).max(axis=1).astype(np.float64).tolist() if samples else [0.0] * rows
+    exponents = [math.ceil(-math.log10(value)) if value > 0 else 0 for value in largest]
+    if any(e < 0 or e > 255 for e in exponents):
+        raise ValueError("flux out of range for a one byte exponent")
+    scale = np.array([10 ** e for e in exponents], dtype=np.float64)
+    out = np.empty((rows, 1 + 2 * samples), dtype=np.uint8)
+    out[:, 0] = exponents
+    out[:, 1:] = (flux.astype(np.float64) * scale[:, None]).astype('<f2').view(np.uint8).reshape(rows, 2 * samples)
+    return out
+
+def copy_bytea_rows(source_ids, payload):
+    # COPY binary tuples of (bigint source_id, bytea) from a (rows, width) uint8 matrix
+    rows, width = payload.shape
+    record = np.dtype([
+        ('fields', '>i2'), ('id_length', '>i4'), ('source_id', '>i8'),
+        ('payload_length', '>i4'), ('payload', 'u1', (width,)),
+    ])
+    out = np.empty(rows, dtype=record)
+    out['fields'] = 2
+    out['id_length'] = 8
+    out['source_id'] = source_ids
+    out['payload_length'] = width
+    out['payload'] = payload
+    return out.tobytes()
+
+def copy_blocks(file, members=None, counts=None, chunk_bytes=CHUNK_BYTES, flux_format='real'):
+    # Yields the COPY binary stream for a decompressed spectra file a chunk at a time.
+    # counts, a dict, gets the rows read and kept added to it as it goes
+    yield COPY_HEADER
+    for buf in read_chunks(file, chunk_bytes):
+        source_ids, flux, rows = parse_chunk(buf, members)
+        if counts is not None:
+            counts['read'] = counts.get('read', 0) + rows
+            counts['kept'] = counts.get('kept', 0) + len(source_ids)
+        if len(source_ids):
+            if flux_format == 'float16':
+                yield copy_bytea_rows(source_ids, export_flux(flux))
+            else:
+                yield copy_rows(source_ids, flux)
+    yield COPY_TRAILER
+
+def text_blocks(file, members=None, counts=None, chunk_bytes=CHUNK_BYTES):
+    # Yields the csv for COPY ... WITH CSV of a decompressed spectra file a chunk at a
+    # time, counting rows into counts like copy_blocks
+    for buf in read_chunks(file, chunk_bytes):
+        rows, kept, block = text_rows(buf, members)
+        if counts is not None:
+            counts['read'] = counts.get('read', 0) + rows
+            counts['kept'] = counts.get('kept', 0) + kept
+        if block:
+            yield block
+
+class StreamReader:
+    # Minimal file object over an iterator of bytes, for copy_expert to read from.
+    # Blocks are handed out in slices without ever being copied into one buffer
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.block = b''
+        self.position = 0
+
+    def read(self, size=-1):
+        parts = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self.position >= len(self.block):
+                self.block = next(self.blocks, None)
+                self.position = 0
+                if self.block is None:
+                    self.block = b''
+                    break
+                continue
+            end = len(self.block) if size < 0 else min(len(self.block), self.position + wanted)
+            parts.append(self.block[self.position:end])
+            wanted -= end - self.position
+            self.position = end
+        return b''.join(parts)
+
+    def readline(self, size=-1):
+        return self.read(size)
@@ -0,0 +1,169 @@
+import argparse
+import glob
+import json
+import os
+import numpy as np
+import gaia_filter
+import columnar
+
+#
+# Zone maps for the staging output of fetch_gaia_source.py. Every output shard gets a
+# small summary of what it holds:
+#
+#   {"rows": 181234, "source_id": [min, max], "healpix8": [min, max],
+#    "phot_g_mean_mag": [min, max], "has_xp_sampled": 1520}
+#
+# The csv and bucket sinks keep it in a sidecar next to each file, e.g.
+# data1.csv.zone.json, along with the zone of every input shard and where it sits in
+# the file. Columnar shards carry it in their descriptor.json under "zone". Zones are
+# worked out on the filter threads and merged by the writers
+#
+# matching() uses them to list the output shards that can hold rows in a pixel range
+# or magnitude cut, so a partial rebuild or spot check only reads those, e.g.
+#
+#   python zonemap.py . --pixels 1000 1200 --max-mag 12 | xargs python load_staging.py
+#
+
+SUFFIX = '.zone.json'
+
+def empty():
+    return {'rows': 0, 'source_id': None, 'healpix8': None, 'phot_g_mean_mag': None, 'has_xp_sampled': 0}
+
+def from_arrays(source_id, mag, xp):
+    zone = empty()
+    zone['rows'] = len(source_id)
+    if len(source_id):
+        zone['source_id'] = [int(source_id.min()), int(source_id.max())]
+        zone['healpix8'] = [int(gaia_filter.healpix(source_id.min())), int(gaia_filter.healpix(source_id.max()))]
+        mag = mag[~np.isnan(mag)]
+        if len(mag):
+            zone['phot_g_mean_mag'] = [float(mag.min()), float(mag.max())]
+        zone['has_xp_sampled'] = int(np.count_nonzero(xp))
+    return zone
+
+def from_csv(block):
+    # Zone of a block of output csv lines
+    if not block:
+        return empty()
+    fields, starts, newlines = gaia_filter.output_fields(block, ['source_id', 'phot_g_mean_mag', 'has_xp_sampled'])
+    return from_arrays(fields['source_id'].astype(np.int64), gaia_filter.to_float(fields['phot_g_mean_mag']),
+                       fields['has_xp_sampled'] == b'1')
+
+def from_columns(columns):
+    # Zone of a dict of numpy columns from the columnar path
+    if not columns:
+        return empty()
+    return from_arrays(columns['source_id'], columns['phot_g_mean_mag'].astype(np.float64), columns['has_xp_sampled'])
+
+def merge_range(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return [min(a[0], b[0]), max(a[1], b[1])]
+
+def merge(zones):
+    merged = empty()
+    for zone in zones:
+        merged['rows'] += zone['rows']
+        merged['has_xp_sampled'] += zone['has_xp_sampled']
+        for name in ['source_id', 'healpix8', 'phot_g_mean_mag']:
+            merged[name] = merge_range(merged[name], zone[name])
+    return merged
+
+def sidecar_name(path):
+    return path + SUFFIX
+
+def write_sidecar(path, shards):
+    # shards is a list of {"shard", "offset", "length", "zone"} for every input shard
+    # in the file. Replaced atomically so a reader never sees half a sidecar
+    sidecar = {'path': os.path.basename(path), 'zone': merge(shard['zone'] for shard in shards), 'shards': shards}
+    temp_name = sidecar_name(path) + '.tmp'
+    with open(temp_name, 'w') as f:
+        json.dump(sidecar, f, indent=1)
+    os.replace(temp_name, sidecar_name(path))
+    return sidecar
+
+def overlaps(zone, source_ids=None, mag=None, xp=False):
+    # Whether a shard with this zone can hold rows with a source_id in source_ids, a
+    # magnitude in mag and, with xp, XP spectra. Ranges are inclusive, either end may
+    # be None for open ended
+    if zone['rows'] == 0:
+        return False
+    if xp and zone['has_xp_sampled'] == 0:
+        return False
+    for wanted, have in [(source_ids, zone['source_id']), (mag, zone['phot_g_mean_mag'])]:
+        if wanted is None:
+            continue
+        if have is None:
+            return False
+        low, high = wanted
+        if (low is not None and have[1] < low) or (high is not None and have[0] > high):
+            return False
+    return True
+
+def pixel_source_ids(first, last, level=8):
+    # source_id range covered by HEALPix pixels first to last inclusive at level
+    shift = gaia_filter.healpix_shift(level)
+    return first << shift, ((last + 1) << shift) - 1
+
+def load(directory):
+    # (path, zone) for every output shard under directory that has a zone map
+    zones = []
+    for sidecar in sorted(glob.glob(os.path.join(directory, '*' + SUFFIX))):
+        with open(sidecar, 'r') as f:
+            zones.append((sidecar[:-len(SUFFIX)], json.load(f)['zone']))
+    if os.path.isdir(directory):
+        for path in columnar.list_shards(directory):
+            descriptor, columns = columnar.load_shard(path, names=[])
+            if 'zone' in descriptor:
+                zones.append((path, descriptor['zone']))
+    return zones
+
+def pieces(directory):
+    # Every input shard's part of the output shards under directory, as dicts of path,
+    # offset, length and zone. A columnar shard is one piece with no offset
+    found = []
+    for sidecar in sorted(glob.glob(os.path.join(directory, '*' + SUFFIX))):
+        with open(sidecar, 'r') as f:
+            shards = json.load(f)['shards']
+        for shard in shards:
+            found.append({'path': sidecar[:-len(SUFFIX)], 'offset': shard['offset'], 'length': shard['length'], 'zone': shard['zone']})
+    if os.path.isdir(directory):
+        for path in columnar.list_shards(directory):
+            descriptor, columns = columnar.load_shard(path, names=[])
+            if 'zone' in descriptor:
+                found.append({'path': path, 'offset': None, 'length': None, 'zone': descriptor['zone']})
+    return found
+
+def matching(directory, pixels=None, level=8, mag=None, xp=False):
+    # Paths of the output shards under directory that can hold rows in the HEALPix
+    # pixel range (first, last) at level, the magnitude range (low, high) and, with
+    # xp, that have XP spectra. Shards without a zone map are always included
+    source_ids = pixel_source_ids(*pixels, level) if pixels is not None else None
+    known = load(directory)
+    paths = [path for path, zone in known if overlaps(zone, source_ids, mag, xp)]
+    described = set(path for path, zone in known)
+    for path in glob.glob(os.path.join(directory, 'data*.csv*')) + glob.glob(os.path.join(directory, 'healpix*_*.csv')):
+        if not path.endswith(SUFFIX) and not path.endswith('.tmp') and path not in described:
+            paths.append(path)
+    if os.path.isdir(directory):
+        paths.extend(path for path in columnar.list_shards(directory) if path not in described)
+    return sorted(paths)
+
+def main():
+    parser = argparse.ArgumentParser(description="List the staging files that can hold rows in a sky region or magnitude range.")
+    parser.add_argument("directory", help="Directory holding data{N}.csv files, buckets or columnar shards")
+    parser.add_argument("--pixels", type=int, nargs=2, metavar=("FIRST", "LAST"), help="HEALPix pixel range, inclusive")
+    parser.add_argument("--level", type=int, default=8, help="HEALPix level of --pixels")
+    parser.add_argument("--min-mag", type=float, default=None)
+    parser.add_argument("--max-mag", type=float, default=None)
+    parser.add_argument("--xp", action="store_true", help="Only shards with XP sampled spectra")
+    args = parser.parse_args()
+
+    mag = None if args.min_mag is None and args.max_mag is None else (args.min_mag, args.max_mag)
+    for path in matching(args.directory, args.pixels, args.level, mag, args.xp):
+        print(path)
+
+if __name__ == "__main__":
+    main()